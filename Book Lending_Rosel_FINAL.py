@@ -1,7 +1,16 @@
 import customtkinter as ctk
 from tkinter import messagebox, simpledialog
-from datetime import datetime
+from itertools import islice
 import os
+import threading
+import time
+
+from booklending import (
+    DUMMY_PASSWORD_HASH, REQUESTS_FILE, Book, BranchLibrary, LendingError, LibraryService, PersistenceWorker,
+    clean_title, default_storage, hash_password, needs_rehash, perf, shared_library, verify_password,
+)
+from lendingreports import build_report, format_report
+from lendingserver import LendingClient
 
 def create_logout_button(parent, app):
     def logout():
@@ -9,101 +18,343 @@ def create_logout_button(parent, app):
         app.deiconify()
     return ctk.CTkButton(parent, text="Logout", command=logout)
 
+def show_error(error):
+    # Errors handed back by the persistence worker.
+    if isinstance(error, LendingError):
+        messagebox.showerror("Error", str(error))
+    else:
+        messagebox.showerror("Error", f"Could not read or save library data: {error}")
+
 # === CONFIG ===
-ctk.set_appearance_mode("dark")
-ctk.set_default_color_theme("green")
-
-USER_DB = "users.txt"
-MANAGER_DB = "managers.txt"
-BOOK_DB = "library.txt"
-ACTIVITY_LOG_FILE = "activity_log.txt"
-REQUESTS_FILE = "requests.txt"
-
-# === USER ACCOUNT FUNCTIONS ===
-def load_users(filename):
-    if not os.path.exists(filename):
-        return {}
-    users = {}
-    with open(filename, "r") as file:
-        for line in file:
-            line = line.strip()
-            if "," in line:
-                username, password = line.split(",", 1)
-                users[username] = password
-    return users
-
-def save_user(username, password):
-    with open(USER_DB, "a") as file:
-        file.write(f"{username},{password}\n")
-
-# === Book Class ===
-class Book:
-    def __init__(self, title, quantity=1, is_lent=0):
-        self.title = title
-        self.quantity = int(quantity)
-        self.is_lent = int(is_lent)
-
-    def __str__(self):
-        return f"{self.title}|{self.quantity}|{self.is_lent}"
-
-    def available(self):
-        return self.quantity - self.is_lent
+SYNC_INTERVAL_MS = 2000
+LOAD_STEP_MS = 1  # pause between catalog chunks so Tk can paint and take input
+WORKER_POLL_MS = 20
+SEARCH_DEBOUNCE_MS = 150  # wait for a pause in typing before searching
+DASHBOARD_LINES = 50
+LOG_QUERY_LIMIT = 500  # newest matches shown for an activity log filter
+PERF_REFRESH_MS = 1000
+# With BOOK_SERVER set (e.g. http://127.0.0.1:8765 or unix:/tmp/lending.sock)
+# logins, sign-ups and the customer view go through lendingserver.py instead
+# of loading the catalog; the manager window still works on the files.
+SERVER_URL = os.environ.get("BOOK_SERVER")
+SERVER_PAGE_SIZE = 1000
+
+
+def apply_theme():
+    ctk.set_appearance_mode("dark")
+    ctk.set_default_color_theme("green")
+
+# === Book List Widget ===
+# Only a fixed pool of row widgets (enough to fill the visible height) is ever
+# created. Scrolling and filtering just move a window over self.rows and
+# rewrite the labels whose text actually changed.
+#
+# stream_rows() fills self.rows from a lazy iterable a few milliseconds at a
+# time between Tk events, so a search matching the whole catalog never holds
+# up typing; calling it again cancels a stream that is still running.
+# Rows that come from elsewhere a page at a time are added with append_rows();
+# on_more is called whenever the view scrolls within a screenful of the last
+# row it has, so the next page is only asked for when it is about to be seen.
+#
+# Columns given a sort key (one of booklending.SORT_COLUMNS) have clickable
+# headers: a click sorts ascending by that column, a second click on the same
+# header reverses it, and a click on a header without a sort key goes back to
+# catalog order; each click jumps to the top and calls on_sort to refill the
+# list. Prev/Next move one screenful. Sorted rows are built on the
+# persistence worker, next to the writes that keep the sort indexes up to
+# date, and handed to load_rows' callback. Without a search, a sorted catalog
+# is shown through PagedRows: the worker builds the catalog's SortedColumn
+# index, and rows are then fetched PAGE at a time from it as they are first
+# drawn, with at most MAX_PAGES pages kept before the cache starts over.
+# Sorted search matches are built as one plain list.
+class PagedRows:
+    PAGE = 100
+    MAX_PAGES = 50
+
+    def __init__(self, count, fetch):
+        self.count = count
+        self.fetch = fetch  # fetch(start, stop) -> the rows at positions [start, stop)
+        self.pages = {}
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        page, slot = divmod(index, self.PAGE)
+        rows = self.pages.get(page)
+        if rows is None:
+            if len(self.pages) >= self.MAX_PAGES:
+                self.pages.clear()
+            rows = self.pages[page] = self.fetch(page * self.PAGE, min(self.count, (page + 1) * self.PAGE))
+        return rows[slot]
+
+
+def sorted_book_rows(library, sort, descending, query, mode, make_row):
+    # The rows of a sorted view, run on the persistence worker: the whole
+    # catalog is paged in from its sort index as it scrolls by, search
+    # matches are sorted up front.
+    if query.strip():
+        return [make_row(number, book) for number, book in library.sorted_books(sort, 0, None, descending, query, mode)]
+    books = library.books
+    books.sorted_column(sort)
+    def fetch(start, stop):
+        if library.books is books:
+            pairs = library.sorted_books(sort, start, stop, descending)
+        else:  # reloaded since; the refresh that follows replaces these rows
+            pairs = [(row + 1, Book(books, row)) for row in books.sorted_rows(sort, start, stop, descending)]
+        return [make_row(number, book) for number, book in pairs]
+    return PagedRows(len(books), fetch)
+
+
+class BookListView(ctk.CTkFrame):
+    ROW_HEIGHT = 30
+    FRAME_BUDGET = 0.008  # seconds of row building per Tk callback
+
+    def __init__(self, master, columns, key_column=0, on_select=None, sort_keys=None, on_sort=None, on_more=None,
+                 **kwargs):
+        super().__init__(master, **kwargs)
+        self.columns = columns
+        self.key_column = key_column
+        self.on_select = on_select
+        self.sort_keys = sort_keys or [None] * len(columns)
+        self.on_sort = on_sort
+        self.on_more = on_more
+        self.sort = None  # the sort column, or None for catalog order
+        self.descending = False
+        self.rows = []
+        self.row_index = {}
+        self.offset = 0
+        self.visible_count = 0
+        self.selected_key = None
+        self.row_frames = []
+        self.row_labels = []
+        self.row_values = []
+        self.row_colors = []
+        self.stream_job = None
+        self.generation = 0  # bumped by each refresh, so a late load_rows result is dropped
+
+        header_frame = ctk.CTkFrame(self)
+        header_frame.pack(fill='x', pady=(0, 5))
+        self.header_labels = []
+        for col, (text, width) in enumerate(columns):
+            label = ctk.CTkLabel(header_frame, text=text, width=width, anchor='w',
+                                 font=ctk.CTkFont(weight="bold"))
+            label.pack(side='left', padx=5)
+            if on_sort is not None:
+                label.bind('<Button-1>', lambda event, col=col: self.sort_by(col))
+            self.header_labels.append(label)
+        pager = ctk.CTkFrame(self, fg_color="transparent")
+        pager.pack(side='bottom', fill='x', pady=(5, 0))
+        ctk.CTkButton(pager, text="◀ Prev", width=70,
+                      command=lambda: self.scroll_to(self.offset - self.visible_count)).pack(side='left', padx=5)
+        ctk.CTkButton(pager, text="Next ▶", width=70,
+                      command=lambda: self.scroll_to(self.offset + self.visible_count)).pack(side='right', padx=5)
+        self.page_label = ctk.CTkLabel(pager, text="")
+        self.page_label.pack(side='left', expand=True)
+
+        self.scrollbar = ctk.CTkScrollbar(self, orientation="vertical", command=self.on_scroll)
+        self.scrollbar.pack(side='right', fill='y')
+        self.body = ctk.CTkFrame(self, fg_color="transparent")
+        self.body.pack(side='left', fill='both', expand=True)
+        self.body.grid_columnconfigure(0, weight=1)
+        self.body.bind('<Configure>', self.on_resize)
+        self.bind_wheel(self.body)
+
+    def add_row_widget(self):
+        slot = len(self.row_frames)
+        row_frame = ctk.CTkFrame(self.body, fg_color='gray15', corner_radius=5)
+        row_frame.grid(row=slot, column=0, sticky='ew', padx=2, pady=1)
+        row_frame.grid_remove()
+        labels = []
+        for col, (text, width) in enumerate(self.columns):
+            label = ctk.CTkLabel(row_frame, text="", width=width, anchor='w')
+            label.grid(row=0, column=col, sticky='w', padx=5)
+            labels.append(label)
+        for widget in [row_frame] + labels:
+            widget.bind('<Button-1>', lambda event, slot=slot: self.select_slot(slot))
+            self.bind_wheel(widget)
+        self.row_frames.append(row_frame)
+        self.row_labels.append(labels)
+        self.row_values.append(None)
+        self.row_colors.append('gray15')
+
+    def bind_wheel(self, widget):
+        widget.bind('<MouseWheel>', lambda event: self.scroll_to(self.offset + (-3 if event.delta > 0 else 3)))
+        widget.bind('<Button-4>', lambda event: self.scroll_to(self.offset - 3))
+        widget.bind('<Button-5>', lambda event: self.scroll_to(self.offset + 3))
+
+    def on_resize(self, event):
+        self.visible_count = max(1, event.height // self.ROW_HEIGHT)
+        while len(self.row_frames) < self.visible_count:
+            self.add_row_widget()
+        self.scroll_to(self.offset, force=True)
+
+    def on_scroll(self, action, value, unit=None):
+        if action == 'moveto':
+            self.scroll_to(int(float(value) * len(self.rows)))
+        else:
+            step = self.visible_count if unit == 'pages' else 1
+            self.scroll_to(self.offset + int(value) * step)
+
+    def scroll_to(self, offset, force=False):
+        offset = min(max(0, offset), max(0, len(self.rows) - self.visible_count))
+        if force or offset != self.offset:
+            self.offset = offset
+            self.render()
+        if self.on_more is not None and offset + 2 * self.visible_count >= len(self.rows):
+            self.on_more()
+
+    def sort_by(self, col):
+        key = self.sort_keys[col]
+        if key is not None and key == self.sort:
+            self.descending = not self.descending
+        else:
+            self.sort, self.descending = key, False
+        for label, (text, _), column_key in zip(self.header_labels, self.columns, self.sort_keys):
+            arrow = (" ▼" if self.descending else " ▲") if column_key is not None and column_key == self.sort else ""
+            label.configure(text=text + arrow)
+        self.offset = 0
+        self.on_sort()
+
+    def set_rows(self, rows):
+        self.rows = rows
+        # Rows paged in from a sort index are looked up by position only.
+        self.row_index = {} if isinstance(rows, PagedRows) else {row[self.key_column]: i for i, row in enumerate(rows)}
+        self.scroll_to(self.offset, force=True)
+
+    def append_rows(self, rows):
+        start = len(self.rows)
+        self.rows.extend(rows)
+        key_column = self.key_column
+        for i, row in enumerate(rows, start):
+            self.row_index[row[key_column]] = i
+        if start < self.offset + self.visible_count:
+            self.render()
+        else:
+            self.update_scrollbar()
+
+    def stream_rows(self, rows):
+        self.cancel_stream()
+        self.stream_started = time.perf_counter()
+        rows = iter(rows)
+        chunk, done = self.take_slice(rows)
+        self.set_rows(chunk)
+        if done:
+            self.stream_done()
+        else:
+            self.stream_job = self.after(1, self.stream_next, rows)
+
+    def stream_next(self, rows):
+        chunk, done = self.take_slice(rows)
+        self.append_rows(chunk)
+        self.stream_job = None if done else self.after(1, self.stream_next, rows)
+        if done:
+            self.stream_done()
+
+    def stream_done(self):
+        if perf.enabled:
+            perf.record("BookListView.stream_rows (to last row)", time.perf_counter() - self.stream_started)
+
+    def take_slice(self, rows):
+        chunk = []
+        deadline = time.perf_counter() + self.FRAME_BUDGET
+        while time.perf_counter() < deadline:
+            part = list(islice(rows, 256))
+            chunk += part
+            if len(part) < 256:
+                return chunk, True
+        return chunk, False
+
+    def load_rows(self, worker, build):
+        # Rows built by build() on the worker replace the list when they
+        # arrive, unless another refresh has started since.
+        self.cancel_stream()
+        generation = self.generation
+        worker.submit(build, lambda rows, error: self.rows_loaded(generation, rows, error), key=("rows", id(self)))
+
+    def rows_loaded(self, generation, rows, error):
+        if generation != self.generation:
+            return
+        if error:
+            show_error(error)
+            return
+        self.set_rows(rows)
 
-    @staticmethod
-    def from_string(data_str):
-        parts = data_str.strip().split("|")
-        if len(parts) == 3:
-            return Book(parts[0], parts[1], parts[2])
-        return None
-
-# === Library Class ===
-class Library:
-    def __init__(self):
-        self.books = {}
-        self.load_books()
+    def cancel_stream(self):
+        self.generation += 1
+        if self.stream_job is not None:
+            self.after_cancel(self.stream_job)
+            self.stream_job = None
 
-    def load_books(self):
-        if not os.path.exists(BOOK_DB):
-            return
-        with open(BOOK_DB, "r") as f:
-            for line in f:
-                book = Book.from_string(line)
-                if book:
-                    self.books[book.title] = book
-
-    def save_books(self):
-        with open(BOOK_DB, "w") as f:
-            for book in self.books.values():
-                f.write(str(book) + "\n")
-
-    def add_book(self, title, quantity=1):
-        if title in self.books:
-            self.books[title].quantity += quantity
+    def destroy(self):
+        self.cancel_stream()
+        super().destroy()
+
+    def get_row(self, key):
+        index = self.row_index.get(key)
+        return None if index is None else self.rows[index]
+
+    def update_row(self, key, values):
+        index = self.row_index.get(key)
+        if index is None:
+            return
+        self.rows[index] = values
+        if self.offset <= index < self.offset + self.visible_count:
+            self.render()
+
+    def set_selected(self, key):
+        self.selected_key = key
+        self.render()
+
+    def select_slot(self, slot):
+        values = self.row_values[slot]
+        if values is None:
+            return
+        self.selected_key = values[self.key_column]
+        self.render()
+        if self.on_select:
+            self.on_select(self.selected_key)
+
+    def render(self):
+        for slot, row_frame in enumerate(self.row_frames):
+            index = self.offset + slot
+            old_values = self.row_values[slot]
+            if slot >= self.visible_count or index >= len(self.rows):
+                if old_values is not None:
+                    row_frame.grid_remove()
+                    self.row_values[slot] = None
+                continue
+            values = self.rows[index]
+            if old_values is None:
+                row_frame.grid()
+            if values != old_values:
+                for col, label in enumerate(self.row_labels[slot]):
+                    if old_values is None or old_values[col] != values[col]:
+                        label.configure(text=str(values[col]))
+                self.row_values[slot] = values
+            if values[self.key_column] == self.selected_key:
+                color = 'blue'
+            else:
+                color = 'gray20' if index % 2 == 0 else 'gray15'
+            if self.row_colors[slot] != color:
+                row_frame.configure(fg_color=color)
+                self.row_colors[slot] = color
+        self.update_scrollbar()
+
+    def update_scrollbar(self):
+        total = len(self.rows)
+        if total:
+            self.scrollbar.set(self.offset / total, min(1.0, (self.offset + self.visible_count) / total))
+            per_page = max(1, self.visible_count)
+            last = min(total, self.offset + per_page)
+            pages = -(-total // per_page)
+            page = pages if last == total else self.offset // per_page + 1
+            text = f"Rows {self.offset + 1}–{last} of {total}   (page {page} of {pages})"
         else:
-            self.books[title] = Book(title, quantity)
-        self.save_books()
-        return True
-
-    def lend_book(self, title):
-        if title in self.books:
-            book = self.books[title]
-            if book.is_lent < book.quantity:
-                book.is_lent += 1
-                self.save_books()
-                return True
-        return False
-
-    def return_book(self, title):
-        if title in self.books:
-            book = self.books[title]
-            if book.is_lent > 0:
-                book.is_lent -= 1
-                self.save_books()
-                return True
-        return False
-
-    def get_books(self):
-        return self.books.values()
+            self.scrollbar.set(0.0, 1.0)
+            text = "No books"
+        if text != self.page_label.cget("text"):
+            self.page_label.configure(text=text)
 
 # === Manager View ===
 class LibraryGUI(ctk.CTkToplevel):
@@ -114,12 +365,20 @@ class LibraryGUI(ctk.CTkToplevel):
         self.title("Book Lending System")
         self.geometry("700x500")
         self.username = username
-        self.library = Library()
-        self.activity_log = []
-
-        self.load_activity_log()
-
-        self.tabview = ctk.CTkTabview(self, width=680, height=460)
+        self.library = shared_library(lazy=True)
+        self.worker = master.worker
+        self.service = LibraryService(self.library, username)
+        self.request_store = self.library.storage.requests
+        self.activity_log = self.library.storage.activity_log
+        self.worker.subscribe(self.on_library_change)
+        self.dashboard_loaded = False
+        self.logs_shown = 0  # how many log entries / requests the boxes already show
+        self.requests_shown = 0
+        self.most_requested = []
+        self.log_filtered = False  # the log box shows filter results, not the live tail
+        self.search_job = None
+
+        self.tabview = ctk.CTkTabview(self, width=680, height=460, command=self.on_tab_change)
         self.tabview.pack(padx=10, pady=10, expand=True, fill="both")
 
         self.dashboard_tab = self.tabview.add("Dashboard")
@@ -129,7 +388,23 @@ class LibraryGUI(ctk.CTkToplevel):
 
         self.init_dashboard_tab()
         self.init_functions_tab()
-
+        self.perf_tab = None
+        self.perf_job = None
+        if perf.enabled:
+            self.init_perf_tab()
+        self.bind("<Control-Alt-p>", lambda event: self.init_perf_tab())
+        self.after(LOAD_STEP_MS, self.on_tab_change)  # Dashboard is shown first
+        self.poll_job = self.after(SYNC_INTERVAL_MS, self.poll_library)
+
+
+    def destroy(self):
+        self.after_cancel(self.poll_job)
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+        if self.perf_job is not None:
+            self.after_cancel(self.perf_job)
+        self.worker.unsubscribe(self.on_library_change)
+        super().destroy()
 
     def logout(self):
         self.destroy()
@@ -141,17 +416,18 @@ class LibraryGUI(ctk.CTkToplevel):
         ctk.CTkLabel(search_frame, text='Search Book:').pack(side='left', padx=5, pady=5)
         search_entry = ctk.CTkEntry(search_frame, textvariable=self.search_var, width=300)
         search_entry.pack(side='left', fill='x', expand=True, padx=(0,5), pady=5)
-        self.search_var.trace_add('write', lambda *args: self.refresh_books())
-
-        self.scrollable_frame = ctk.CTkScrollableFrame(self.functions_tab)
-        self.scrollable_frame.pack(fill='both', expand=True, padx=10, pady=10, side='left')
-
-        header_frame = ctk.CTkFrame(self.scrollable_frame)
-        header_frame.pack(fill='x', pady=(0, 10))
-        ctk.CTkLabel(header_frame, text='No.', width=50).pack(side='left', padx=(10,5))
-        ctk.CTkLabel(header_frame, text='Title', width=300).pack(side='left', padx=5)
-        ctk.CTkLabel(header_frame, text='Available', width=80).pack(side='left', padx=5)
-        ctk.CTkLabel(header_frame, text='Total', width=80).pack(side='left', padx=5)
+        self.search_var.trace_add('write', lambda *args: self.schedule_search())
+        self.fuzzy_var = ctk.BooleanVar(value=False)
+        ctk.CTkCheckBox(search_frame, text='Fuzzy', variable=self.fuzzy_var, width=60,
+                        command=self.refresh_books).pack(side='left', padx=5, pady=5)
+
+        self.book_list = BookListView(self.functions_tab,
+                                      columns=[('No.', 50), ('Title', 260), ('Available', 80), ('Total', 60),
+                                               ('Lent', 60)],
+                                      key_column=1, on_select=self.on_book_selected,
+                                      sort_keys=[None, 'title', 'available', 'total', 'lent'],
+                                      on_sort=self.refresh_books)
+        self.book_list.pack(fill='both', expand=True, padx=10, pady=10, side='left')
 
         button_frame = ctk.CTkFrame(self.functions_tab)
         button_frame.pack(side='right', fill='y', padx=10, pady=10)
@@ -163,14 +439,41 @@ class LibraryGUI(ctk.CTkToplevel):
         ctk.CTkButton(button_frame, text='Add Book', command=self.add_book, width=button_width, height=button_height).pack(pady=(0, button_padding))
         ctk.CTkButton(button_frame, text='Lend Book', command=self.lend_book, width=button_width, height=button_height).pack(pady=(0, button_padding))
         ctk.CTkButton(button_frame, text='Return Book', command=self.return_book, width=button_width, height=button_height).pack(pady=(0, button_padding))
+        if isinstance(self.library, BranchLibrary):
+            ctk.CTkButton(button_frame, text='Branch Stock', command=self.show_branch_stock, width=button_width, height=button_height).pack(pady=(0, button_padding))
         ctk.CTkButton(button_frame, text='Logout', command=self.logout, width=button_width, height=button_height).pack(pady=(0, 0))
 
         self.refresh_books()
     def init_dashboard_tab(self):
         self.total_books_label = ctk.CTkLabel(self.dashboard_tab, text="", font=ctk.CTkFont(size=14, weight="bold"))
-        self.total_books_label.pack(pady=10)
-        self.reload_btn = ctk.CTkButton(self.dashboard_tab, text="Reload Logs", command=self.update_dashboard)
-        self.reload_btn.pack(pady=(0, 10))
+        self.total_books_label.pack(pady=(10, 0))
+        self.stats_label = ctk.CTkLabel(self.dashboard_tab, text="")
+        self.stats_label.pack(pady=(0, 10))
+        dashboard_buttons = ctk.CTkFrame(self.dashboard_tab, fg_color="transparent")
+        dashboard_buttons.pack(pady=(0, 10))
+        self.reload_btn = ctk.CTkButton(dashboard_buttons, text="Reload Logs", command=self.update_dashboard)
+        self.reload_btn.pack(side="left", padx=5)
+        self.approve_btn = ctk.CTkButton(dashboard_buttons, text="Approve Fulfillable Requests",
+                                         command=self.approve_requests)
+        self.approve_btn.pack(side="left", padx=5)
+        self.overdue_btn = ctk.CTkButton(dashboard_buttons, text="Overdue Loans", command=self.show_overdue)
+        self.overdue_btn.pack(side="left", padx=5)
+        self.reports_btn = ctk.CTkButton(dashboard_buttons, text="Reports", command=self.show_reports)
+        self.reports_btn.pack(side="left", padx=5)
+
+        # Activity log filter: any mix of who, words of the entry (a title)
+        # and a date range; dates may be cut short ("2025-05", "2025-05-13 10").
+        filter_row = ctk.CTkFrame(self.dashboard_tab, fg_color="transparent")
+        filter_row.pack(fill="x", padx=10)
+        self.log_filter_entries = {}
+        for name, placeholder, width in (("user", "User", 100), ("text", "Title or words", 170),
+                                         ("since", "From (YYYY-MM-DD)", 130), ("until", "To", 130)):
+            entry = ctk.CTkEntry(filter_row, placeholder_text=placeholder, width=width)
+            entry.pack(side="left", padx=(0, 5))
+            entry.bind("<Return>", self.filter_log)
+            self.log_filter_entries[name] = entry
+        ctk.CTkButton(filter_row, text="Filter", width=60, command=self.filter_log).pack(side="left", padx=(0, 5))
+        ctk.CTkButton(filter_row, text="Clear", width=60, command=self.clear_log_filter).pack(side="left")
         log_frame = ctk.CTkFrame(self.dashboard_tab)
         log_frame.pack(fill="both", expand=True, padx=10, pady=10)
 
@@ -184,23 +487,62 @@ class LibraryGUI(ctk.CTkToplevel):
         self.request_box = ctk.CTkTextbox(log_frame)
         self.request_box.pack(side="right", fill="both", expand=True, padx=(5, 0))
 
-    def load_activity_log(self):
-        if os.path.exists(ACTIVITY_LOG_FILE):
-            with open(ACTIVITY_LOG_FILE, "r") as f:
-                self.activity_log = [line.strip() for line in f.readlines()]
-
-    def save_activity_log(self):
-        with open(ACTIVITY_LOG_FILE, "w") as f:
-            for entry in self.activity_log:
-                f.write(entry + "\n")
-
-    def log_activity(self, action_text):
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        user_info = f"{self.username}" if self.username else "Unknown"
-        log_entry = f"[{timestamp}] ({user_info}) {action_text}"
-        self.activity_log.append(log_entry)
-        self.save_activity_log()
-        self.update_dashboard()
+    def on_tab_change(self):
+        # The activity log and requests file are only read once the Dashboard
+        # is actually on screen.
+        if self.tabview.get() == "Dashboard" and not self.dashboard_loaded:
+            self.dashboard_loaded = True
+            self.update_dashboard()
+        if self.tabview.get() == "Performance" and self.perf_job is None:
+            self.update_perf()
+
+    # === Performance Tab ===
+    # Only added when instrumentation is on (BOOK_PERF=1), or on demand with
+    # Ctrl+Alt+P, which also switches it on. It redraws itself once a second
+    # while it is the visible tab.
+    def init_perf_tab(self):
+        perf.enabled = True
+        if self.perf_tab is not None:
+            self.tabview.set("Performance")
+            self.on_tab_change()
+            return
+        self.perf_tab = self.tabview.add("Performance")
+        controls = ctk.CTkFrame(self.perf_tab, fg_color="transparent")
+        controls.pack(fill="x", padx=10, pady=(10, 0))
+        ctk.CTkLabel(controls, text="Profile next call of:").pack(side="left", padx=5)
+        self.profile_var = ctk.StringVar(value="LibraryGUI.refresh_books")
+        self.profile_menu = ctk.CTkOptionMenu(controls, variable=self.profile_var, width=260,
+                                              values=self.perf_operations())
+        self.profile_menu.pack(side="left", padx=5)
+        ctk.CTkButton(controls, text="Arm Profiler", width=110,
+                      command=lambda: perf.profile_next(self.profile_var.get())).pack(side="left", padx=5)
+        self.perf_box = ctk.CTkTextbox(self.perf_tab, font=ctk.CTkFont(family="Courier", size=12), wrap="none")
+        self.perf_box.pack(fill="both", expand=True, padx=10, pady=10)
+
+    @staticmethod
+    def perf_operations():
+        known = ["LibraryGUI.refresh_books", "LibraryGUI.update_dashboard", "CustomerView.show_books",
+                 "Library.load_books", "Library.save_books", "Library.sync", "LibraryService.log_activity",
+                 "login"]
+        return sorted(set(known) | {name for name, *_ in perf.summary()})
+
+    def update_perf(self):
+        self.perf_job = None
+        if self.tabview.get() != "Performance":
+            return
+        widgets = self.count_widgets(self)
+        text = (f"Widgets in this window: {widgets}   book list rows: {len(self.book_list.rows)} "
+                f"(row widgets: {len(self.book_list.row_frames)})\n\n{perf.report()}")
+        profile = perf.profiles.get(self.profile_var.get())
+        if profile:
+            text += f"\n\ncProfile of the last profiled {self.profile_var.get()}:\n{profile}"
+        self.perf_box.delete("1.0", "end")
+        self.perf_box.insert("end", text)
+        self.profile_menu.configure(values=self.perf_operations())
+        self.perf_job = self.after(PERF_REFRESH_MS, self.update_perf)
+
+    def count_widgets(self, widget):
+        return 1 + sum(self.count_widgets(child) for child in widget.winfo_children())
 
 
     def lend_book_with_quantity(self):
@@ -215,14 +557,11 @@ class LibraryGUI(ctk.CTkToplevel):
         qty = simpledialog.askinteger('Quantity', 'Enter number of copies to lend:', parent=self, minvalue=1)
         if qty is None:
             return
-        if qty > book.available():
-            messagebox.showerror('Error', f'Only {book.available()} copies available.')
-        else:
-            book.is_lent += qty
-            self.library.save_books()
-            self.log_activity(f'Lent {qty} copies of "{title}".')
-            messagebox.showinfo('Success', f'{qty} copies lent.')
-            self.refresh_books()
+        borrower = self.ask_borrower('Who is borrowing the copies? (leave blank if unknown)')
+        if borrower is None:
+            return
+        self.worker.submit(lambda: self.service.lend_book(title, qty, borrower),
+                           lambda result, error: self.finish_change(error, f'{qty} copies lent.'), write=True)
     def view_customer_requests(self):
         if not os.path.exists(REQUESTS_FILE):
             messagebox.showinfo("No Requests", "No customer requests found.")
@@ -235,67 +574,234 @@ class LibraryGUI(ctk.CTkToplevel):
         msg = "\n".join(requests)
         messagebox.showinfo("Customer Requests", msg)
 
+    def update_stats(self):
+        # The catalog and request store keep these totals up to date as
+        # changes come in, so this is constant work however big they get.
+        books = self.library.books
+        if self.library.loaded:
+            self.total_books_label.configure(text=f"Total Available Books: {books.total_available()}")
+        else:
+            self.total_books_label.configure(
+                text=f"Loading catalog... {len(books)} titles, {books.total_available()} available so far")
+        top = ", ".join(f"{title} ({n})" for title, n in self.most_requested[:3]) or "none yet"
+        self.stats_label.configure(
+            text=f"Lent: {books.lent}   Out of stock: {books.out_of_stock}   Most requested: {top}")
+
+    @perf.timed("LibraryGUI.update_dashboard")
     def update_dashboard(self):
-        total_books = sum(book.quantity - book.is_lent for book in self.library.get_books())
-        self.total_books_label.configure(text=f"Total Available Books: {total_books}")
-
-        if hasattr(self, 'log_box'):
-            self.log_box.delete("0.0", "end")
-            if self.activity_log:
-                for log in reversed(self.activity_log[-50:]):
-                    self.log_box.insert("end", log + "\n")
-            else:
-                self.log_box.insert("end", "No recent activity.")
-
-        if hasattr(self, 'request_box'):
-            self.request_box.delete("0.0", "end")
-            if os.path.exists(REQUESTS_FILE):
-                with open(REQUESTS_FILE, "r") as f:
-                    requests = f.readlines()
-                if requests:
-                    for req in reversed(requests[-50:]):
-                        self.request_box.insert("end", req.strip() + "\n")
-                else:
-                    self.request_box.insert("end", "No customer requests.")
-            else:
-                self.request_box.insert("end", "requests.txt not found.")
+        # The log and request files are read on the worker; only the newest
+        # refresh request of this window is kept if several queue up.
+        self.update_stats()
+        shown = (self.logs_shown, self.requests_shown)
+        self.worker.submit(lambda: self.read_dashboard(*shown), self.show_dashboard, key=("dashboard", id(self)))
+
+    @staticmethod
+    def unseen(entries, count, shown):
+        # The entries after the first `shown` of `count`, oldest first (all
+        # of them if the source was reset since).
+        new = count - shown if count >= shown else len(entries)
+        return list(islice(reversed(entries), new))[::-1]
+
+    def read_dashboard(self, logs_shown, requests_shown):
+        log = self.activity_log
+        logs = self.unseen(log.entries, log.count, logs_shown)
+        store = self.request_store
+        store.refresh()
+        return (log.count, logs, store.count, self.unseen(store.recent, store.count, requests_shown),
+                store.most_requested())
+
+    def show_dashboard(self, result, error):
+        if error:
+            show_error(error)
+            return
+        log_count, logs, request_count, requests, self.most_requested = result
+        if not self.log_filtered:
+            self.logs_shown = self.prepend_lines(self.log_box, self.logs_shown, log_count, logs,
+                                                 "No recent activity.")
+        self.requests_shown = self.prepend_lines(self.request_box, self.requests_shown, request_count,
+                                                 requests, "No customer requests.")
+        self.update_stats()
+
+    def filter_log(self, event=None):
+        criteria = {name: entry.get().strip() or None for name, entry in self.log_filter_entries.items()}
+        if not any(criteria.values()):
+            self.clear_log_filter()
+            return
+        self.worker.submit(lambda: self.activity_log.query(limit=LOG_QUERY_LIMIT, **criteria),
+                           self.show_log_query, key=("log query", id(self)))
+
+    def show_log_query(self, entries, error):
+        if error:
+            show_error(error)
+            return
+        self.log_filtered = True
+        self.log_box.delete("0.0", "end")
+        if not entries:
+            self.log_box.insert("end", "No matching activity.")
+            return
+        if len(entries) >= LOG_QUERY_LIMIT:
+            entries.append(f"(only the newest {LOG_QUERY_LIMIT} matches are shown)")
+        self.log_box.insert("end", "\n".join(entries))
+
+    def clear_log_filter(self):
+        for entry in self.log_filter_entries.values():
+            entry.delete(0, "end")
+        if self.log_filtered:
+            # Back to the live tail, redrawn from scratch.
+            self.log_filtered = False
+            self.logs_shown = 0
+            self.update_dashboard()
+
+    def prepend_lines(self, box, shown, count, lines, empty_text):
+        # Newest first: new lines go in at the top and whatever falls past
+        # DASHBOARD_LINES is trimmed off the bottom, so a refresh only
+        # touches the lines that changed. Returns the new `shown`.
+        if count < shown or not shown:
+            box.delete("0.0", "end")  # source was reset, or the box holds a placeholder
+            shown = max(0, count - len(lines))
+        new = min(count - shown, len(lines))
+        for line in lines[len(lines) - new:] if new > 0 else []:
+            box.insert("1.0", line + "\n")
+        if not count:
+            box.insert("end", empty_text)
+        box.delete(f"{DASHBOARD_LINES + 1}.0", "end")
+        return count
+
+    def approve_requests(self):
+        self.worker.submit(self.service.approve_fulfillable, self.finish_approve, write=True)
+
+    def finish_approve(self, approved, error):
+        if not error and not approved:
+            messagebox.showinfo("Requests", "No pending request can be filled right now.")
+            return
+        self.finish_change(error, f"Approved {approved} requests.")
+
+    def ask_borrower(self, prompt):
+        # None on Cancel; a blank answer lends or returns without a borrower.
+        borrower = simpledialog.askstring('Borrower', prompt, parent=self)
+        return None if borrower is None else borrower.strip()
+
+    def show_overdue(self):
+        self.worker.submit(self.service.overdue_loans, self.finish_overdue, key=("overdue", id(self)))
+
+    def finish_overdue(self, loans, error):
+        if error:
+            show_error(error)
+            return
+        if not loans:
+            messagebox.showinfo("Overdue Loans", "No loans are overdue.")
+            return
+        lines = [f"{title} - {borrower or 'unknown borrower'} (due {due_at})"
+                 for _, borrower, title, _, due_at in loans[:DASHBOARD_LINES]]
+        if len(loans) > DASHBOARD_LINES:
+            lines.append(f"... and {len(loans) - DASHBOARD_LINES} more")
+        messagebox.showinfo("Overdue Loans", "\n".join(lines))
+
+    def show_branch_stock(self):
+        title = self.selected_book_title
+        if not title:
+            messagebox.showerror('Error', 'Please select a book.')
+            return
+        self.worker.submit(lambda: self.library.availability(title),
+                           lambda branches, error: self.finish_branch_stock(title, branches, error))
+
+    def finish_branch_stock(self, title, branches, error):
+        if error:
+            show_error(error)
+            return
+        if not branches:
+            messagebox.showerror('Error', 'Book not found.')
+            return
+        lines = [f"{name} ({distance:.1f} km) - {book.available()} of {book.quantity} available"
+                 for name, distance, book in branches]
+        messagebox.showinfo(f"Branch Stock - {title}", "\n".join(lines))
+
+    def show_reports(self):
+        # A report reads the whole request and activity history, which can
+        # take a while, so it runs on its own thread (and process pool)
+        # instead of holding up the worker's lends; the result is still
+        # handed back through the worker.
+        self.reports_btn.configure(state="disabled")
+        worker = self.worker
+
+        def run():
+            worker.finish(self.finish_reports, *worker.call(build_report))
+        threading.Thread(target=run, name="reports", daemon=True).start()
+
+    def finish_reports(self, report, error):
+        if not self.winfo_exists():
+            return
+        self.reports_btn.configure(state="normal")
+        if error:
+            show_error(error)
+            return
+        window = ctk.CTkToplevel(self)
+        window.title("Reports")
+        window.geometry("600x500")
+        box = ctk.CTkTextbox(window, font=ctk.CTkFont(family="Courier", size=12))
+        box.pack(fill="both", expand=True, padx=10, pady=10)
+        box.insert("end", format_report(report))
+        box.configure(state="disabled")
+
+    def finish_change(self, error, message):
+        if error:
+            show_error(error)
+            return
+        self.update_dashboard()
+        messagebox.showinfo('Success', message)
+
+    def on_book_selected(self, title):
+        self.selected_book_title = title
+
+    def poll_library(self):
+        # Picks up lends and returns made by other processes (once the
+        # catalog has finished streaming in).
+        if self.library.loaded:
+            self.worker.submit(self.library.sync, key="sync")
+        self.poll_job = self.after(SYNC_INTERVAL_MS, self.poll_library)
+
+    def on_library_change(self, action, book):
+        if book is None:
+            self.refresh_books()
+            if self.dashboard_loaded:
+                self.update_stats()
+            return
+        if self.dashboard_loaded:
+            self.update_stats()
+        values = self.book_list.get_row(book.title)
+        if self.book_list.sort is not None:
+            self.refresh_books()  # the book may have moved in the sort order
+        elif values is not None:
+            self.book_list.update_row(book.title, self.book_row(values[0], book))
+        elif action == "add":
+            self.refresh_books()
 
     def highlight_selected_book(self):
-        for i, child in enumerate(self.scrollable_frame.winfo_children(), start=1):
-            if isinstance(child, ctk.CTkFrame):
-                bg = 'gray20' if child.grid_info()['row'] % 2 == 0 else 'gray15'
-                child.configure(fg_color=bg)
-                labels = [w for w in child.winfo_children() if isinstance(w, ctk.CTkLabel)]
-                if labels and labels[1].cget('text') == self.selected_book_title:
-                    child.configure(fg_color='blue')
+        self.book_list.set_selected(self.selected_book_title)
 
-    def refresh_books(self):
-        filter_text = self.search_var.get().lower() if hasattr(self, 'search_var') else ''
-        for widget in self.scrollable_frame.winfo_children():
-            widget.destroy()
+    def search_mode(self):
+        return "fuzzy" if hasattr(self, 'fuzzy_var') and self.fuzzy_var.get() else "substring"
 
-        for col in range(4):
-            self.scrollable_frame.grid_columnconfigure(col, weight=1)
+    def schedule_search(self):
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+        self.search_job = self.after(SEARCH_DEBOUNCE_MS, self.refresh_books)
 
-        for i, book in enumerate(self.library.get_books(), start=1):
-            if filter_text and filter_text not in book.title.lower():
-                continue
-            available = book.quantity - book.is_lent
-            row_frame = ctk.CTkFrame(self.scrollable_frame, fg_color='gray15', corner_radius=5)
-            row_frame.grid(row=i, column=0, columnspan=4, sticky='nsew', padx=2, pady=1)
-
-            ctk.CTkLabel(row_frame, text=str(i), width=30).grid(row=0, column=0, sticky='w')
-            ctk.CTkLabel(row_frame, text=book.title, width=200).grid(row=0, column=1, sticky='w')
-            ctk.CTkLabel(row_frame, text=str(available), width=60).grid(row=0, column=2, sticky='w')
-            ctk.CTkLabel(row_frame, text=str(book.quantity), width=60).grid(row=0, column=3, sticky='w')
-
-            def on_select(event, title=book.title):
-                self.selected_book_title = title
-                self.highlight_selected_book()
-            row_frame.bind('<Button-1>', on_select)
-            for child in row_frame.winfo_children():
-                child.bind('<Button-1>', on_select)
+    @staticmethod
+    def book_row(number, book):
+        return (number, book.title, book.quantity - book.is_lent, book.quantity, book.is_lent)
 
+    @perf.timed("LibraryGUI.refresh_books")
+    def refresh_books(self):
+        self.search_job = None
+        filter_text = self.search_var.get() if hasattr(self, 'search_var') else ''
+        if self.book_list.sort is None:
+            rows = (self.book_row(i, book) for i, book in self.library.iter_search_books(filter_text, self.search_mode()))
+            self.book_list.stream_rows(rows)
+        else:
+            sort, descending, mode = self.book_list.sort, self.book_list.descending, self.search_mode()
+            self.book_list.load_rows(self.worker, lambda: sorted_book_rows(self.library, sort, descending,
+                                                                           filter_text, mode, self.book_row))
         self.highlight_selected_book()
     def get_selected_book_title(self):
         return simpledialog.askstring("Book", "Enter exact book title:")
@@ -303,14 +809,22 @@ class LibraryGUI(ctk.CTkToplevel):
     def add_book(self):
         title = simpledialog.askstring("Add Book", "Enter book title:")
         if title:
+            try:
+                title = clean_title(title)
+            except LendingError as error:
+                messagebox.showerror("Error", str(error))
+                return
             try:
                 quantity = int(simpledialog.askstring("Quantity", "Enter quantity:"))
-                if self.library.add_book(title.strip(), quantity):
-                    self.log_activity(f"Added {quantity} copies of '{title}'.")
-                    messagebox.showinfo("Success", f"{quantity} copies added.")
-            except:
+            except (TypeError, ValueError):
                 messagebox.showerror("Error", "Quantity must be a number.")
-        self.refresh_books()
+                return
+            if quantity < 1:
+                messagebox.showerror("Error", "Quantity must be at least 1.")
+                return
+            self.worker.submit(lambda: self.service.add_book(title, quantity),
+                               lambda result, error: self.finish_change(error, f"{quantity} copies added."),
+                               write=True)
 
     def lend_book(self):
         title = self.selected_book_title
@@ -324,15 +838,12 @@ class LibraryGUI(ctk.CTkToplevel):
         qty = simpledialog.askinteger('Quantity', f'Enter number of copies to lend for "{title}":', parent=self, minvalue=1)
         if qty is None:
             return
-        available = book.quantity - book.is_lent
-        if qty > available:
-            messagebox.showerror('Error', f'Only {available} copies available.')
+        borrower = self.ask_borrower('Who is borrowing the copies? (leave blank if unknown)')
+        if borrower is None:
             return
-        book.is_lent += qty
-        self.library.save_books()
-        self.log_activity(f'Lent {qty} copies of "{title}".')
-        messagebox.showinfo('Success', f'{qty} copies lent.')
-        self.refresh_books()
+        # The service re-checks against changes made by other sessions.
+        self.worker.submit(lambda: self.service.lend_book(title, qty, borrower),
+                           lambda result, error: self.finish_change(error, f'{qty} copies lent.'), write=True)
     def return_book(self):
         title = self.selected_book_title
         if not title:
@@ -345,121 +856,23 @@ class LibraryGUI(ctk.CTkToplevel):
         qty = simpledialog.askinteger('Quantity', f'Enter number of copies to return for "{title}":', parent=self, minvalue=1)
         if qty is None:
             return
-        if qty > book.is_lent:
-            messagebox.showerror('Error', f'Only {book.is_lent} copies can be returned.')
+        borrower = self.ask_borrower('Who is returning the copies? (leave blank to close the oldest loans)')
+        if borrower is None:
             return
-        book.is_lent -= qty
-        self.library.save_books()
-        self.log_activity(f'Returned {qty} copies of "{title}".')
-        messagebox.showinfo('Success', f'{qty} copies returned.')
-        self.refresh_books()
-    def refresh_return_books(self):
-        filter_text = self.return_search_var.get().lower() if hasattr(self, 'return_search_var') else ''
-        for widget in self.return_scrollable_frame.winfo_children():
-            widget.destroy()
-
-        for col in range(4):
-            self.return_scrollable_frame.grid_columnconfigure(col, weight=1)
-
-        for i, book in enumerate(self.library.get_books(), start=1):
-            available = book.is_lent
-            if available <= 0:
-                continue
-            if filter_text and filter_text not in book.title.lower():
-                continue
-            row_frame = ctk.CTkFrame(self.return_scrollable_frame, fg_color='gray15', corner_radius=5)
-            row_frame.grid(row=i, column=0, columnspan=4, sticky='nsew', padx=2, pady=1)
-
-            ctk.CTkLabel(row_frame, text=str(i), width=30).grid(row=0, column=0, sticky='w')
-            ctk.CTkLabel(row_frame, text=book.title, width=200).grid(row=0, column=1, sticky='w')
-            ctk.CTkLabel(row_frame, text=str(available), width=60).grid(row=0, column=2, sticky='w')
-            ctk.CTkLabel(row_frame, text=str(book.quantity), width=60).grid(row=0, column=3, sticky='w')
-
-            def on_select(event, title=book.title):
-                self.selected_return_book_title = title
-                self.highlight_selected_return_book()
-            row_frame.bind('<Button-1>', on_select)
-            for child in row_frame.winfo_children():
-                child.bind('<Button-1>', on_select)
+        self.worker.submit(lambda: self.service.return_book(title, qty, borrower),
+                           lambda result, error: self.finish_change(error, f'{qty} copies returned.'), write=True)
+    def on_return_book_selected(self, title):
+        self.selected_return_book_title = title
 
+    def refresh_return_books(self):
+        filter_text = self.return_search_var.get() if hasattr(self, 'return_search_var') else ''
+        rows = [(i, book.title, book.is_lent, book.quantity)
+                for i, book in self.library.search_books(filter_text, self.search_mode()) if book.is_lent > 0]
+        self.return_book_list.set_rows(rows)
         self.highlight_selected_return_book()
 
     def highlight_selected_return_book(self):
-        for i, child in enumerate(self.return_scrollable_frame.winfo_children(), start=1):
-            if isinstance(child, ctk.CTkFrame):
-                bg = 'gray20' if child.grid_info()['row'] % 2 == 0 else 'gray15'
-                child.configure(fg_color=bg)
-                labels = [w for w in child.winfo_children() if isinstance(w, ctk.CTkLabel)]
-                if labels and labels[1].cget('text') == self.selected_return_book_title:
-                    child.configure(fg_color='blue')
-class Book:
-    def __init__(self, title, quantity=1, is_lent=0):
-        self.title = title
-        self.quantity = int(quantity)
-        self.is_lent = int(is_lent)
-
-    def __str__(self):
-        return f"{self.title}|{self.quantity}|{self.is_lent}"
-
-    def available(self):
-        return self.quantity - self.is_lent
-
-    @staticmethod
-    def from_string(data_str):
-        parts = data_str.strip().split("|")
-        if len(parts) == 3:
-            return Book(parts[0], parts[1], parts[2])
-        return None
-
-# === Library Class ===
-class Library:
-    def __init__(self):
-        self.books = {}
-        self.load_books()
-
-    def load_books(self):
-        if not os.path.exists(BOOK_DB):
-            return
-        with open(BOOK_DB, "r") as f:
-            for line in f:
-                book = Book.from_string(line)
-                if book:
-                    self.books[book.title] = book
-
-    def save_books(self):
-        with open(BOOK_DB, "w") as f:
-            for book in self.books.values():
-                f.write(str(book) + "\n")
-
-    def add_book(self, title, quantity=1):
-        if title in self.books:
-            self.books[title].quantity += quantity
-        else:
-            self.books[title] = Book(title, quantity)
-        self.save_books()
-        return True
-
-    def lend_book(self, title):
-        if title in self.books:
-            book = self.books[title]
-            if book.is_lent < book.quantity:
-                book.is_lent += 1
-                self.save_books()
-                return True
-        return False
-
-    def return_book(self, title):
-        if title in self.books:
-            book = self.books[title]
-            if book.is_lent > 0:
-                book.is_lent -= 1
-                self.save_books()
-                return True
-        return False
-
-    def get_books(self):
-        return self.books.values()
-
+        self.return_book_list.set_selected(self.selected_return_book_title)
 # === Customer View ===
 class CustomerView(ctk.CTkToplevel):
     def __init__(self, master=None, username=None):
@@ -469,20 +882,49 @@ class CustomerView(ctk.CTkToplevel):
         self.geometry("700x500")
         self.username = username
 
-        self.books = []
-        self.load_books()
+        self.library = None
+        self.worker = master.worker
+        self.client = master.client
+        self.search_job = None
+        self.poll_job = None
+        self.search_generation = 0
+        self.next_page = None  # server mode: (query, mode, offset, after, generation) of the page to fetch next
+        if self.client is None:
+            self.load_books()
+            self.service = LibraryService(self.library, username)
+            self.request_store = self.library.storage.requests
 
         self.build_ui()
         self.show_books()
+        if self.client is None:
+            self.worker.subscribe(self.on_library_change)
+            self.poll_job = self.after(SYNC_INTERVAL_MS, self.poll_library)
 
     def load_books(self):
-        self.books = []
-        if os.path.exists(BOOK_DB):
-            with open(BOOK_DB, "r") as f:
-                for line in f:
-                    book = Book.from_string(line)
-                    if book:
-                        self.books.append(book)
+        self.library = shared_library(lazy=True)
+
+    def destroy(self):
+        if self.poll_job is not None:
+            self.after_cancel(self.poll_job)
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+        self.search_generation += 1  # drop pages still on their way
+        if self.client is None:
+            self.worker.unsubscribe(self.on_library_change)
+        super().destroy()
+
+    def poll_library(self):
+        if self.library.loaded:
+            self.worker.submit(self.library.sync, key="sync")
+        self.poll_job = self.after(SYNC_INTERVAL_MS, self.poll_library)
+
+    def on_library_change(self, action, book):
+        if book is None or self.book_list.sort is not None:
+            self.show_books()
+        elif self.book_list.get_row(book.title) is not None:
+            self.book_list.update_row(book.title, (book.title, book.available(), book.quantity))
+        elif action == "add":
+            self.show_books()
 
     def build_ui(self):
         self.label = ctk.CTkLabel(self, text=f"Welcome, {self.username}!", font=ctk.CTkFont(size=16, weight="bold"))
@@ -502,94 +944,135 @@ class CustomerView(ctk.CTkToplevel):
             font=ctk.CTkFont(size=13)
         )
         self.search_entry.pack(side="left", fill="x", expand=True)
-        self.search_entry.bind("<KeyRelease>", lambda event: self.show_books())
+        self.search_entry.bind("<KeyRelease>", lambda event: self.schedule_search())
+        self.fuzzy_var = ctk.BooleanVar(value=False)
+        ctk.CTkCheckBox(search_row, text="Fuzzy", variable=self.fuzzy_var, width=60,
+                        command=self.show_books).pack(side="left", padx=5)
 
         # === Scrollable Book List ===
-        container = ctk.CTkFrame(self)
-        container.pack(fill="both", expand=True, padx=10, pady=10)
-
-        self.canvas = ctk.CTkCanvas(container, bg="black", highlightthickness=0)
-        self.scrollable_frame = ctk.CTkFrame(self.canvas)
-
-        self.scrollbar = ctk.CTkScrollbar(container, orientation="vertical", command=self.canvas.yview)
-        self.scrollbar.pack(side="right", fill="y")
-        self.canvas.configure(yscrollcommand=self.scrollbar.set)
-
-        self.scrollable_window = self.canvas.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
-
-        self.scrollable_frame.bind("<Configure>", lambda e: self.canvas.configure(scrollregion=self.canvas.bbox("all")))
-        self.canvas.bind("<Configure>", lambda e: self.canvas.itemconfig(self.scrollable_window, width=e.width))
-
-        self.canvas.pack(side="left", fill="both", expand=True)
+        self.book_list = BookListView(self, columns=[("Title", 300), ("Available", 80), ("Total", 80)],
+                                      sort_keys=["title", "available", "total"], on_sort=self.show_books,
+                                      on_more=self.fetch_more)
+        self.book_list.pack(fill="both", expand=True, padx=10, pady=10)
 
         self.request_button = ctk.CTkButton(self, text="Request a Book", command=self.request_book)
         self.request_button.pack(pady=5)
 
         self.history_button = ctk.CTkButton(self, text="View My Requests", command=self.view_requests)
         self.history_button.pack(pady=5)
+
+        self.loans_button = ctk.CTkButton(self, text="My Loans", command=self.view_loans)
+        self.loans_button.pack(pady=5)
         create_logout_button(self, self.master).pack(pady=10)
 
+    def schedule_search(self):
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+        self.search_job = self.after(SEARCH_DEBOUNCE_MS, self.show_books)
+
+    @perf.timed("CustomerView.show_books")
     def show_books(self):
-        for widget in self.scrollable_frame.winfo_children():
-            widget.destroy()
-
-        query = self.search_entry.get().lower()
-        filtered = [b for b in self.books if query in b.title.lower()]
-
-        headers = ["Title", "Available", "Total"]
-        for i, text in enumerate(headers):
-            ctk.CTkLabel(self.scrollable_frame, text=text, font=ctk.CTkFont(weight="bold"),
-                         fg_color="gray30", corner_radius=5).grid(row=0, column=i, padx=5, pady=5, sticky="nsew")
-            self.scrollable_frame.grid_columnconfigure(i, weight=1)
-
-        for idx, book in enumerate(filtered, start=1):
-            ctk.CTkLabel(self.scrollable_frame, text=book.title).grid(row=idx, column=0, padx=5, pady=2, sticky="nsew")
-            ctk.CTkLabel(self.scrollable_frame, text=str(book.available())).grid(row=idx, column=1, padx=5, pady=2,
-                                                                                 sticky="nsew")
-            ctk.CTkLabel(self.scrollable_frame, text=str(book.quantity)).grid(row=idx, column=2, padx=5, pady=2,
-                                                                              sticky="nsew")
+        self.search_job = None
+        mode = "fuzzy" if self.fuzzy_var.get() else "substring"
+        if self.client is not None:
+            self.search_generation += 1
+            self.fetch_page(self.search_entry.get(), mode, 0, None, self.search_generation)
+            return
+        if self.book_list.sort is not None:
+            sort, descending, query = self.book_list.sort, self.book_list.descending, self.search_entry.get()
+            self.book_list.load_rows(self.worker, lambda: sorted_book_rows(
+                self.library, sort, descending, query, mode, lambda _, b: (b.title, b.available(), b.quantity)))
+            return
+        matches = self.library.iter_search_books(self.search_entry.get(), mode)
+        self.book_list.stream_rows((b.title, b.available(), b.quantity) for _, b in matches)
+
+    def fetch_page(self, query, mode, offset, after, generation):
+        # Server mode: each page is fetched on the worker thread and appended
+        # when it arrives; the next one is only fetched once the list scrolls
+        # near its end (fetch_more). `after` is the catalog number of the last
+        # row so far, which lets the server resume an unsorted search there.
+        self.next_page = None
+        sort, descending = self.book_list.sort, self.book_list.descending
+        self.worker.submit(lambda: self.client.search_books(query, mode, offset, SERVER_PAGE_SIZE, sort, descending,
+                                                            after),
+                           lambda page, error: self.show_page(query, mode, offset, generation, page, error))
+
+    def fetch_more(self):
+        if self.next_page is not None and self.next_page[-1] == self.search_generation:
+            self.fetch_page(*self.next_page)
+
+    def show_page(self, query, mode, offset, generation, page, error):
+        if generation != self.search_generation:
+            return  # a newer search has started
+        if error:
+            show_error(error)
+            return
+        rows, more = page
+        if more:
+            self.next_page = (query, mode, offset + len(rows), rows[-1][0], generation)
+        rows = [(title, available, quantity) for _, title, available, quantity in rows]
+        if offset == 0:
+            self.book_list.set_rows(rows)
+        else:
+            self.book_list.append_rows(rows)
+            self.book_list.scroll_to(self.book_list.offset)  # still near the end: ask for the next one
+
     def request_book(self):
         title = simpledialog.askstring("Request Book", "Enter the exact title of the book:")
         if not title:
             return
 
-        book = next((b for b in self.books if b.title.lower() == title.strip().lower()), None)
-        if not book:
-            messagebox.showerror("Error", "Book not found.")
-            return
+        if self.client is not None:
+            self.worker.submit(lambda: self.client.request_book(title), self.finish_request)
+        else:
+            self.worker.submit(lambda: self.service.request_book(title).title, self.finish_request)
 
-        if book.available() <= 0:
-            messagebox.showwarning("Unavailable", "This book is currently not available.")
+    def finish_request(self, title, error):
+        if error:
+            show_error(error)
             return
-
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with open(REQUESTS_FILE, "a") as f:
-            f.write(f"{self.username}|{book.title}|{timestamp}\n")
-
-        messagebox.showinfo("Requested", f"You have requested '{book.title}'. Please wait for manager approval.")
+        messagebox.showinfo("Requested", f"You have requested '{title}'. Please wait for manager approval.")
 
     def view_requests(self):
-        if not os.path.exists(REQUESTS_FILE):
-            messagebox.showinfo("No Requests", "You haven't made any requests yet.")
-            return
+        self.worker.submit(self.read_requests, self.show_requests, key=("requests", id(self)))
 
-        requests = []
-        with open(REQUESTS_FILE, "r") as f:
-            for line in f:
-                user, title, time = line.strip().split("|")
-                if user == self.username:
-                    requests.append((title, time))
+    def read_requests(self):
+        if self.client is not None:
+            return [tuple(request) for request in self.client.user_requests()]
+        return [(title, time, state) for _, title, time, state in self.request_store.user_requests(self.username)]
 
+    def show_requests(self, requests, error):
+        if error:
+            show_error(error)
+            return
         if not requests:
             messagebox.showinfo("No Requests", "You haven't made any requests yet.")
             return
 
-        msg = "\n".join([f"{title} ({time})" for title, time in requests])
+        msg = "\n".join([f"{title} ({time}) - {state}" for title, time, state in requests])
         messagebox.showinfo("My Requests", msg)
 
+    def view_loans(self):
+        if self.client is not None:
+            work = self.client.loans
+        else:
+            work = lambda: self.service.borrower_loans(self.username)
+        self.worker.submit(work, self.show_loans, key=("loans", id(self)))
+
+    def show_loans(self, loans, error):
+        if error:
+            show_error(error)
+            return
+        if not loans:
+            messagebox.showinfo("My Loans", "You have no books on loan.")
+            return
+        msg = "\n".join(f"{title} - due {due_at}" for _, _, title, _, due_at in loans)
+        messagebox.showinfo("My Loans", msg)
+
 # === Login App ===
 class LoginApp(ctk.CTk):
     def __init__(self):
+        apply_theme()
         super().__init__()
 
         self.title("Eldridge's Book Lending System")
@@ -613,6 +1096,41 @@ class LoginApp(ctk.CTk):
         self.signup_username_entry.bind("<Return>", self.signup)
         self.signup_password_entry.bind("<Return>", self.signup)
 
+        # Every window hands its disk work to this one worker thread.
+        self.worker = PersistenceWorker(shared_library(lazy=True), on_error=show_error)
+        self.after(WORKER_POLL_MS, self.pump_worker)
+        self.client = LendingClient(SERVER_URL) if SERVER_URL else None
+
+        # The catalog streams in while the user is still typing credentials.
+        # Against a server only the manager window needs it, so it waits for
+        # a manager to log in.
+        self.streamed_rows = 0
+        self.catalog_streaming = self.client is None
+        if self.catalog_streaming:
+            self.after(LOAD_STEP_MS, self.stream_catalog)
+
+    def pump_worker(self):
+        self.worker.deliver()
+        self.after(WORKER_POLL_MS, self.pump_worker)
+
+    def stream_catalog(self):
+        # One chunk per worker job, read off the Tk thread.
+        self.worker.submit(self.worker.library.load_next_chunk, self.catalog_chunk_loaded)
+
+    def catalog_chunk_loaded(self, more, error):
+        # Open views are told to redraw after the first chunk and then
+        # whenever the catalog has doubled, so the repeated redraws add up to
+        # about one full redraw in total.
+        if error:
+            show_error(error)
+            return
+        library = self.worker.library
+        if not more or len(library.books) >= 2 * self.streamed_rows:
+            self.streamed_rows = len(library.books)
+            library.notify("reload", None)
+        if more:
+            self.after(LOAD_STEP_MS, self.stream_catalog)
+
     def init_login_tab(self):
         self.title_label = ctk.CTkLabel(self.login_tab, text="Log In to Your Account", font=ctk.CTkFont(size=18, weight="bold"))
         self.title_label.pack(pady=(20, 10))
@@ -639,40 +1157,87 @@ class LoginApp(ctk.CTk):
         self.signup_btn = ctk.CTkButton(self.signup_tab, text="Sign Up", command=self.signup)
         self.signup_btn.pack(pady=15)
 
+    def run_in_background(self, work, done):
+        # Password hashing is deliberately slow and account lookups touch
+        # disk, so both run on the worker thread.
+        def finished(result, error):
+            if error:
+                show_error(error)
+                done(None)
+            else:
+                done(result)
+        self.worker.submit(work, finished)
+
     def login(self, event=None):
         username = self.username_entry.get().strip()
         password = self.password_entry.get().strip()
-        managers = load_users(MANAGER_DB)
-        users = load_users(USER_DB)
-
         if not username or not password:
             messagebox.showerror("Error", "Please enter all fields.")
-        elif username in managers and managers[username] == password:
+            return
+        if self.login_btn.cget("state") == "disabled":
+            return
+        def check():
+            if self.client is not None:
+                return self.client.login(username, password)
+            storage = default_storage()
+            for role in ("manager", "customer"):
+                stored = storage.find_user(role, username)
+                if stored is not None and verify_password(password, stored):
+                    if needs_rehash(stored):
+                        storage.save_user(username, hash_password(password), role)
+                    return role
+            verify_password(password, DUMMY_PASSWORD_HASH)
+            return None
+
+        self.login_btn.configure(state="disabled")
+        self.run_in_background(perf.timed("login")(check), lambda result: self.finish_login(username, result))
+
+    def finish_login(self, username, role):
+        self.login_btn.configure(state="normal")
+        if not role:
+            messagebox.showerror("Error", "Invalid credentials.")
+            return
+        if role == "manager":
             messagebox.showinfo("Success", f"Welcome Manager, {username}!")
             self.withdraw()
+            if not self.catalog_streaming:
+                self.catalog_streaming = True
+                self.after(LOAD_STEP_MS, self.stream_catalog)
             LibraryGUI(self, username=username)
-        elif username in users and users[username] == password:
+        else:
             messagebox.showinfo("Success", f"Welcome, {username}!")
             self.withdraw()
             CustomerView(self, username=username)
-        else:
-            messagebox.showerror("Error", "Invalid credentials.")
 
     def signup(self, event=None):
         username = self.signup_username_entry.get().strip()
         password = self.signup_password_entry.get().strip()
-        users = load_users(USER_DB)
 
         if not username or not password:
             messagebox.showerror("Error", "Please enter all fields.")
-        elif username in users:
-            messagebox.showwarning("Warning", "Username already exists.")
         elif len(password) < 6:
             messagebox.showwarning("Weak Password", "Password must be at least 6 characters long.")
         elif username.lower() == password.lower():
             messagebox.showwarning("Weak Password", "Password cannot be the same as the username.")
-        else:
-            save_user(username, password)
+        elif self.signup_btn.cget("state") != "disabled":
+            self.signup_btn.configure(state="disabled")
+
+            def create():
+                if self.client is not None:
+                    self.client.signup(username, password)  # LendingError if the name is taken
+                    return "created"
+                storage = default_storage()
+                if storage.find_user("customer", username) is not None:
+                    return "exists"
+                storage.save_user(username, hash_password(password))
+                return "created"
+            self.run_in_background(create, self.finish_signup)
+
+    def finish_signup(self, outcome):
+        self.signup_btn.configure(state="normal")
+        if outcome == "exists":
+            messagebox.showwarning("Warning", "Username already exists.")
+        elif outcome == "created":
             messagebox.showinfo("Success", "Account created!")
 
 # === Run ===
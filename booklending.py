@@ -0,0 +1,3249 @@
+"""Book lending core: catalog, storage backends, accounts and requests.
+
+Nothing in here imports Tk, so it can be used from scripts and batch jobs.
+The GUI lives in "Book Lending_Rosel_FINAL.py"; the command line is
+
+    python -m booklending import books.csv
+    python -m booklending apply events.csv
+    python -m booklending lend "Moby Dick" --quantity 2 --borrower alice
+    python -m booklending return "Moby Dick"
+    python -m booklending report
+    python -m booklending approve-requests
+    python -m booklending mark-request 12 fulfilled
+    python -m booklending overdue
+    python -m booklending availability "Moby Dick"    (per branch, with a branches.txt)
+    python -m booklending log --user alice --text "Moby Dick" --since 2025-05 --until 2025-06-15
+    python -m booklending migrate-sqlite
+    python -m booklending --perf report    (timings of the hot paths on stderr)
+"""
+from datetime import datetime, timedelta
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
+from difflib import SequenceMatcher
+from functools import wraps
+from heapq import heapify, heappop, heappush, merge, nlargest
+from itertools import accumulate, groupby, islice
+from operator import ge, sub
+import argparse
+import cProfile
+import csv
+import gzip
+import hashlib
+import hmac
+import io
+import math
+import mmap
+import os
+import pstats
+import queue
+import re
+import shutil
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from zlib import crc32
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# === CONFIG ===
+USER_DB = "users.txt"
+MANAGER_DB = "managers.txt"
+BOOK_DB = "library.txt"
+BOOK_JOURNAL = "library_journal.txt"
+SNAPSHOT_HEADER = "#journal|"
+JOURNAL_COMPACT_EVERY = 500
+LOCK_FILE = "library.lock"
+PASSWORD_ITERATIONS = 200_000
+ACTIVITY_LOG_FILE = "activity_log.txt"
+REQUESTS_FILE = "requests.txt"
+REQUEST_STATUS_FILE = "request_status.txt"
+LOANS_FILE = "loans.txt"
+LOAN_DAYS = 14
+ACTIVITY_LOG_MAX_BYTES = 1024 * 1024
+ACTIVITY_LOG_BACKUPS = 5
+ACTIVITY_LOG_ROTATE_DAILY = False
+ACTIVITY_LOG_COMPRESS = True
+ACTIVITY_INDEX_SAVE_EVERY = 1000  # newly indexed log lines before the index file is rewritten
+ACTIVITY_STOPWORDS = frozenset(["a", "an", "as", "copies", "for", "of", "the", "to"])
+STORAGE_BACKEND = os.environ.get("BOOK_STORAGE", "text")
+SQLITE_DB = "library.db"
+CHANGE_LOG_KEEP = 10000
+CHANGE_LOG_PRUNE_EVERY = 500
+CATALOG_SNAPSHOT = os.environ.get("BOOK_SNAPSHOT", "1") != "0"
+CATALOG_SNAPSHOT_FILE = "library.snap"
+# With BRANCHES_FILE present ("name|x|y" per line, x/y a branch's position
+# in km) the catalog is split into one shard per branch, kept under
+# BRANCH_DIR/<name>/. BOOK_BRANCH names the branch this process works at
+# (default: the first listed); lends go to the nearest branch with stock.
+BRANCHES_FILE = "branches.txt"
+BRANCH_DIR = "branches"
+HOME_BRANCH = os.environ.get("BOOK_BRANCH")
+BRANCH_LOAD_WORKERS = 8
+BRANCH_ROW_MAP_FILE = "library.rowmap"  # with a library.snap of the merged catalog, in BRANCH_DIR
+PERF_ENABLED = os.environ.get("BOOK_PERF", "") not in ("", "0")
+PERF_SAMPLES = 1000  # durations kept per operation for the percentiles
+PERF_RECENT = 200  # calls kept for the "slowest recent" list
+
+# === Instrumentation ===
+# Timing and counter hooks on the hot paths, off unless BOOK_PERF=1 is set
+# (or --perf given on the command line, or switched on from the GUI). While
+# off, a timed call costs one attribute check and count() returns at once.
+# profile_next(name) runs the next call of that operation under cProfile and
+# keeps the report in profiles[name].
+class PerfMonitor:
+    def __init__(self, enabled=PERF_ENABLED):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.samples = defaultdict(lambda: deque(maxlen=PERF_SAMPLES))
+        self.calls = Counter()
+        self.counters = Counter()
+        self.recent = deque(maxlen=PERF_RECENT)
+        self.profile_requests = set()
+        self.profiles = {}
+        self.profiling = False
+
+    def timed(self, name):
+        def decorate(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                return self.call(name, fn, args, kwargs)
+            return wrapper
+        return decorate
+
+    def call(self, name, fn, args, kwargs):
+        # Only one profiler can run at a time; a call that finds another
+        # thread profiling leaves the request armed for the next one.
+        with self.lock:
+            profile = name in self.profile_requests and not self.profiling
+            if profile:
+                self.profile_requests.discard(name)
+                self.profiling = True
+        profiler = cProfile.Profile() if profile else None
+        started = time.perf_counter()
+        try:
+            if profiler is not None:
+                return profiler.runcall(fn, *args, **kwargs)
+            return fn(*args, **kwargs)
+        finally:
+            self.record(name, time.perf_counter() - started)
+            if profiler is not None:
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(30)
+                self.profiles[name] = out.getvalue()
+                self.profiling = False
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.samples[name].append(seconds)
+            self.calls[name] += 1
+            self.recent.append((seconds, name, datetime.now().strftime("%H:%M:%S")))
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += amount
+
+    def profile_next(self, name):
+        self.enabled = True
+        with self.lock:
+            self.profile_requests.add(name)
+
+    def summary(self):
+        # [(operation, calls, p50 ms, p95 ms, max ms)], slowest p95 first.
+        with self.lock:
+            samples = {name: sorted(values) for name, values in self.samples.items()}
+            calls = dict(self.calls)
+        rows = []
+        for name, values in samples.items():
+            p50 = values[(len(values) - 1) // 2]
+            p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+            rows.append((name, calls[name], p50 * 1000, p95 * 1000, values[-1] * 1000))
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+
+    def slowest(self, count=10):
+        with self.lock:
+            return nlargest(count, self.recent)
+
+    def report(self):
+        lines = [f"{'operation':<32} {'calls':>7} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}"]
+        for name, calls, p50, p95, worst in self.summary():
+            lines.append(f"{name:<32} {calls:>7} {p50:>9.2f} {p95:>9.2f} {worst:>9.2f}")
+        with self.lock:
+            counters = sorted(self.counters.items())
+        if counters:
+            lines.append("")
+            lines += [f"{name:<32} {value:>12,}" for name, value in counters]
+        slowest = self.slowest()
+        if slowest:
+            lines.append("")
+            lines.append("Slowest recent calls:")
+            lines += [f"  {when}  {seconds * 1000:>9.2f} ms  {name}" for seconds, name, when in slowest]
+        return "\n".join(lines)
+
+
+perf = PerfMonitor()
+
+# === USER ACCOUNT FUNCTIONS ===
+def load_users(filename):
+    if not os.path.exists(filename):
+        return {}
+    users = {}
+    with open(filename, "r") as file:
+        for line in file:
+            line = line.strip()
+            if "," in line:
+                username, password = line.split(",", 1)
+                users[username] = password
+    return users
+
+def save_user(username, password):
+    with open(USER_DB, "a") as file:
+        file.write(f"{username},{password}\n")
+
+# Passwords are stored as "pbkdf2_sha256$iterations$salt$hash". Older
+# plaintext entries still verify and are re-saved hashed on the next login;
+# a later line for the same username overrides an earlier one.
+PASSWORD_SCHEME = "pbkdf2_sha256"
+# Verified when the username is unknown, so a miss costs the same as a hit.
+DUMMY_PASSWORD_HASH = f"{PASSWORD_SCHEME}${PASSWORD_ITERATIONS}${'0' * 32}${'0' * 64}"
+
+def hash_password(password, salt=None):
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, PASSWORD_ITERATIONS)
+    return f"{PASSWORD_SCHEME}${PASSWORD_ITERATIONS}${salt.hex()}${digest.hex()}"
+
+def verify_password(password, stored):
+    if not stored.startswith(PASSWORD_SCHEME + "$"):
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+    _, iterations, salt, digest = stored.split("$")
+    check = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(check.hex(), digest)
+
+def needs_rehash(stored):
+    return not stored.startswith(f"{PASSWORD_SCHEME}${PASSWORD_ITERATIONS}$")
+
+# Keeps a users file parsed in memory. A lookup only stats the file; if it
+# grew in place only the appended lines are parsed, and any other change
+# reloads it.
+class CredentialCache:
+    def __init__(self, filename):
+        self.filename = filename
+        self.users = {}
+        self.inode = None
+        self.size = 0
+        self.mtime = None
+
+    def get_users(self):
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            self.users, self.inode, self.size, self.mtime = {}, None, 0, None
+            return self.users
+        if stat.st_ino == self.inode and stat.st_size == self.size and stat.st_mtime_ns == self.mtime:
+            return self.users
+        if stat.st_ino != self.inode or stat.st_size < self.size:
+            self.users = {}
+            self.size = 0
+        with open(self.filename, "rb") as file:
+            file.seek(self.size)
+            for raw in file:
+                if not raw.endswith(b"\n"):
+                    break
+                self.size += len(raw)
+                perf.count("bytes read: accounts", len(raw))
+                line = raw.decode("utf-8", errors="replace").strip()
+                if "," in line:
+                    username, password = line.split(",", 1)
+                    self.users[username] = password
+        self.inode = stat.st_ino
+        self.mtime = stat.st_mtime_ns
+        return self.users
+
+# === Book Class ===
+# A Book is a two-slot view onto one row of a Catalog; the data itself lives
+# in the catalog's columns, so views are cheap to create and throw away.
+class Book:
+    __slots__ = ("catalog", "row")
+
+    def __init__(self, catalog, row):
+        self.catalog = catalog
+        self.row = row
+
+    @property
+    def title(self):
+        return self.catalog.titles[self.row]
+
+    @property
+    def quantity(self):
+        return self.catalog.quantity[self.row]
+
+    @quantity.setter
+    def quantity(self, value):
+        self.catalog.update(self.row, value, self.is_lent)
+
+    @property
+    def is_lent(self):
+        return self.catalog.is_lent[self.row]
+
+    @is_lent.setter
+    def is_lent(self, value):
+        self.catalog.update(self.row, self.quantity, value)
+
+    def __str__(self):
+        return f"{self.title}|{self.quantity}|{self.is_lent}"
+
+    def available(self):
+        return self.quantity - self.is_lent
+
+    @staticmethod
+    def parse(data_str):
+        parts = data_str.strip().split("|")
+        if len(parts) == 3:
+            return parts[0], int(parts[1]), int(parts[2])
+        return None
+
+# === Catalog ===
+# Column store behind Library.books: interned titles plus int32 quantity and
+# is_lent columns, addressed by a title -> row dict. It answers the dict
+# calls the rest of the file makes (get, [], in, values) with Book views.
+# Every write goes through add() or update(), which keep running totals of
+# copies, lent copies and titles with nothing left on the shelf, so the
+# dashboard and reports never have to sum the columns. They also keep any
+# sort index a view has asked for (see SortedColumn) in order.
+SORT_COLUMNS = ("title", "available", "total", "lent")
+
+
+class Catalog:
+    def __init__(self):
+        self.titles = []
+        self.quantity = array('i')
+        self.is_lent = array('i')
+        self.rows = {}
+        self.copies = 0
+        self.lent = 0
+        self.out_of_stock = 0
+        # column -> SortedColumn, built the first time something sorts by it;
+        # build and change them on the same thread (the GUI's persistence
+        # worker), as add() and update() walk this dict.
+        self.sorted = {}
+
+    def add(self, title, quantity=1, is_lent=0):
+        title = sys.intern(title)
+        row = len(self.titles)
+        self.titles.append(title)
+        self.quantity.append(quantity)
+        self.is_lent.append(is_lent)
+        self.rows[title] = row
+        self.copies += quantity
+        self.lent += is_lent
+        self.out_of_stock += is_lent >= quantity
+        for column, index in self.sorted.items():
+            index.add(self.sort_entry(column, row, quantity, is_lent))
+        return Book(self, row)
+
+    def update(self, row, quantity, is_lent):
+        old_quantity, old_lent = self.quantity[row], self.is_lent[row]
+        self.quantity[row] = quantity
+        self.is_lent[row] = is_lent
+        self.copies += quantity - old_quantity
+        self.lent += is_lent - old_lent
+        self.out_of_stock += (is_lent >= quantity) - (old_lent >= old_quantity)
+        for column, index in self.sorted.items():
+            old = self.sort_entry(column, row, old_quantity, old_lent)
+            new = self.sort_entry(column, row, quantity, is_lent)
+            if new != old:
+                index.remove(old)
+                index.add(new)
+
+    def sort_entry(self, column, row, quantity, is_lent):
+        # Counts are packed with the row into one int, so the numeric
+        # indexes are plain int64 arrays; ties go in catalog order.
+        if column == "title":
+            return self.titles[row].casefold(), row
+        value = quantity - is_lent if column == "available" else quantity if column == "total" else is_lent
+        return value << 32 | row
+
+    def sorted_column(self, column):
+        index = self.sorted.get(column)
+        if index is None:
+            if column == "title":
+                index = SortedColumn(sorted((title.casefold(), row) for row, title in enumerate(self.titles)))
+            else:
+                values = {"available": map(sub, self.quantity, self.is_lent), "total": self.quantity,
+                          "lent": self.is_lent}[column]
+                index = SortedColumn(sorted(value << 32 | row for row, value in enumerate(values)),
+                                     lambda entries: array("q", entries))
+            self.sorted[column] = index
+        return index
+
+    def sorted_rows(self, column, start=0, stop=None, descending=False):
+        # Rows at positions [start, stop) of the catalog ordered by column.
+        index = self.sorted_column(column)
+        size = len(index)
+        stop = size if stop is None else min(stop, size)
+        if descending:
+            entries = index.slice(size - stop, size - start)[::-1]
+        else:
+            entries = index.slice(start, stop)
+        if column == "title":
+            return [row for _, row in entries]
+        return [entry & 0xFFFFFFFF for entry in entries]
+
+    def __contains__(self, title):
+        return title in self.rows
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __iter__(self):
+        return iter(self.titles)
+
+    def __getitem__(self, title):
+        return Book(self, self.rows[title])
+
+    def get(self, title, default=None):
+        row = self.rows.get(title)
+        return default if row is None else Book(self, row)
+
+    def values(self):
+        return (Book(self, row) for row in range(len(self.titles)))
+
+    def lines(self):
+        return (f"{t}|{q}|{l}" for t, q, l in zip(self.titles, self.quantity, self.is_lent))
+
+    def total_available(self):
+        return self.copies - self.lent
+
+# === Sort Index ===
+# One catalog column in sorted order, kept sorted as rows change, so a view
+# reads any page of any sort order with a few bisects instead of sorting
+# the catalog. Entries end in the row number, and they are held in buckets
+# of up to 2 * LOAD with each bucket's last entry in `maxes`. A change is a
+# bisect over the maxes, a bisect in one bucket and an insert or delete in
+# that bucket: O(log n) plus a move of at most 2 * LOAD entries, however
+# big the catalog is. Bucket start positions are recomputed on the first
+# page read after a change.
+class SortedColumn:
+    LOAD = 1000
+
+    def __init__(self, entries, make_bucket=list):
+        self.make_bucket = make_bucket
+        self.buckets = [make_bucket(entries[i:i + self.LOAD]) for i in range(0, len(entries), self.LOAD)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.starts = None
+        self.size = len(entries)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, entry):
+        self.size += 1
+        self.starts = None
+        if not self.buckets:
+            self.buckets.append(self.make_bucket([entry]))
+            self.maxes.append(entry)
+            return
+        i = min(bisect_left(self.maxes, entry), len(self.maxes) - 1)
+        bucket = self.buckets[i]
+        insort(bucket, entry)
+        self.maxes[i] = bucket[-1]
+        if len(bucket) > 2 * self.LOAD:
+            self.buckets[i:i + 1] = [bucket[:self.LOAD], bucket[self.LOAD:]]
+            self.maxes[i:i + 1] = [bucket[self.LOAD - 1], bucket[-1]]
+
+    def remove(self, entry):
+        i = bisect_left(self.maxes, entry)
+        bucket = self.buckets[i] if i < len(self.buckets) else ()
+        j = bisect_left(bucket, entry)
+        if j == len(bucket) or bucket[j] != entry:
+            raise ValueError(f"{entry!r} is not in the sort index")
+        del bucket[j]
+        self.size -= 1
+        self.starts = None
+        if bucket:
+            self.maxes[i] = bucket[-1]
+        else:
+            del self.buckets[i]
+            del self.maxes[i]
+
+    def slice(self, start, stop):
+        # The entries at positions [start, stop).
+        starts = self.starts
+        if starts is None:
+            starts = self.starts = list(accumulate((len(bucket) for bucket in self.buckets), initial=0))
+        entries = []
+        i = bisect_right(starts, start) - 1
+        while start < stop and i < len(self.buckets) and i < len(starts):
+            offset = start - starts[i]
+            part = self.buckets[i][offset:offset + stop - start]
+            entries.extend(part)
+            start += len(part)
+            i += 1
+        return entries
+
+# === Search Index ===
+# Titles get a stable id in catalog order. Lookups go through a casefolded
+# exact-title dict, a sorted key list for prefix search and a trigram
+# posting index for substring and fuzzy search, so a query only touches the
+# titles that contain its rarest trigram instead of the whole catalog.
+# Posting lists are appended in id order, so results come out sorted.
+class TitleIndex:
+    FUZZY_CANDIDATES = 50
+    FUZZY_POSTING_BUDGET = 50000
+
+    def __init__(self, titles=()):
+        self.titles = []
+        self.keys = []
+        self.ids = {}
+        self.exact = {}
+        self.grams = defaultdict(list)
+        self.sorted_keys = []
+        self.base_sorted = ()  # keys in order from a catalog snapshot, see CatalogSnapshot
+        for title in titles:
+            self.add(title, keep_sorted=False)
+        self.sort_keys()
+
+    def sort_keys(self):
+        self.sorted_keys = sorted((key, i) for i, key in enumerate(self.keys))
+
+    @staticmethod
+    def trigrams(key):
+        padded = f" {key} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, title, keep_sorted=True):
+        if title in self.ids:
+            return self.ids[title]
+        title_id = len(self.titles)
+        key = title.casefold()
+        self.titles.append(title)
+        self.keys.append(key)
+        self.ids[title] = title_id
+        self.exact.setdefault(key, title_id)
+        for gram in self.trigrams(key):
+            try:
+                self.grams[gram].append(title_id)
+            except AttributeError:  # a read-only posting list from a snapshot
+                self.grams[gram] = list(self.grams[gram]) + [title_id]
+        if keep_sorted:
+            insort(self.sorted_keys, (key, title_id))
+        return title_id
+
+    def find(self, title):
+        title_id = self.exact.get(title.strip().casefold())
+        return None if title_id is None else self.titles[title_id]
+
+    def search(self, query, mode="substring"):
+        return list(self.iter_search(query, mode))
+
+    def iter_search(self, query, mode="substring", start=0):
+        # Substring matches (and "everything" for an empty query) are produced
+        # lazily, so a view can stop or pause part way through a big result.
+        # Substring and prefix matches come in id order and begin at id
+        # `start`, so a paged client resumes where its last page ended
+        # without walking the matches before it; fuzzy matches are ranked,
+        # so `start` does not apply to them.
+        query = query.casefold()
+        if not query:
+            return iter(range(start, len(self.titles)))
+        if mode == "prefix":
+            return self.tail(self.search_prefix(query), start)
+        if mode == "fuzzy":
+            return iter(self.search_fuzzy(query))
+        return self.search_substring(query, start)
+
+    @staticmethod
+    def tail(ids, start):
+        # The ids >= start of a sorted id list, without copying it.
+        return (ids[i] for i in range(bisect_left(ids, start), len(ids)))
+
+    def search_prefix(self, query):
+        start = bisect_left(self.sorted_keys, (query, -1))
+        found = []
+        for key, title_id in self.sorted_keys[start:]:
+            if not key.startswith(query):
+                break
+            found.append(title_id)
+        base = self.base_sorted
+        for position in range(bisect_left(base, query), len(base)):
+            if not base[position].startswith(query):
+                break
+            found.append(base.order[position])
+        return sorted(found)
+
+    def search_substring(self, query, start=0):
+        keys = self.keys
+        if len(query) < 3:
+            # Every occurrence sits inside some padded trigram, so merging the
+            # (sorted) postings of the trigrams containing the query finds
+            # rare matches without a full scan; common ones scan the keys.
+            postings = [posting for gram, posting in list(self.grams.items()) if query in gram]
+            if sum(map(len, postings)) > len(keys):
+                return (i for i in range(start, len(keys)) if query in keys[i])
+            postings = [self.tail(posting, start) for posting in postings]
+            return (i for i, _ in groupby(merge(*postings)) if query in keys[i])
+        rarest = min((self.grams.get(query[i:i + 3], ()) for i in range(len(query) - 2)), key=len)
+        return (i for i in self.tail(rarest, start) if query in keys[i])
+
+    def search_fuzzy(self, query):
+        # Count shared trigrams, starting with the rarest ones, then rank the
+        # best-overlapping titles by edit similarity.
+        postings = sorted((self.grams[g] for g in self.trigrams(query) if g in self.grams), key=len)
+        counts = Counter()
+        budget = self.FUZZY_POSTING_BUDGET
+        for posting in postings:
+            if budget <= 0:
+                break
+            counts.update(posting)
+            budget -= len(posting)
+        candidates = [i for i, _ in counts.most_common(self.FUZZY_CANDIDATES * 4)]
+        scored = sorted(candidates, key=lambda i: SequenceMatcher(None, query, self.keys[i]).ratio(), reverse=True)
+        return scored[:self.FUZZY_CANDIDATES]
+
+# === Catalog Snapshot ===
+# library.snap is a binary copy of the loaded catalog and its TitleIndex,
+# opened with mmap so a window starts without parsing library.txt or
+# rebuilding the trigram index, and processes on the same machine share its
+# pages. Counts are fixed-width int32 columns; titles and their casefolded
+# keys are "\n"-joined UTF-8 blobs with an end-offset column, decoded one
+# string at a time on access (or all at once the first time something
+# iterates over them). Exact lookups binary-search a column of CRC32 hashes
+# sorted next to their row numbers, prefix search bisects a row order sorted
+# by key, and trigram posting lists are used straight from the mapping.
+# Titles added after the snapshot go into small in-memory overlays.
+#
+# The header records the inode, size and mtime of the library.txt it was
+# built from and the journal position it covers; any other library.txt
+# (a compaction, a hand edit) makes it stale, and the next full load from
+# text writes a new one.
+class StringTable:
+    def __init__(self, blob, ends):
+        self.blob = blob
+        self.ends = ends
+        self.count = len(ends)
+        self.decoded = None
+        self.extra = []
+
+    def __len__(self):
+        return self.count + len(self.extra)
+
+    def __getitem__(self, i):
+        if i >= self.count:
+            return self.extra[i - self.count]
+        if self.decoded is not None:
+            return self.decoded[i]
+        start = self.ends[i - 1] + 1 if i else 0
+        return str(self.blob[start:self.ends[i]], "utf-8")
+
+    def __iter__(self):
+        if self.decoded is None:
+            self.decoded = str(self.blob, "utf-8").split("\n") if self.count else []
+        yield from self.decoded
+        yield from self.extra
+
+    def append(self, value):
+        self.extra.append(value)
+
+
+class SnapshotLookup:
+    # string -> row, for Catalog.rows and TitleIndex.ids / exact.
+    def __init__(self, hashes, order, strings):
+        self.hashes = hashes
+        self.order = order
+        self.strings = strings
+        self.extra = {}
+
+    def get(self, key, default=None):
+        row = self.extra.get(key)
+        if row is not None:
+            return row
+        h = crc32(key.encode("utf-8"))
+        hashes = self.hashes
+        position = bisect_left(hashes, h)
+        while position < len(hashes) and hashes[position] == h:
+            row = self.order[position]
+            if self.strings[row] == key:
+                return row
+            position += 1
+        return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        row = self.get(key)
+        if row is None:
+            raise KeyError(key)
+        return row
+
+    def __setitem__(self, key, row):
+        self.extra[key] = row
+
+    def setdefault(self, key, row):
+        found = self.get(key)
+        if found is None:
+            self.extra[key] = found = row
+        return found
+
+
+class SortedKeys:
+    # The snapshot's keys in sorted order, as a sequence bisect can search.
+    def __init__(self, order, keys):
+        self.order = order
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, position):
+        return self.keys[self.order[position]]
+
+
+class CatalogSnapshot:
+    MAGIC = b"BOOKSNP1"
+    FIELDS = ("ino", "size", "mtime_ns", "text_seq", "journal_seq", "journal_entries",
+              "rows", "copies", "lent", "out_of_stock", "little_endian")
+    SECTIONS = (("quantity", "i"), ("is_lent", "i"), ("title_ends", "Q"), ("titles", "B"),
+                ("key_ends", "Q"), ("keys", "B"), ("title_hashes", "I"), ("title_order", "I"),
+                ("key_hashes", "I"), ("key_order", "I"), ("sorted_order", "I"),
+                ("gram_names", "B"), ("gram_ends", "Q"), ("postings", "I"))
+    HEADER = struct.Struct("<8s" + "q" * (len(FIELDS) + len(SECTIONS)))
+
+    def __init__(self, mapping, header, sections):
+        self.mapping = mapping
+        self.header = header
+        self.sections = sections
+        for name in ("text_seq", "journal_seq", "journal_entries"):
+            setattr(self, name, header[name])
+
+    @classmethod
+    def open(cls, path, stamp):
+        # The snapshot at path if it was built from the library.txt whose
+        # (inode, size, mtime_ns) is stamp, else None.
+        try:
+            with open(path, "rb") as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(mapping) < cls.HEADER.size or mapping[:8] != cls.MAGIC:
+            return None
+        values = cls.HEADER.unpack_from(mapping)[1:]
+        header = dict(zip(cls.FIELDS, values))
+        if (header["ino"], header["size"], header["mtime_ns"]) != tuple(stamp):
+            return None
+        if header["little_endian"] != (sys.byteorder == "little"):
+            return None
+        view = memoryview(mapping)
+        sections = {}
+        offset = cls.HEADER.size
+        for (name, code), length in zip(cls.SECTIONS, values[len(cls.FIELDS):]):
+            offset += -offset % 8
+            sections[name] = view[offset:offset + length].cast(code)
+            offset += length
+        if offset > len(mapping):
+            return None
+        perf.count("bytes mapped: snapshot", len(mapping))
+        return cls(mapping, header, sections)
+
+    def catalog(self):
+        sections, header = self.sections, self.header
+        catalog = Catalog()
+        catalog.titles = StringTable(sections["titles"], sections["title_ends"])
+        catalog.quantity = array("i", sections["quantity"].tobytes())
+        catalog.is_lent = array("i", sections["is_lent"].tobytes())
+        catalog.rows = SnapshotLookup(sections["title_hashes"], sections["title_order"], catalog.titles)
+        catalog.copies, catalog.lent, catalog.out_of_stock = header["copies"], header["lent"], header["out_of_stock"]
+        return catalog
+
+    def index(self):
+        sections = self.sections
+        index = TitleIndex()
+        index.titles = StringTable(sections["titles"], sections["title_ends"])
+        index.keys = StringTable(sections["keys"], sections["key_ends"])
+        index.ids = SnapshotLookup(sections["title_hashes"], sections["title_order"], index.titles)
+        index.exact = SnapshotLookup(sections["key_hashes"], sections["key_order"], index.keys)
+        index.base_sorted = SortedKeys(sections["sorted_order"], index.keys)
+        names = str(sections["gram_names"], "utf-8").split("\n") if len(sections["gram_ends"]) else []
+        postings = sections["postings"]
+        ends = sections["gram_ends"].tolist()
+        index.grams = defaultdict(list, ((name, postings[start:end])
+                                         for name, start, end in zip(names, [0] + ends, ends)))
+        return index
+
+    @classmethod
+    def write(cls, path, catalog, index, stamp):
+        # stamp: (ino, size, mtime_ns, text_seq, journal_seq, journal_entries)
+        # describing the state catalog and index hold. Only a catalog whose
+        # index ids are its rows (no duplicate titles) is written.
+        titles = catalog.titles
+        if not isinstance(titles, list) or index.titles != titles:
+            return False
+        encoded = [title.encode("utf-8") for title in titles]
+        keys = [key.encode("utf-8") for key in index.keys]
+
+        def ends(parts):
+            return array("Q", (end - 1 for end in accumulate(len(part) + 1 for part in parts)))
+
+        def hash_table(strings, rows):
+            pairs = sorted((crc32(strings[row]), row) for row in rows)
+            return array("I", (h for h, _ in pairs)), array("I", (row for _, row in pairs))
+
+        title_hashes, title_order = hash_table(encoded, range(len(encoded)))
+        key_hashes, key_order = hash_table(keys, sorted(index.exact.values()))
+        gram_names = list(index.grams)
+        gram_postings = [index.grams[name] for name in gram_names]
+        sections = {
+            "quantity": catalog.quantity, "is_lent": catalog.is_lent,
+            "title_ends": ends(encoded), "titles": b"\n".join(encoded),
+            "key_ends": ends(keys), "keys": b"\n".join(keys),
+            "title_hashes": title_hashes, "title_order": title_order,
+            "key_hashes": key_hashes, "key_order": key_order,
+            "sorted_order": array("I", (title_id for _, title_id in index.sorted_keys)),
+            "gram_names": "\n".join(gram_names).encode("utf-8"),
+            "gram_ends": array("Q", accumulate(map(len, gram_postings))),
+            "postings": array("I", (title_id for posting in gram_postings for title_id in posting)),
+        }
+        blobs = [sections[name] if isinstance(sections[name], bytes) else sections[name].tobytes()
+                 for name, _ in cls.SECTIONS]
+        header = tuple(stamp) + (len(titles), catalog.copies, catalog.lent, catalog.out_of_stock,
+                                 sys.byteorder == "little")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(cls.HEADER.pack(cls.MAGIC, *header, *map(len, blobs)))
+                for blob in blobs:
+                    f.write(b"\0" * (-f.tell() % 8))
+                    f.write(blob)
+                perf.count("bytes written: snapshot", f.tell())
+            os.replace(tmp_path, path)
+        except OSError:
+            # Read-only data directory, or (on Windows) another process has
+            # the old snapshot mapped; the text files still work.
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        return True
+
+# === Library Class ===
+# The catalog lives in memory; a storage backend (see Storage Backends
+# below) decides how each change is persisted and how the catalog is
+# loaded back. Several processes may share the same data, so every
+# mutation takes the backend's cross-process lock, pulls in whatever other
+# processes changed since the last sync, validates against that fresh
+# state and only then records the change.
+# With lazy=True nothing is read up front: a window can paint first and then
+# feed the catalog in with load_next_chunk() from Tk's after() loop, showing
+# the rows read so far after each chunk. Anything that needs the whole
+# catalog (sync, lending, batches) finishes the load first.
+class Library:
+    LOAD_CHUNK = 20000
+    LOAD_ATTEMPTS = 5
+
+    def __init__(self, storage=None, lazy=False):
+        self.storage = storage or default_storage()
+        self.books = Catalog()
+        self.index = TitleIndex()
+        self.listeners = []
+        self.batch_depth = 0
+        self.loaded = False
+        self.loader = None
+        if not lazy:
+            self.load_books()
+
+    @perf.timed("Library.load_books")
+    def load_books(self):
+        self.loaded = False
+        self.loader = None
+        self.ensure_loaded()
+
+    def load_steps(self):
+        # None from pull_changes() means a compaction raced with the load, so
+        # it is read again. The last attempt holds the lock, which no
+        # compaction can race with: a gap that is still there then is damage
+        # in the journal, and reloading again would never get past it.
+        for attempt in range(self.LOAD_ATTEMPTS):
+            if attempt < self.LOAD_ATTEMPTS - 1:
+                snapshot, changes = yield from self.read_catalog()
+            else:
+                with self.storage.locked():
+                    snapshot, changes = yield from self.read_catalog()
+            if changes is not None:
+                break
+        else:
+            raise LendingError("The catalog's change journal has a gap or a damaged record, "
+                               "so the catalog cannot be loaded.")
+        for action, title, quantity in changes:
+            self.apply_change(action, title, quantity)
+        self.loaded = True
+        if self.storage.needs_compaction():
+            with self.storage.locked():
+                self.sync()
+                self.save_books()
+        if snapshot is None and CATALOG_SNAPSHOT:
+            self.storage.write_snapshot(self.books, self.index)
+
+    def read_catalog(self):
+        # One load attempt: (snapshot or None, changes since it or None).
+        snapshot = self.storage.load_snapshot() if CATALOG_SNAPSHOT else None
+        if snapshot is not None:
+            self.books = snapshot.catalog()
+            self.index = snapshot.index()
+        else:
+            self.books = Catalog()
+            self.index = TitleIndex()
+            for title, quantity, is_lent in self.storage.load_books():
+                self.books.add(title, quantity, is_lent)
+                self.index.add(title, keep_sorted=False)
+                if len(self.books) % self.LOAD_CHUNK == 0:
+                    yield len(self.books)
+            self.index.sort_keys()
+        return snapshot, self.storage.pull_changes()
+
+    @perf.timed("Library.load_next_chunk")
+    def load_next_chunk(self):
+        # Returns False once the catalog is fully loaded.
+        if self.loaded:
+            return False
+        if self.loader is None:
+            self.loader = self.load_steps()
+        try:
+            next(self.loader)
+            return True
+        except StopIteration:
+            self.loader = None
+            return False
+
+    def ensure_loaded(self):
+        while self.load_next_chunk():
+            pass
+
+    @perf.timed("Library.sync")
+    def sync(self):
+        self.ensure_loaded()
+        if self.batch_depth:
+            return  # the batch holds the lock, nobody else can have written
+        changes = self.storage.pull_changes()
+        if changes is None:
+            self.load_books()
+            self.notify("reload", None)
+            return
+        for action, title, quantity in changes:
+            self.apply_change(action, title, quantity)
+            self.notify(action, title)
+
+    def apply_change(self, action, title, quantity):
+        if action == "add":
+            if title in self.books:
+                self.books[title].quantity += quantity
+            else:
+                self.books.add(title, quantity)
+                self.index.add(title)
+        elif action == "lend":
+            self.books[title].is_lent += quantity
+        elif action == "return":
+            self.books[title].is_lent -= quantity
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def notify(self, action, title):
+        book = self.books[title] if title is not None else None
+        for listener in list(self.listeners):
+            listener(action, book)
+
+    def record_change(self, action, title, quantity):
+        self.apply_change(action, title, quantity)
+        self.storage.record_change(action, title, quantity)
+        if not self.batch_depth and self.storage.needs_compaction():
+            self.save_books()
+        self.notify(action, title)
+
+    @contextmanager
+    def batch(self):
+        # Many changes under one lock, one sync and one write (one journal
+        # append or one SQLite transaction), compacting at most once. A batch
+        # that raises writes nothing: the storage drops or rolls back its
+        # changes, and the catalog is read back without the ones already
+        # applied in memory.
+        try:
+            with self.storage.locked():
+                self.sync()
+                self.batch_depth += 1
+                try:
+                    with self.storage.batched():
+                        yield self
+                finally:
+                    self.batch_depth -= 1
+                if self.storage.needs_compaction():
+                    self.save_books()
+        except BaseException:
+            if not self.batch_depth:
+                self.load_books()
+                self.notify("reload", None)
+            raise
+
+    @perf.timed("Library.save_books")
+    def save_books(self):
+        self.storage.save_books(self.books)
+
+    def add_book(self, title, quantity=1):
+        with self.storage.locked():
+            self.sync()
+            self.record_change("add", title, quantity)
+        return True
+
+    def lend_book(self, title, quantity=1):
+        with self.storage.locked():
+            self.sync()
+            book = self.books.get(title)
+            if book is None or book.is_lent + quantity > book.quantity:
+                return False
+            self.record_change("lend", title, quantity)
+        return True
+
+    def return_book(self, title, quantity=1):
+        with self.storage.locked():
+            self.sync()
+            book = self.books.get(title)
+            if book is None or book.is_lent < quantity:
+                return False
+            self.record_change("return", title, quantity)
+        return True
+
+    def get_books(self):
+        return self.books.values()
+
+    def find_book(self, title):
+        self.ensure_loaded()
+        found = self.index.find(title)
+        return None if found is None else self.books[found]
+
+    def search_books(self, query, mode="substring"):
+        # Returns (catalog number, book) pairs in catalog order, or best match
+        # first for fuzzy search.
+        return list(self.iter_search_books(query, mode))
+
+    def iter_search_books(self, query, mode="substring", start=0):
+        # (catalog number, book) pairs; see TitleIndex.iter_search for start.
+        titles = self.index.titles
+        books = self.books
+        matches = self.index.iter_search(query.strip(), mode, start)
+        if len(titles) == len(books):
+            # No duplicate titles were loaded, so index ids are catalog rows.
+            return ((i + 1, Book(books, i)) for i in matches)
+        return ((i + 1, books[titles[i]]) for i in matches)
+
+    def sorted_books(self, column, start=0, stop=None, descending=False, query="", mode="substring"):
+        # (catalog number, book) pairs at positions [start, stop) of the
+        # catalog in column order (one of SORT_COLUMNS). The whole catalog
+        # is paged straight off its sort index; the matches of a query are
+        # sorted, as they are usually far fewer.
+        if query.strip():
+            key = {"title": lambda book: book.title.casefold(), "available": Book.available,
+                   "total": lambda book: book.quantity, "lent": lambda book: book.is_lent}[column]
+            matches = sorted(self.iter_search_books(query, mode), key=lambda pair: (key(pair[1]), pair[1].row),
+                             reverse=descending)
+            return matches[start:stop]
+        books = self.books
+        rows = books.sorted_rows(column, start, stop, descending)
+        if len(self.index.titles) == len(books):
+            return [(row + 1, Book(books, row)) for row in rows]
+        ids = self.index.ids
+        return [(ids[books.titles[row]] + 1, Book(books, row)) for row in rows]
+
+# === Branches ===
+# A BranchLibrary is a Library whose catalog is split into one shard per
+# branch. Each shard is an ordinary Library over its own storage (its own
+# library.txt and journal, or its own database, and its own lock), so a
+# lend at one branch appends to that branch's journal only and compacts
+# only that branch's snapshot. Requests, loans, the activity log and the
+# accounts stay in the main storage and are shared by every shard.
+#
+# The shards load side by side on a thread pool. Their catalogs then merge
+# into self.books/self.index (copies summed per title), so search, sorting
+# and the reports see the chain as one catalog, and every shard change is
+# folded back into the merged row. availability() breaks a title down per
+# branch. Lends and returns go to the nearest branch, by distance from the
+# home branch, that can take them.
+#
+# Indexing the merged titles is the slow part of a merge, so the merged
+# catalog and index are kept as a CatalogSnapshot in BRANCH_DIR together
+# with a row map (each shard row's merged row). Both are keyed on the shard
+# titles they were built from, which only ever grow at the end, so they
+# stay valid across lends, returns and compactions and a start only has to
+# sum the shards' copy counts through the row map.
+def load_branches(path=BRANCHES_FILE):
+    # [(name, x, y)] in file order.
+    branches = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.strip().split("|")
+            if len(parts) == 3 and parts[0] and not parts[0].startswith("#"):
+                branches.append((parts[0], float(parts[1]), float(parts[2])))
+    return branches
+
+
+def branch_storage(name, shared):
+    directory = os.path.join(BRANCH_DIR, name)
+    os.makedirs(directory, exist_ok=True)
+    if isinstance(shared, SqliteStorage):
+        return SqliteStorage(os.path.join(directory, SQLITE_DB), shared=shared)
+    return TextStorage(directory, shared=shared)
+
+
+class BranchLibrary(Library):
+    def __init__(self, branches, storage=None, lazy=False, home=None):
+        super().__init__(storage, lazy=True)
+        self.branches = {}
+        for name, x, y in branches:
+            branch = Library(branch_storage(name, self.storage), lazy=True)
+            branch.subscribe(self.on_branch_change)
+            self.branches[name] = branch
+        positions = {name: (x, y) for name, x, y in branches}
+        self.home = home if home in positions else branches[0][0]
+        home_x, home_y = positions[self.home]
+        self.distances = {name: math.hypot(x - home_x, y - home_y) for name, (x, y) in positions.items()}
+        self.nearest = sorted(self.branches, key=self.distances.get)
+        self.snapshot_file = os.path.join(BRANCH_DIR, CATALOG_SNAPSHOT_FILE)
+        self.row_map_file = os.path.join(BRANCH_DIR, BRANCH_ROW_MAP_FILE)
+        if not lazy:
+            self.load_books()
+
+    def load_steps(self):
+        workers = max(1, min(BRANCH_LOAD_WORKERS, len(self.branches)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for _ in pool.map(Library.ensure_loaded, self.branches.values()):
+                pass
+        yield from self.merge()
+        self.loaded = True
+
+    def merge(self):
+        # Rebuilds the merged catalog, one branch per step.
+        fingerprint = self.fingerprint()
+        if CATALOG_SNAPSHOT and self.load_merged(fingerprint):
+            yield len(self.books)
+            return
+        self.books = books = Catalog()
+        self.index = index = TitleIndex()
+        row_maps = []
+        for branch in self.branches.values():
+            shard = branch.books
+            row_map = array("I")
+            for title, quantity, is_lent in zip(shard.titles, shard.quantity, shard.is_lent):
+                row = books.rows.get(title)
+                if row is None:
+                    row = len(books)
+                    books.add(title, quantity, is_lent)
+                    index.add(title, keep_sorted=False)
+                else:
+                    books.update(row, books.quantity[row] + quantity, books.is_lent[row] + is_lent)
+                row_map.append(row)
+            row_maps.append(row_map)
+            yield len(books)
+        index.sort_keys()
+        if CATALOG_SNAPSHOT:
+            self.save_merged(fingerprint, row_maps)
+
+    def fingerprint(self):
+        # Names, generations, row counts and last titles of the shards. Rows
+        # are only appended between rewrites of a shard's catalog, and each
+        # rewrite starts a new generation.
+        digest = hashlib.blake2b(digest_size=7)
+        for name, branch in self.branches.items():
+            titles = branch.books.titles
+            last = titles[len(titles) - 1] if len(titles) else ""
+            digest.update(f"{name}\n{branch.storage.generation()}\n{len(titles)}\n{last}\n".encode())
+        return int.from_bytes(digest.digest(), "little")
+
+    def load_merged(self, fingerprint):
+        snapshot = CatalogSnapshot.open(self.snapshot_file, (fingerprint, 0, 0))
+        row_maps = BranchRowMap.load(self.row_map_file, fingerprint)
+        if snapshot is None or row_maps is None:
+            return False
+        books = snapshot.catalog()
+        quantity = array("i", bytes(len(books.quantity) * books.quantity.itemsize))
+        is_lent = array("i", bytes(len(books.is_lent) * books.is_lent.itemsize))
+        for branch, row_map in zip(self.branches.values(), row_maps):
+            for row, copies, lent in zip(row_map, branch.books.quantity, branch.books.is_lent):
+                quantity[row] += copies
+                is_lent[row] += lent
+        books.quantity, books.is_lent = quantity, is_lent
+        books.copies, books.lent = sum(quantity), sum(is_lent)
+        books.out_of_stock = sum(map(ge, is_lent, quantity))
+        self.books = books
+        self.index = snapshot.index()
+        return True
+
+    def save_merged(self, fingerprint, row_maps):
+        # The row map goes last: a crash in between leaves no pair that matches.
+        if CatalogSnapshot.write(self.snapshot_file, self.books, self.index, (fingerprint, 0, 0, 0, 0, 0)):
+            BranchRowMap.save(self.row_map_file, fingerprint, row_maps)
+
+    def on_branch_change(self, action, book):
+        if not self.loaded:
+            return  # merge() will pick it up
+        if book is None:
+            for _ in self.merge():
+                pass
+            self.notify("reload", None)
+            return
+        title = book.title
+        quantity = is_lent = 0
+        for branch in self.branches.values():
+            found = branch.books.get(title)
+            if found is not None:
+                quantity += found.quantity
+                is_lent += found.is_lent
+        merged = self.books.get(title)
+        if merged is None:
+            self.books.add(title, quantity, is_lent)
+            self.index.add(title)
+        else:
+            self.books.update(merged.row, quantity, is_lent)
+        self.notify(action, title)
+
+    def sync(self):
+        self.ensure_loaded()
+        for branch in self.branches.values():
+            branch.sync()
+
+    @contextmanager
+    def batch(self):
+        # The main lock first, then every branch's in a fixed order, so two
+        # batches never wait on each other's locks. Only branches that were
+        # changed append to their journals.
+        with self.storage.locked(), ExitStack() as stack:
+            self.ensure_loaded()
+            for branch in self.branches.values():
+                stack.enter_context(branch.batch())
+            with self.storage.batched():
+                yield self
+
+    def record_change(self, action, title, quantity):
+        # Inside batch(): adds go to the home branch; lends and returns are
+        # spread over the branches, nearest first.
+        if action == "add":
+            self.branches[self.home].record_change(action, title, quantity)
+            return
+        for name in self.nearest:
+            book = self.branches[name].books.get(title)
+            part = 0 if book is None else min(quantity, book.available() if action == "lend" else book.is_lent)
+            if part > 0:
+                self.branches[name].record_change(action, title, part)
+                quantity -= part
+                if not quantity:
+                    return
+
+    def save_books(self):
+        for branch in self.branches.values():
+            branch.save_books()
+
+    def add_book(self, title, quantity=1, branch=None):
+        self.ensure_loaded()
+        return self.branches[branch or self.home].add_book(title, quantity)
+
+    def lend_book(self, title, quantity=1):
+        # Lends all copies from the nearest branch that has them on the
+        # shelf. Returns that branch's name, or None.
+        self.sync()
+        for name in self.nearest:
+            book = self.branches[name].books.get(title)
+            if book is not None and book.available() >= quantity and self.branches[name].lend_book(title, quantity):
+                return name
+        return None
+
+    def return_book(self, title, quantity=1):
+        # Returns the copies to the nearest branch that has that many out.
+        # Returns that branch's name, or None.
+        self.sync()
+        for name in self.nearest:
+            book = self.branches[name].books.get(title)
+            if book is not None and book.is_lent >= quantity and self.branches[name].return_book(title, quantity):
+                return name
+        return None
+
+    def availability(self, title):
+        # [(branch, distance in km, book)] for the branches that hold the
+        # title, nearest first.
+        self.ensure_loaded()
+        found = []
+        for name in self.nearest:
+            book = self.branches[name].books.get(title)
+            if book is not None:
+                found.append((name, self.distances[name], book))
+        return found
+
+# For each shard (in branches.txt order) the merged row of each of its
+# rows, as uint32 arrays after a header that names the fingerprint of the
+# shard titles they were built from.
+class BranchRowMap:
+    MAGIC = b"BOOKRMP1"
+    HEADER = struct.Struct("<8sqq")
+    LENGTH = struct.Struct("<q")
+
+    @classmethod
+    def save(cls, path, fingerprint, row_maps):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(cls.HEADER.pack(cls.MAGIC, fingerprint, len(row_maps)))
+                for row_map in row_maps:
+                    f.write(cls.LENGTH.pack(len(row_map)))
+                    f.write(row_map.tobytes())
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        return True
+
+    @classmethod
+    def load(cls, path, fingerprint):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < cls.HEADER.size:
+            return None
+        magic, found, count = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or found != fingerprint:
+            return None
+        row_maps = []
+        offset = cls.HEADER.size
+        for _ in range(count):
+            if offset + cls.LENGTH.size > len(data):
+                return None
+            length = cls.LENGTH.unpack_from(data, offset)[0] * 4
+            offset += cls.LENGTH.size
+            if offset + length > len(data):
+                return None
+            row_maps.append(array("I", data[offset:offset + length]))
+            offset += length
+        return row_maps
+
+# === Shared Library ===
+# Every window in the process shares one Library, so a change made in one
+# view reaches the others through Library.subscribe() without re-reading
+# library.txt. With a BRANCHES_FILE it is a BranchLibrary.
+_shared_library = None
+
+
+def shared_library(lazy=False):
+    global _shared_library
+    if _shared_library is None:
+        if os.path.exists(BRANCHES_FILE):
+            _shared_library = BranchLibrary(load_branches(), lazy=lazy, home=HOME_BRANCH)
+        else:
+            _shared_library = Library(lazy=lazy)
+    elif not lazy:
+        _shared_library.ensure_loaded()
+    return _shared_library
+
+# === Request Store ===
+# requests.txt is only ever appended to, so the store remembers how far it
+# has read and indexes each new "user|title|timestamp" line by the byte
+# offset where it starts. A refresh reads just the bytes appended since the
+# previous one, and one user's history is read back by seeking to their
+# offsets instead of scanning everyone else's requests.
+#
+# Requests are numbered 1, 2, ... in file order. Their state changes are
+# appended as "id|state|timestamp" lines to request_status.txt, which is
+# read incrementally the same way and replayed into a RequestQueue.
+def parse_request(line):
+    parts = line.strip().split("|", 1)
+    if len(parts) != 2 or "|" not in parts[1]:
+        return None
+    title, timestamp = parts[1].rsplit("|", 1)
+    return parts[0], title, timestamp
+
+
+class RequestStore:
+    RECENT_LIMIT = 50
+
+    def __init__(self, filename=REQUESTS_FILE, status_file=REQUEST_STATUS_FILE):
+        self.filename = filename
+        self.status_file = status_file
+        self.user_offsets = defaultdict(list)  # username -> [(offset, request id)]
+        self.recent = deque(maxlen=self.RECENT_LIMIT)
+        self.counts = RequestCounts()
+        self.queue = RequestQueue()
+        self.count = 0  # lines seen so far, so a view can tell which are new
+        self.last_id = 0
+        self.indexed_to = 0
+        self.status_read_to = 0
+        self.pending = None  # (request lines, status lines) inside a batch
+
+    def reset(self):
+        self.user_offsets.clear()
+        self.recent.clear()
+        self.counts = RequestCounts()
+        self.queue = RequestQueue()
+        self.count = 0
+        self.last_id = 0
+        self.indexed_to = 0
+        self.status_read_to = 0
+
+    def refresh(self):
+        if not os.path.exists(self.filename):
+            return []
+        if os.path.getsize(self.filename) < self.indexed_to:
+            self.reset()  # the file was replaced or truncated; start the index over
+        new_lines = []
+        with open(self.filename, "rb") as f:
+            f.seek(self.indexed_to)
+            offset = self.indexed_to
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # still being written; pick it up next time
+                line = raw.decode("utf-8", errors="replace").strip()
+                request = parse_request(line)
+                if request:
+                    self.last_id += 1
+                    self.user_offsets[request[0]].append((offset, self.last_id))
+                    self.counts.add(request[1])
+                    self.queue.add(self.last_id, *request)
+                if line:
+                    self.recent.append(line)
+                    self.count += 1
+                    new_lines.append(line)
+                offset += len(raw)
+        self.indexed_to = offset
+        self.read_statuses()
+        return new_lines
+
+    def read_statuses(self):
+        if not os.path.exists(self.status_file):
+            return
+        with open(self.status_file, "rb") as f:
+            f.seek(self.status_read_to)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                parts = raw.decode("utf-8", errors="replace").split("|")
+                if len(parts) >= 2 and parts[0].isdigit():
+                    self.queue.set(int(parts[0]), parts[1])
+                self.status_read_to += len(raw)
+
+    def add(self, username, title, timestamp):
+        line = f"{username}|{title}|{timestamp}\n"
+        if self.pending is not None:
+            self.pending[0].append(line)
+            return
+        with open(self.filename, "a") as f:
+            f.write(line)
+
+    @contextmanager
+    def batched(self):
+        # Requests added and states set inside a storage batch are written
+        # when it succeeds, one append per file, and dropped if it fails.
+        if self.pending is not None:
+            yield
+            return
+        self.pending = ([], [])
+        try:
+            yield
+        except BaseException:
+            # The queue already holds the dropped states; read it back.
+            self.pending = None
+            self.reset()
+            raise
+        (lines, statuses), self.pending = self.pending, None
+        if lines:
+            with open(self.filename, "a") as f:
+                f.write("".join(lines))
+        if statuses:
+            self.write_statuses(statuses)
+
+    def most_requested(self):
+        return self.counts.most_requested()
+
+    def state(self, request_id):
+        return self.queue.states.get(request_id)
+
+    def get(self, request_id):
+        request = self.queue.requests.get(request_id)
+        return None if request is None else request + (self.queue.states[request_id],)
+
+    def pending_by_title(self):
+        return self.queue.pending_by_title()
+
+    def set_status(self, updates):
+        # One append (and one fsync) for the whole list of (id, state), or
+        # for the whole batch inside one.
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        lines = [f"{request_id}|{state}|{timestamp}\n" for request_id, state in updates]
+        if self.pending is not None:
+            self.pending[1].extend(lines)
+        else:
+            self.write_statuses(lines)
+        for request_id, state in updates:
+            self.queue.set(request_id, state)
+
+    def write_statuses(self, lines):
+        with open(self.status_file, "a") as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def user_requests(self, username):
+        self.refresh()
+        requests = []
+        offsets = self.user_offsets.get(username, [])
+        if not offsets:
+            return requests
+        with open(self.filename, "rb") as f:
+            for offset, request_id in offsets:
+                f.seek(offset)
+                request = parse_request(f.readline().decode("utf-8", errors="replace"))
+                if request:
+                    requests.append(request + (self.state(request_id),))
+        return requests
+
+# Per-title request counts plus the few most requested titles. Counts only
+# ever go up, so a title can only enter the top list by overtaking its last
+# entry, and each new request costs a comparison or a sort of `size` items.
+class RequestCounts:
+    def __init__(self, size=10):
+        self.size = size
+        self.counts = Counter()
+        self.top = []
+
+    def add(self, title, n=1):
+        counts = self.counts
+        counts[title] += n
+        top = self.top
+        if title not in top:
+            if len(top) < self.size:
+                top.append(title)
+            elif counts[title] > counts[top[-1]]:
+                top[-1] = title
+            else:
+                return
+        top.sort(key=counts.__getitem__, reverse=True)
+
+    def most_requested(self):
+        return [(title, self.counts[title]) for title in self.top]
+
+# Request states: pending -> approved -> fulfilled, or pending -> rejected.
+# The queue keeps open requests (pending or approved) in memory, with the
+# pending ones in a FIFO per title; closed requests only keep their state.
+# A request that stops being pending is left in its title's FIFO and
+# skipped when the FIFO is next read.
+REQUEST_TRANSITIONS = {"pending": ("approved", "rejected"), "approved": ("fulfilled",)}
+
+
+class RequestQueue:
+    def __init__(self):
+        self.requests = {}
+        self.states = {}
+        self.pending = defaultdict(deque)
+
+    def add(self, request_id, username, title, timestamp):
+        self.requests[request_id] = (username, title, timestamp)
+        self.states[request_id] = "pending"
+        self.pending[title].append(request_id)
+
+    def set(self, request_id, state):
+        if request_id not in self.states:
+            return
+        self.states[request_id] = state
+        if state not in REQUEST_TRANSITIONS:
+            self.requests.pop(request_id, None)
+
+    def pending_by_title(self):
+        # (title, [(id, username) of pending requests, oldest first]) for
+        # every title with a queue.
+        states = self.states
+        for title in list(self.pending):
+            ids = [request_id for request_id in self.pending[title] if states[request_id] == "pending"]
+            if ids:
+                self.pending[title] = deque(ids)
+                yield title, [(request_id, self.requests[request_id][0]) for request_id in ids]
+            else:
+                del self.pending[title]
+
+# === Activity Log ===
+# Each event is appended as one line; the full history is never held in
+# memory or rewritten. Only the newest entries are kept in a deque for the
+# dashboard. When the live file grows past max_bytes (or, with daily
+# rotation, was last written on an earlier day) it is rolled over to
+# activity_log.txt.1[.gz], .2[.gz], ... keeping at most `backups` segments.
+#
+# query() answers "what did X do", "everything about this title" and
+# "what happened between A and B" from an ActivityIndex per segment (see
+# below) instead of reading the history: words and users narrow the
+# search to a few line numbers, and since the lines are appended in time
+# order a time range is two binary searches over the line start offsets.
+# Whole segments outside the time range, or without a matching word, are
+# skipped without being opened (or decompressed).
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def entry_tokens(entry):
+    # "@user" for whoever did it, plus the distinct lower-cased words of the
+    # action, minus a few that are in nearly every line.
+    head, sep, action = entry.partition(") ")
+    if not sep:
+        return set(query_words(entry))
+    tokens = set(query_words(action))
+    if "(" in head:
+        tokens.add("@" + head.partition("(")[2])
+    return tokens
+
+
+def query_words(text):
+    return [word for word in WORD_PATTERN.findall(text.lower()) if word not in ACTIVITY_STOPWORDS]
+
+
+class ActivityLog:
+    def __init__(self, filename=ACTIVITY_LOG_FILE, keep=50, max_bytes=ACTIVITY_LOG_MAX_BYTES,
+                 backups=ACTIVITY_LOG_BACKUPS, daily=ACTIVITY_LOG_ROTATE_DAILY, compress=ACTIVITY_LOG_COMPRESS):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.daily = daily
+        self.compress = compress
+        self.keep = keep
+        self.recent = None  # the tail is only read once somebody looks at it
+        self.count = 0  # entries seen so far, so a view can tell which are new
+        self.indexes = {}  # segment path -> ActivityIndex, once a query has needed it
+        self.pending = None
+
+    @property
+    def entries(self):
+        if self.recent is None:
+            self.recent = deque(self.read_tail(self.keep), maxlen=self.keep)
+            self.count = len(self.recent)
+        return self.recent
+
+    def read_tail(self, count):
+        if not os.path.exists(self.filename):
+            return []
+        with open(self.filename, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            data = b""
+            while pos > 0 and data.count(b"\n") <= count:
+                step = min(8192, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        lines = [line.strip() for line in data.decode("utf-8", errors="replace").splitlines()]
+        return [line for line in lines if line][-count:]
+
+    def segment_name(self, number):
+        name = f"{self.filename}.{number}"
+        return name + ".gz" if self.compress else name
+
+    def should_rotate(self):
+        if not os.path.exists(self.filename):
+            return False
+        if self.max_bytes and os.path.getsize(self.filename) >= self.max_bytes:
+            return True
+        if self.daily:
+            written = datetime.fromtimestamp(os.path.getmtime(self.filename)).date()
+            return written != datetime.now().date()
+        return False
+
+    def segment_paths(self):
+        # Newest first: the live file, then the rotated segments (with either
+        # suffix, in case compression was switched on or off).
+        paths = [self.filename]
+        for number in range(1, self.backups + 1):
+            for path in (f"{self.filename}.{number}.gz", f"{self.filename}.{number}"):
+                if os.path.exists(path):
+                    paths.append(path)
+        return paths
+
+    def rotate(self):
+        # Each segment's index file moves along with it; offsets into a
+        # compressed segment are offsets into its decompressed text, so the
+        # index of the live file stays valid for segment 1.
+        for number in range(self.backups - 1, 0, -1):
+            for suffix in ("", ActivityIndex.SUFFIX):
+                if os.path.exists(self.segment_name(number) + suffix):
+                    os.replace(self.segment_name(number) + suffix, self.segment_name(number + 1) + suffix)
+        index_file = self.filename + ActivityIndex.SUFFIX
+        if self.backups <= 0:
+            os.remove(self.filename)
+            if os.path.exists(index_file):
+                os.remove(index_file)
+        elif self.compress:
+            with open(self.filename, "rb") as src, gzip.open(self.segment_name(1), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.filename)
+        else:
+            os.replace(self.filename, self.segment_name(1))
+        if self.backups > 0 and os.path.exists(index_file):
+            os.replace(index_file, self.segment_name(1) + ActivityIndex.SUFFIX)
+        self.indexes.clear()
+
+    def append(self, entry):
+        if self.pending is not None:
+            self.pending.append(entry)
+            return
+        # The tail is loaded (if it was not yet) before the line is written,
+        # or it would already hold the entry appended below.
+        entries = self.entries
+        if self.should_rotate():
+            self.rotate()
+        line = entry.encode("utf-8")
+        with open(self.filename, "ab") as f:
+            f.write(line + b"\n")
+            offset = f.tell() - len(line) - 1  # O_APPEND: wherever the line actually landed
+        perf.count("bytes written: activity log", len(line) + 1)
+        index = self.indexes.get(self.filename)
+        if index is not None and index.covered_to == offset:
+            index.add(offset, line)  # otherwise another process wrote first; query() catches up
+        entries.append(entry)
+        self.count += 1
+
+    @contextmanager
+    def batched(self):
+        # Entries logged inside a storage batch are appended when it
+        # succeeds and dropped if it fails, like the changes they describe.
+        if self.pending is not None:
+            yield
+            return
+        self.pending = []
+        try:
+            yield
+        except BaseException:
+            self.pending = None
+            raise
+        pending, self.pending = self.pending, None
+        for entry in pending:
+            self.append(entry)
+
+    @contextmanager
+    def segment_data(self, path):
+        # The segment's text as a bytes-like object: mapped for a plain
+        # file, decompressed for a .gz one.
+        if path.endswith(".gz"):
+            with gzip.open(path, "rb") as f:
+                yield f.read()
+            return
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b""
+                return
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapping
+        finally:
+            mapping.close()
+
+    def segment_index(self, path):
+        # The segment's index, brought up to date with the file. A compressed
+        # segment never changes, so if its index file was saved against the
+        # same compressed size it is used without decompressing anything.
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return None
+        index = self.indexes.get(path) or ActivityIndex.load(path + ActivityIndex.SUFFIX)
+        if index is not None and index.source_size == size and path.endswith(".gz"):
+            self.indexes[path] = index
+            return index
+        with self.segment_data(path) as data:
+            if index is None or not index.matches(data):
+                index = ActivityIndex()
+            index.catch_up(data)
+        resized, index.source_size = index.source_size != size, size
+        unsaved = len(index.offsets) - index.saved_lines
+        if unsaved >= ACTIVITY_INDEX_SAVE_EVERY or (path != self.filename and (unsaved or resized)):
+            index.save(path + ActivityIndex.SUFFIX)
+        self.indexes[path] = index
+        return index
+
+    @perf.timed("ActivityLog.query")
+    def query(self, user=None, text=None, since=None, until=None, limit=None):
+        # Entries newest first. user is who did it; every word of text must
+        # appear in the entry; since and until are inclusive timestamp
+        # prefixes ("2025-05", "2025-05-13 10:40").
+        tokens = query_words(text or "")
+        if user:
+            tokens.append("@" + user)
+        results = []
+        for path in self.segment_paths():
+            index = self.segment_index(path)
+            if index is None or not index.offsets:
+                continue
+            if since and index.last_time[:len(since)] < since:
+                break  # older segments are older still
+            if until and index.first_time()[:len(until)] > until:
+                continue
+            if not all(token in index.postings for token in tokens):
+                continue
+            with self.segment_data(path) as data:
+                lo, hi = index.line_range(data, since, until)
+                for number in index.matching_lines(tokens, lo, hi, lazy=bool(limit)):
+                    results.append(index.line(data, number))
+                    if limit and len(results) >= limit:
+                        return results
+        return results
+
+# One segment's index: where each line starts, and for every token (see
+# entry_tokens) the ascending line numbers that contain it, as compact
+# uint32 arrays. The live file's index is extended on every append() and
+# caught up from whatever other processes appended; it is saved next to
+# its segment as <segment>.idx every ACTIVITY_INDEX_SAVE_EVERY lines, so
+# a restart only indexes the lines since. The first line of the segment is
+# kept to tell a file that grew from one that was replaced.
+class ActivityIndex:
+    SUFFIX = ".idx"
+    MAGIC = b"BOOKLIX1"
+    HEADER = struct.Struct("<8s8q")  # magic, source size, covered to, then section lengths
+    SECTIONS = ("head", "last_time", "token_names", "token_ends", "offsets", "postings")
+
+    def __init__(self):
+        self.offsets = array("Q")
+        self.postings = {}
+        self.covered_to = 0
+        self.source_size = -1
+        self.head = b""
+        self.last_time = ""
+        self.saved_lines = 0
+
+    def first_time(self):
+        return self.head[1:20].decode("utf-8", errors="replace")
+
+    def add(self, offset, line):
+        number = len(self.offsets)
+        self.offsets.append(offset)
+        if not number:
+            self.head = bytes(line)
+        text = line.decode("utf-8", errors="replace")
+        self.last_time = text[1:20]
+        postings = self.postings
+        for token in entry_tokens(text):
+            numbers = postings.get(token)
+            if numbers is None:
+                postings[token] = array("I", (number,))
+            else:
+                numbers.append(number)
+        self.covered_to = offset + len(line) + 1
+
+    def catch_up(self, data):
+        pos = self.covered_to
+        while True:
+            end = data.find(b"\n", pos)
+            if end < 0:
+                break  # nothing more, or a line still being written
+            line = data[pos:end]
+            if line.strip():
+                self.add(pos, line)
+            pos = self.covered_to = end + 1
+
+    def matches(self, data):
+        return self.covered_to <= len(data) and data[:len(self.head)] == self.head
+
+    def matching_lines(self, tokens, lo, hi, lazy=False):
+        # Line numbers in [lo, hi) holding every token, newest first. lazy
+        # walks the rarest token's lines and binary-searches the other
+        # lists, so a query with a limit stops as soon as it has enough;
+        # otherwise the lists are intersected as sets, which is quicker
+        # for all of them.
+        if not tokens:
+            yield from reversed(range(lo, hi))
+            return
+        lists = sorted((self.postings.get(token, array("I")) for token in set(tokens)), key=len)
+        first, *others = [numbers[bisect_left(numbers, lo):bisect_left(numbers, hi)] for numbers in lists]
+        if not lazy:
+            yield from sorted(set(first).intersection(*others), reverse=True)
+            return
+        for number in reversed(first):
+            if all(self.holds(numbers, number) for numbers in others):
+                yield number
+
+    @staticmethod
+    def holds(numbers, number):
+        i = bisect_left(numbers, number)
+        return i < len(numbers) and numbers[i] == number
+
+    def time_key(self, data, number, width):
+        start = self.offsets[number] + 1
+        return data[start:start + width].decode("ascii", errors="replace")
+
+    def line_range(self, data, since, until):
+        # [lo, hi) of the line numbers stamped within since..until.
+        lo, hi = 0, len(self.offsets)
+        if since:
+            lo = self.bisect_time(data, since, lo, hi, lambda key: key < since)
+        if until:
+            hi = self.bisect_time(data, until, lo, hi, lambda key: key <= until)
+        return lo, hi
+
+    def bisect_time(self, data, bound, lo, hi, before):
+        # The first line number in [lo, hi) whose timestamp is not `before`.
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if before(self.time_key(data, mid, len(bound))):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def line(self, data, number):
+        start = self.offsets[number]
+        return bytes(data[start:data.find(b"\n", start)]).decode("utf-8", errors="replace")
+
+    def save(self, path):
+        names = list(self.postings)
+        lists = [self.postings[name] for name in names]
+        blobs = {
+            "head": self.head,
+            "last_time": self.last_time.encode("utf-8"),
+            "token_names": "\n".join(names).encode("utf-8"),
+            "token_ends": array("Q", accumulate(map(len, lists))).tobytes(),
+            "offsets": self.offsets.tobytes(),
+            "postings": b"".join(numbers.tobytes() for numbers in lists),
+        }
+        blobs = [blobs[name] for name in self.SECTIONS]
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.source_size, self.covered_to, *map(len, blobs)))
+                for blob in blobs:
+                    f.write(blob)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.saved_lines = len(self.offsets)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) < cls.HEADER.size or data[:8] != cls.MAGIC:
+            return None
+        _, source_size, covered_to, *lengths = cls.HEADER.unpack_from(data)
+        if cls.HEADER.size + sum(lengths) != len(data):
+            return None
+        sections = {}
+        offset = cls.HEADER.size
+        for name, length in zip(cls.SECTIONS, lengths):
+            sections[name] = data[offset:offset + length]
+            offset += length
+        index = cls()
+        index.source_size, index.covered_to = source_size, covered_to
+        index.head = sections["head"]
+        index.last_time = sections["last_time"].decode("utf-8")
+        index.offsets.frombytes(sections["offsets"])
+        ends = array("Q", sections["token_ends"]).tolist()
+        names = sections["token_names"].decode("utf-8").split("\n") if ends else []
+        postings = memoryview(sections["postings"]).cast("I")
+        index.postings = {name: array("I", postings[start:end].tobytes())
+                          for name, start, end in zip(names, [0] + ends, ends)}
+        index.saved_lines = len(index.offsets)
+        return index
+
+# === Loan Ledger ===
+# One record per lent copy: who has it, since when and until when. Open
+# loans are indexed by borrower and by title (dicts kept in lend order, so
+# the oldest loan comes first), and their due dates sit in a min-heap.
+# overdue() walks that heap from the root and only descends below entries
+# that are already due, so it costs O(k log k) for k overdue loans however
+# many are open. Closed loans are dropped from the heap lazily, and the heap
+# is rebuilt once they make up half of it. Times are "%Y-%m-%d %H:%M:%S"
+# strings, which sort chronologically.
+class LoanLedger:
+    def __init__(self):
+        self.loans = {}
+        self.by_borrower = defaultdict(dict)
+        self.by_title = defaultdict(dict)
+        self.due = []
+        self.stale = 0
+        self.next_id = 1
+
+    def open(self, loan_id, borrower, title, lent_at, due_at):
+        if loan_id < self.next_id:
+            return  # already replayed
+        self.next_id = loan_id + 1
+        self.loans[loan_id] = (borrower, title, lent_at, due_at)
+        self.by_borrower[borrower][loan_id] = None
+        self.by_title[title][loan_id] = None
+        heappush(self.due, (due_at, loan_id))
+
+    def close(self, loan_id):
+        loan = self.loans.pop(loan_id, None)
+        if loan is None:
+            return
+        for index, key in ((self.by_borrower, loan[0]), (self.by_title, loan[1])):
+            del index[key][loan_id]
+            if not index[key]:
+                del index[key]
+        self.stale += 1
+        if self.stale > len(self.due) // 2:
+            self.due = [entry for entry in self.due if entry[1] in self.loans]
+            heapify(self.due)
+            self.stale = 0
+
+    def get(self, loan_id):
+        return (loan_id,) + self.loans[loan_id]
+
+    def open_loans(self, borrower=None, title=None):
+        if borrower is not None:
+            ids = self.by_borrower.get(borrower, {})
+        elif title is not None:
+            ids = self.by_title.get(title, {})
+        else:
+            ids = self.loans
+        return [self.get(loan_id) for loan_id in ids if title is None or self.loans[loan_id][1] == title]
+
+    def oldest(self, title, count, borrower=None):
+        ids = (loan_id for loan_id in self.by_title.get(title, {})
+               if borrower is None or self.loans[loan_id][0] == borrower)
+        return list(islice(ids, count))
+
+    def overdue(self, now):
+        heap = self.due
+        found = []
+        frontier = [(heap[0], 0)] if heap else []
+        while frontier:
+            (due_at, loan_id), i = heappop(frontier)
+            if due_at > now:
+                break
+            if loan_id in self.loans:
+                found.append(self.get(loan_id))
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heappush(frontier, (heap[child], child))
+        return found
+
+
+# loans.txt is an append-only list of "open|id|lent_at|due_at|borrower|title"
+# and "close|id|returned_at" lines, read incrementally into a LoanLedger.
+# Ids are handed out under the storage lock after catching up with the file,
+# so processes never reuse one. Inside a batch the lines are buffered and
+# written with a single append at the end, or dropped if the batch fails.
+class LoanStore:
+    def __init__(self, filename=LOANS_FILE):
+        self.filename = filename
+        self.ledger = LoanLedger()
+        self.read_to = 0
+        self.pending = None
+
+    def refresh(self):
+        if not os.path.exists(self.filename):
+            return
+        if os.path.getsize(self.filename) < self.read_to:
+            self.ledger = LoanLedger()
+            self.read_to = 0
+        with open(self.filename, "rb") as f:
+            f.seek(self.read_to)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                self.replay(raw.decode("utf-8", errors="replace").rstrip("\r\n"))
+                self.read_to += len(raw)
+
+    def replay(self, line):
+        parts = line.split("|", 5)
+        if parts[0] == "open" and len(parts) == 6 and parts[1].isdigit():
+            self.ledger.open(int(parts[1]), parts[4], parts[5], parts[2], parts[3])
+        elif parts[0] == "close" and len(parts) >= 2 and parts[1].isdigit():
+            self.ledger.close(int(parts[1]))
+
+    def record(self, opened, closed):
+        # opened: [(borrower, title, lent_at, due_at)], closed: [(loan id, returned_at)].
+        self.refresh()
+        lines = []
+        for borrower, title, lent_at, due_at in opened:
+            loan_id = self.ledger.next_id
+            self.ledger.open(loan_id, borrower, title, lent_at, due_at)
+            lines.append(f"open|{loan_id}|{lent_at}|{due_at}|{borrower}|{title}\n")
+        for loan_id, returned_at in closed:
+            self.ledger.close(loan_id)
+            lines.append(f"close|{loan_id}|{returned_at}\n")
+        if self.pending is not None:
+            self.pending.extend(lines)
+        elif lines:
+            self.write(lines)
+
+    def write(self, lines):
+        with open(self.filename, "a") as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    @contextmanager
+    def batched(self):
+        if self.pending is not None:
+            yield
+            return
+        self.pending = []
+        try:
+            yield
+        except BaseException:
+            # The ledger already holds the dropped loans; read it back.
+            self.pending = None
+            self.ledger = LoanLedger()
+            self.read_to = 0
+            raise
+        pending, self.pending = self.pending, None
+        if pending:
+            self.write(pending)
+
+    def open_loans(self, borrower=None, title=None):
+        self.refresh()
+        return self.ledger.open_loans(borrower, title)
+
+    def oldest(self, title, count, borrower=None):
+        self.refresh()
+        return self.ledger.oldest(title, count, borrower)
+
+    def overdue(self, now):
+        self.refresh()
+        return self.ledger.overdue(now)
+
+# === Storage Backends ===
+# Library, the account functions and the request/activity stores only talk
+# to a backend through this small interface:
+#   locked() / load_books() / load_snapshot() / write_snapshot(catalog,
+#   index) / pull_changes() / record_change() / batched() /
+#   needs_compaction() / save_books(catalog) / generation() /
+#   load_users(role) / find_user(role, username) / save_user(...) and the
+#   .requests, .loans and .activity_log stores.
+# locked() is a re-entrant cross-process write lock. pull_changes() returns
+# the changes other processes made since the last call, or None when they
+# can no longer be replayed and the catalog has to be loaded again.
+# TextStorage keeps the original text files; SqliteStorage keeps everything
+# in one WAL-mode database. BOOK_STORAGE=sqlite selects the latter.
+def lock_file(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue  # LK_LOCK gives up after ~10 seconds; keep waiting
+
+
+def unlock_file(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# library.txt is a snapshot; every change since the snapshot is appended to
+# BOOK_JOURNAL as "seq|action|title|quantity" and replayed on startup. The
+# snapshot's first line records the last journal seq folded into it, so a
+# crash in the middle of a compaction never applies a record twice. Seqs
+# are consecutive, so a reader that finds a gap knows a compaction folded
+# records it has not seen and reloads instead, and a reader that finds a
+# new seq in the snapshot's first line knows the journal was replaced and
+# reads it from the start. Readers never take the lock;
+# writers hold LOCK_FILE only while they catch up and append one record.
+#
+# A branch shard (see BranchLibrary) keeps these catalog files in its own
+# directory and shares the requests, loans, log and accounts of the main
+# storage passed as `shared`.
+class TextStorage:
+    def __init__(self, directory="", shared=None):
+        self.book_db = os.path.join(directory, BOOK_DB)
+        self.journal_file = os.path.join(directory, BOOK_JOURNAL)
+        self.lock_path = os.path.join(directory, LOCK_FILE)
+        self.snapshot_file = os.path.join(directory, CATALOG_SNAPSHOT_FILE)
+        self.journal_seq = 0
+        self.journal_entries = 0
+        self.journal_offset = 0
+        self.journal_inode = None
+        self.loaded_snapshot_seq = 0
+        self.text_stamp = None  # (inode, size, mtime_ns, seq) of the library.txt loaded or written
+        self.lock_depth = 0
+        self.lock_handle = None
+        self.pending = None
+        if shared is not None:
+            self.requests, self.activity_log, self.loans = shared.requests, shared.activity_log, shared.loans
+            self.credentials = shared.credentials
+        else:
+            self.requests = RequestStore()
+            self.activity_log = ActivityLog()
+            self.loans = LoanStore()
+            self.credentials = {"manager": CredentialCache(MANAGER_DB), "customer": CredentialCache(USER_DB)}
+
+    @contextmanager
+    def locked(self):
+        if self.lock_depth == 0:
+            self.lock_handle = open(self.lock_path, "a+")
+            lock_file(self.lock_handle)
+        self.lock_depth += 1
+        try:
+            yield
+        finally:
+            self.lock_depth -= 1
+            if self.lock_depth == 0:
+                unlock_file(self.lock_handle)
+                self.lock_handle.close()
+                self.lock_handle = None
+
+    def snapshot_seq(self):
+        if not os.path.exists(self.book_db):
+            return 0
+        with open(self.book_db, "r") as f:
+            first = f.readline()
+        return int(first.strip().split("|")[1]) if first.startswith(SNAPSHOT_HEADER) else 0
+
+    def load_books(self):
+        self.journal_seq = 0
+        self.journal_entries = 0
+        self.journal_offset = 0
+        self.journal_inode = None
+        self.loaded_snapshot_seq = 0
+        self.text_stamp = None
+        if not os.path.exists(self.book_db):
+            return
+        perf.count("bytes read: catalog", os.path.getsize(self.book_db))
+        with open(self.book_db, "r") as f:
+            stat = os.fstat(f.fileno())
+            for line in f:
+                if line.startswith(SNAPSHOT_HEADER):
+                    self.journal_seq = int(line.strip().split("|")[1])
+                    self.loaded_snapshot_seq = self.journal_seq
+                    continue
+                parsed = Book.parse(line)
+                if parsed:
+                    yield parsed
+        self.text_stamp = (stat.st_ino, stat.st_size, stat.st_mtime_ns, self.loaded_snapshot_seq)
+
+    def load_snapshot(self):
+        # A CatalogSnapshot of the current library.txt, with the journal
+        # position it covers, or None if there is no up-to-date one. Two
+        # compactions can leave files with the same inode, size and (coarse)
+        # mtime, so the seq in the first line has to match as well.
+        try:
+            with open(self.book_db, "r") as f:
+                stat = os.fstat(f.fileno())
+                first = f.readline()
+        except FileNotFoundError:
+            return None
+        text_seq = int(first.strip().split("|")[1]) if first.startswith(SNAPSHOT_HEADER) else 0
+        snapshot = CatalogSnapshot.open(self.snapshot_file, (stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        if snapshot is None or snapshot.text_seq != text_seq:
+            return None
+        self.journal_seq = snapshot.journal_seq
+        self.journal_entries = snapshot.journal_entries
+        self.journal_offset = 0
+        self.journal_inode = None
+        self.loaded_snapshot_seq = snapshot.text_seq
+        self.text_stamp = (stat.st_ino, stat.st_size, stat.st_mtime_ns, snapshot.text_seq)
+        return snapshot
+
+    def write_snapshot(self, catalog, index):
+        # catalog must hold exactly the state up to journal_seq.
+        if self.text_stamp is not None:
+            CatalogSnapshot.write(self.snapshot_file, catalog, index,
+                                  self.text_stamp + (self.journal_seq, self.journal_entries))
+
+    def pull_changes(self):
+        text_seq = self.snapshot_seq()
+        if text_seq > self.journal_seq:
+            return None
+        if text_seq != self.loaded_snapshot_seq:
+            # library.txt was compacted since our journal position was taken,
+            # so the journal is a new file, possibly under the old one's inode
+            # number: read it from the start.
+            self.loaded_snapshot_seq = text_seq
+            self.journal_offset = 0
+            self.journal_inode = None
+        try:
+            f = open(self.journal_file, "rb")
+        except FileNotFoundError:
+            self.journal_offset = 0
+            self.journal_inode = None
+            return []
+        changes = []
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self.journal_inode or stat.st_size < self.journal_offset:
+                self.journal_offset = 0
+                self.journal_inode = stat.st_ino
+            f.seek(self.journal_offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # torn by a crash, or still being written
+                self.journal_offset += len(raw)
+                perf.count("bytes read: journal", len(raw))
+                parts = raw.decode("utf-8", errors="replace").rstrip("\r\n").split("|")
+                if len(parts) != 4 or not parts[0].isdigit() or not parts[3].isdigit():
+                    continue
+                seq = int(parts[0])
+                if seq <= self.journal_seq:
+                    continue
+                if seq != self.journal_seq + 1:
+                    return None  # a compaction folded records we never saw
+                self.journal_seq = seq
+                self.journal_entries += 1
+                changes.append((parts[1], parts[2], int(parts[3])))
+        return changes
+
+    def record_change(self, action, title, quantity):
+        # Callers hold locked() and have pulled every earlier change, so the
+        # next seq is free.
+        with self.locked():
+            self.journal_seq += 1
+            self.journal_entries += 1
+            record = f"{self.journal_seq}|{action}|{title}|{quantity}\n".encode("utf-8")
+            if self.pending is not None:
+                self.pending.append(record)
+            else:
+                self.append_records([record])
+
+    def append_records(self, records):
+        data = b"".join(records)
+        with open(self.journal_file, "ab") as f:
+            if f.tell() > self.journal_offset:
+                data = b"\n" + data  # seal off a line torn by a crashed writer
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            perf.count("bytes written: journal", len(data))
+            self.journal_offset = f.tell()
+            self.journal_inode = os.fstat(f.fileno()).st_ino
+
+    @contextmanager
+    def batched(self):
+        if self.pending is not None:
+            yield  # nested batch: the outer one writes everything
+            return
+        self.pending = []
+        seq, entries = self.journal_seq, self.journal_entries
+        written = False
+        try:
+            with self.loans.batched(), self.requests.batched(), self.activity_log.batched():
+                yield
+                # The journal goes first, still inside the other stores'
+                # batches: they write their lines only once it is on disk, and
+                # drop them if it could not be written.
+                pending, self.pending = self.pending, None
+                if pending:
+                    self.append_records(pending)
+                written = True
+        except BaseException:
+            self.pending = None  # a failed batch writes none of its records
+            if not written:
+                self.journal_seq, self.journal_entries = seq, entries
+            raise
+
+    def needs_compaction(self):
+        return self.journal_entries >= JOURNAL_COMPACT_EVERY
+
+    def generation(self):
+        # The library.txt the catalog was read from or last compacted to,
+        # down to the journal seq in its first line.
+        return self.text_stamp
+
+    def save_books(self, catalog):
+        # Compaction: write a full snapshot next to the old one, swap it in
+        # atomically, then drop the journal records it now contains.
+        with self.locked():
+            tmp_path = self.book_db + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(f"{SNAPSHOT_HEADER}{self.journal_seq}\n")
+                for line in catalog.lines():
+                    f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+                perf.count("bytes written: catalog", f.tell())
+                stat = os.fstat(f.fileno())
+            os.replace(tmp_path, self.book_db)
+            self.text_stamp = (stat.st_ino, stat.st_size, stat.st_mtime_ns, self.journal_seq)
+            self.loaded_snapshot_seq = self.journal_seq
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+            self.journal_entries = 0
+            self.journal_offset = 0
+            self.journal_inode = None
+
+    def load_users(self, role):
+        return self.credentials[role].get_users()
+
+    def find_user(self, role, username):
+        return self.credentials[role].get_users().get(username)
+
+    def save_user(self, username, password, role="customer"):
+        if role == "manager":
+            with open(MANAGER_DB, "a") as file:
+                file.write(f"{username},{password}\n")
+        else:
+            save_user(username, password)
+
+
+# Each book change also lands in the changes table inside the same
+# transaction; other processes replay it from there just like the text
+# journal. Old rows are pruned, and a process that fell behind the pruned
+# range reloads.
+class SqliteStorage:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS books (
+            title TEXT PRIMARY KEY,
+            quantity INTEGER NOT NULL,
+            is_lent INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY,
+            action TEXT NOT NULL,
+            title TEXT NOT NULL,
+            quantity INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL,
+            PRIMARY KEY (username, role)
+        );
+        CREATE TABLE IF NOT EXISTS requests (
+            id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            title TEXT NOT NULL,
+            requested_at TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending'
+        );
+        CREATE INDEX IF NOT EXISTS requests_by_username ON requests (username, id);
+        CREATE TABLE IF NOT EXISTS activity_log (
+            id INTEGER PRIMARY KEY,
+            entry TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS activity_log_by_time ON activity_log (entry);
+        CREATE TABLE IF NOT EXISTS activity_tokens (
+            token TEXT NOT NULL,
+            entry_id INTEGER NOT NULL,
+            PRIMARY KEY (token, entry_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS loans (
+            id INTEGER PRIMARY KEY,
+            borrower TEXT NOT NULL,
+            title TEXT NOT NULL,
+            lent_at TEXT NOT NULL,
+            due_at TEXT NOT NULL,
+            returned_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS open_loans_by_borrower ON loans (borrower, id) WHERE returned_at IS NULL;
+        CREATE INDEX IF NOT EXISTS open_loans_by_title ON loans (title, id) WHERE returned_at IS NULL;
+        CREATE INDEX IF NOT EXISTS open_loans_by_due ON loans (due_at) WHERE returned_at IS NULL;
+    """
+    # sqlite3 caches compiled statements per connection, so keeping the SQL
+    # text constant makes these prepared statements.
+    ADD_SQL = ("INSERT INTO books (title, quantity, is_lent) VALUES (?, ?, 0) "
+               "ON CONFLICT (title) DO UPDATE SET quantity = quantity + excluded.quantity")
+    LEND_SQL = "UPDATE books SET is_lent = is_lent + ? WHERE title = ?"
+    RETURN_SQL = "UPDATE books SET is_lent = is_lent - ? WHERE title = ?"
+    CHANGE_SQL = "INSERT INTO changes (action, title, quantity) VALUES (?, ?, ?)"
+    SAVE_SQL = ("INSERT INTO books (title, quantity, is_lent) VALUES (?, ?, ?) "
+                "ON CONFLICT (title) DO UPDATE SET quantity = excluded.quantity, is_lent = excluded.is_lent")
+
+    def __init__(self, path=SQLITE_DB, shared=None):
+        # The connection is opened by whichever thread first asks for storage
+        # but the GUI then uses it only from its PersistenceWorker thread. A
+        # branch shard has a database of its own for its books and changes
+        # and uses the stores of the `shared` main database for the rest.
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        if "status" not in [row[1] for row in self.conn.execute("PRAGMA table_info(requests)")]:
+            self.conn.execute("ALTER TABLE requests ADD COLUMN status TEXT NOT NULL DEFAULT 'pending'")
+        # The per-title FIFO of pending requests is this index.
+        self.conn.execute("CREATE INDEX IF NOT EXISTS requests_pending ON requests (status, title, id)")
+        self.lock_depth = 0
+        self.last_seq = 0
+        self.changes_since_prune = 0
+        if shared is not None:
+            self.requests, self.activity_log, self.loans = shared.requests, shared.activity_log, shared.loans
+        else:
+            self.requests = SqliteRequestStore(self.conn, self.locked)
+            self.activity_log = SqliteActivityLog(self.conn, self.locked)
+            self.loans = SqliteLoanStore(self.conn, self.locked)
+
+    @contextmanager
+    def locked(self):
+        # BEGIN IMMEDIATE takes SQLite's write lock; readers are not blocked
+        # in WAL mode.
+        if self.lock_depth == 0:
+            self.conn.execute("BEGIN IMMEDIATE")
+        self.lock_depth += 1
+        try:
+            yield
+        except BaseException:
+            self.lock_depth -= 1
+            if self.lock_depth == 0:
+                self.conn.rollback()
+                if self.activity_log.conn is self.conn:
+                    self.activity_log.rolled_back()
+            raise
+        self.lock_depth -= 1
+        if self.lock_depth == 0:
+            self.conn.commit()
+
+    def load_books(self):
+        # One read transaction, so last_seq matches the rows exactly.
+        own_transaction = not self.conn.in_transaction
+        if own_transaction:
+            self.conn.execute("BEGIN")
+        self.last_seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        rows = self.conn.execute("SELECT title, quantity, is_lent FROM books ORDER BY rowid").fetchall()
+        if own_transaction:
+            self.conn.commit()
+        return rows
+
+    def load_snapshot(self):
+        return None  # the database already opens without parsing anything
+
+    def write_snapshot(self, catalog, index):
+        pass
+
+    def pull_changes(self):
+        rows = self.conn.execute("SELECT seq, action, title, quantity FROM changes WHERE seq > ? ORDER BY seq",
+                                 (self.last_seq,)).fetchall()
+        if rows and rows[0][0] != self.last_seq + 1:
+            return None
+        if rows:
+            self.last_seq = rows[-1][0]
+        return [(action, title, quantity) for _, action, title, quantity in rows]
+
+    def record_change(self, action, title, quantity):
+        with self.locked():
+            if action == "add":
+                self.conn.execute(self.ADD_SQL, (title, quantity))
+            elif action == "lend":
+                self.conn.execute(self.LEND_SQL, (quantity, title))
+            elif action == "return":
+                self.conn.execute(self.RETURN_SQL, (quantity, title))
+            self.last_seq = self.conn.execute(self.CHANGE_SQL, (action, title, quantity)).lastrowid
+            self.changes_since_prune += 1
+            if self.changes_since_prune >= CHANGE_LOG_PRUNE_EVERY:
+                self.conn.execute("DELETE FROM changes WHERE seq <= ?", (self.last_seq - CHANGE_LOG_KEEP,))
+                self.changes_since_prune = 0
+
+    def needs_compaction(self):
+        return False
+
+    def generation(self):
+        # Never compacted; rows only change through logged changes.
+        return self.last_seq
+
+    def batched(self):
+        return nullcontext()  # locked() already makes it one transaction
+
+    def save_books(self, catalog):
+        with self.locked():
+            self.conn.executemany(self.SAVE_SQL, zip(catalog.titles, catalog.quantity, catalog.is_lent))
+
+    def load_users(self, role):
+        return dict(self.conn.execute("SELECT username, password FROM users WHERE role = ?", (role,)))
+
+    def find_user(self, role, username):
+        row = self.conn.execute("SELECT password FROM users WHERE username = ? AND role = ?",
+                                (username, role)).fetchone()
+        return row[0] if row else None
+
+    def save_user(self, username, password, role="customer"):
+        with self.locked():
+            self.conn.execute("INSERT OR REPLACE INTO users (username, password, role) VALUES (?, ?, ?)",
+                              (username, password, role))
+
+
+class SqliteRequestStore:
+    RECENT_LIMIT = 50
+
+    def __init__(self, conn, locked):
+        self.conn = conn
+        self.locked = locked  # the storage's write lock, so status updates join its transaction
+        self.recent = deque(maxlen=self.RECENT_LIMIT)
+        self.counts = RequestCounts()
+        self.count = 0
+        self.last_id = None
+
+    def refresh(self):
+        if self.last_id is None:
+            # First call: count everything up to the current last row once,
+            # then only read rows past it.
+            self.last_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM requests").fetchone()[0]
+            for title, n in self.conn.execute("SELECT title, COUNT(*) FROM requests WHERE id <= ? "
+                                              "GROUP BY title", (self.last_id,)):
+                self.counts.add(title, n)
+                self.count += n
+            rows = self.conn.execute("SELECT username, title, requested_at FROM requests WHERE id <= ? "
+                                     "ORDER BY id DESC LIMIT ?", (self.last_id, self.RECENT_LIMIT)).fetchall()
+            lines = [f"{username}|{title}|{timestamp}" for username, title, timestamp in reversed(rows)]
+            self.recent.extend(lines)
+            return lines
+        rows = self.conn.execute("SELECT id, username, title, requested_at FROM requests "
+                                 "WHERE id > ? ORDER BY id", (self.last_id,)).fetchall()
+        new_lines = []
+        for row_id, username, title, timestamp in rows:
+            line = f"{username}|{title}|{timestamp}"
+            self.recent.append(line)
+            self.count += 1
+            self.counts.add(title)
+            new_lines.append(line)
+            self.last_id = row_id
+        return new_lines
+
+    def most_requested(self):
+        return self.counts.most_requested()
+
+    def add(self, username, title, timestamp):
+        with self.locked():
+            self.conn.execute("INSERT INTO requests (username, title, requested_at) VALUES (?, ?, ?)",
+                              (username, title, timestamp))
+
+    def state(self, request_id):
+        row = self.conn.execute("SELECT status FROM requests WHERE id = ?", (request_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def get(self, request_id):
+        return self.conn.execute("SELECT username, title, requested_at, status FROM requests WHERE id = ?",
+                                 (request_id,)).fetchone()
+
+    def pending_by_title(self):
+        rows = self.conn.execute("SELECT title, id, username FROM requests WHERE status = 'pending' "
+                                 "ORDER BY title, id")
+        for title, group in groupby(rows, key=lambda row: row[0]):
+            yield title, [(request_id, username) for _, request_id, username in group]
+
+    def set_status(self, updates):
+        with self.locked():
+            self.conn.executemany("UPDATE requests SET status = ? WHERE id = ?",
+                                  ((state, request_id) for request_id, state in updates))
+
+    def user_requests(self, username):
+        return self.conn.execute("SELECT username, title, requested_at, status FROM requests "
+                                 "WHERE username = ? ORDER BY id", (username,)).fetchall()
+
+
+class SqliteActivityLog:
+    def __init__(self, conn, locked, keep=50):
+        self.conn = conn
+        self.locked = locked  # the storage's write lock: a commit of our own would end an open batch
+        self.keep = keep
+        self.recent = None
+        self.count = 0
+        self.indexed_to = -1  # highest entry id known to be indexed, once a query has caught up
+
+    @property
+    def entries(self):
+        if self.recent is None:
+            rows = self.conn.execute("SELECT entry FROM activity_log ORDER BY id DESC LIMIT ?",
+                                     (self.keep,)).fetchall()
+            self.recent = deque((entry for entry, in reversed(rows)), maxlen=self.keep)
+            self.count = len(self.recent)
+        return self.recent
+
+    def append(self, entry):
+        entries = self.entries  # the tail, read before the new row is in it
+        with self.locked():
+            row_id = self.conn.execute("INSERT INTO activity_log (entry) VALUES (?)", (entry,)).lastrowid
+            if row_id == self.indexed_to + 1:
+                self.index_entries([(row_id, entry)])
+                self.indexed_to = row_id
+        entries.append(entry)
+        self.count += 1
+
+    def rolled_back(self):
+        # The transaction that appended entries was rolled back; the tail
+        # is read again when next needed.
+        self.recent = None
+        self.indexed_to = -1
+
+    # activity_tokens is the same inverted index as the text backend's
+    # ActivityIndex. Every entry up to its highest entry_id is indexed: a
+    # process only adds an entry's tokens if it knows all before it are in,
+    # and otherwise leaves it for the next query to catch up.
+    def index_entries(self, rows):
+        self.conn.executemany("INSERT OR IGNORE INTO activity_tokens (token, entry_id) VALUES (?, ?)",
+                              ((token, row_id) for row_id, entry in rows for token in entry_tokens(entry)))
+
+    def catch_up(self):
+        with self.locked():
+            last = self.conn.execute("SELECT COALESCE(MAX(entry_id), 0) FROM activity_tokens").fetchone()[0]
+            rows = self.conn.execute("SELECT id, entry FROM activity_log WHERE id > ? ORDER BY id",
+                                     (last,)).fetchall()
+            self.index_entries(rows)
+            self.indexed_to = rows[-1][0] if rows else last
+
+    @perf.timed("SqliteActivityLog.query")
+    def query(self, user=None, text=None, since=None, until=None, limit=None):
+        # Same arguments and order as ActivityLog.query. The timestamp
+        # prefix makes a time range a range of the entry column's index.
+        self.catch_up()
+        tokens = query_words(text or "")
+        if user:
+            tokens.append("@" + user)
+        sql = ["SELECT entry FROM activity_log WHERE 1"]
+        params = []
+        for token in set(tokens):
+            sql.append("AND id IN (SELECT entry_id FROM activity_tokens WHERE token = ?)")
+            params.append(token)
+        if since:
+            sql.append("AND entry >= ?")
+            params.append("[" + since)
+        if until:
+            sql.append("AND entry < ?")
+            params.append("[" + until + "\U0010ffff")
+        sql.append("ORDER BY id DESC LIMIT ?")
+        params.append(limit or -1)
+        return [entry for entry, in self.conn.execute(" ".join(sql), params)]
+
+
+# The loan ledger as a table; the partial indexes over open loans play the
+# part of LoanLedger's dicts and due-date heap.
+class SqliteLoanStore:
+    COLUMNS = "SELECT id, borrower, title, lent_at, due_at FROM loans WHERE returned_at IS NULL"
+
+    def __init__(self, conn, locked):
+        self.conn = conn
+        self.locked = locked
+
+    def refresh(self):
+        pass
+
+    def record(self, opened, closed):
+        with self.locked():
+            self.conn.executemany("INSERT INTO loans (borrower, title, lent_at, due_at) VALUES (?, ?, ?, ?)", opened)
+            self.conn.executemany("UPDATE loans SET returned_at = ? WHERE id = ?",
+                                  ((returned_at, loan_id) for loan_id, returned_at in closed))
+
+    def open_loans(self, borrower=None, title=None):
+        if borrower is not None and title is not None:
+            return self.conn.execute(self.COLUMNS + " AND borrower = ? AND title = ? ORDER BY id",
+                                     (borrower, title)).fetchall()
+        if borrower is not None:
+            return self.conn.execute(self.COLUMNS + " AND borrower = ? ORDER BY id", (borrower,)).fetchall()
+        if title is not None:
+            return self.conn.execute(self.COLUMNS + " AND title = ? ORDER BY id", (title,)).fetchall()
+        return self.conn.execute(self.COLUMNS + " ORDER BY id").fetchall()
+
+    def oldest(self, title, count, borrower=None):
+        if borrower is None:
+            rows = self.conn.execute("SELECT id FROM loans WHERE returned_at IS NULL AND title = ? "
+                                     "ORDER BY id LIMIT ?", (title, count))
+        else:
+            rows = self.conn.execute("SELECT id FROM loans WHERE returned_at IS NULL AND title = ? "
+                                     "AND borrower = ? ORDER BY id LIMIT ?", (title, borrower, count))
+        return [loan_id for loan_id, in rows]
+
+    def overdue(self, now):
+        return self.conn.execute(self.COLUMNS + " AND due_at <= ? ORDER BY due_at", (now,)).fetchall()
+
+
+_default_storage = None
+
+
+def default_storage():
+    global _default_storage
+    if _default_storage is None:
+        _default_storage = SqliteStorage() if STORAGE_BACKEND == "sqlite" else TextStorage()
+    return _default_storage
+
+
+def migrate_text_to_sqlite(path=SQLITE_DB):
+    # One-shot copy of the text files into a new SQLite database, all in one
+    # transaction: a failure leaves the database empty, and a database that
+    # already holds data is refused rather than given a second copy.
+    text = TextStorage()
+    library = Library(text)
+    target = SqliteStorage(path)
+    with target.locked():
+        for table in ("books", "changes", "users", "requests", "activity_log", "loans"):
+            if target.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                raise LendingError(f"{path} already holds library data ({table}); migrate into a new database.")
+        target.save_books(library.books)
+        for role in ("manager", "customer"):
+            target.conn.executemany("INSERT OR REPLACE INTO users (username, password, role) VALUES (?, ?, ?)",
+                                    ((u, p, role) for u, p in text.load_users(role).items()))
+        if os.path.exists(REQUESTS_FILE):
+            text.requests.refresh()
+            with open(REQUESTS_FILE, "r") as f:
+                requests = (r for r in map(parse_request, f) if r)
+                target.conn.executemany(
+                    "INSERT INTO requests (username, title, requested_at, status) VALUES (?, ?, ?, ?)",
+                    (request + (text.requests.state(request_id) or "pending",)
+                     for request_id, request in enumerate(requests, start=1)))
+        if os.path.exists(ACTIVITY_LOG_FILE):
+            with open(ACTIVITY_LOG_FILE, "r") as f:
+                target.conn.executemany("INSERT INTO activity_log (entry) VALUES (?)",
+                                        ((line.strip(),) for line in f if line.strip()))
+        target.conn.executemany("INSERT INTO loans (id, borrower, title, lent_at, due_at) VALUES (?, ?, ?, ?, ?)",
+                                text.loans.open_loans())
+    return target
+
+
+# === Library Service ===
+# The rules behind the GUI buttons, with no dialogs attached, so the GUI,
+# the command line and batch jobs all go through the same checks and the
+# same activity log. A refused action raises LendingError with the message
+# to show the user.
+class LendingError(Exception):
+    pass
+
+
+def clean_title(title):
+    # Titles are stored in "|"-separated, one-record-per-line files.
+    title = title.strip()
+    if not title:
+        raise LendingError("Title cannot be empty.")
+    if "|" in title or "\n" in title or "\r" in title:
+        raise LendingError('Title cannot contain "|" or line breaks.')
+    return title
+
+
+def check_quantity(quantity):
+    if quantity < 1:
+        raise LendingError("Quantity must be at least 1.")
+
+
+def format_log_entry(username, action_text):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return f"[{timestamp}] ({username or 'Unknown'}) {action_text}"
+
+
+class LibraryService:
+    def __init__(self, library=None, username=None):
+        self.library = library or shared_library()
+        self.storage = self.library.storage
+        self.username = username
+
+    @perf.timed("LibraryService.log_activity")
+    def log_activity(self, action_text):
+        self.storage.activity_log.append(format_log_entry(self.username, action_text))
+
+    def add_book(self, title, quantity):
+        title = clean_title(title)
+        check_quantity(quantity)
+        self.library.add_book(title, quantity)
+        self.log_activity(f"Added {quantity} copies of '{title}'.")
+
+    def lend_book(self, title, quantity=1, borrower=None, days=LOAN_DAYS):
+        check_quantity(quantity)
+        book = self.library.books.get(title)
+        if book is None:
+            raise LendingError("Book not found.")
+        with self.storage.locked():
+            lent = self.library.lend_book(title, quantity)
+            if not lent and isinstance(self.library, BranchLibrary) and book.available() >= quantity:
+                raise LendingError(f"No single branch has {quantity} copies available.")
+            if not lent:
+                raise LendingError(f"Only {book.available()} copies available.")
+            self.open_loans(title, [borrower] * quantity, days)
+        to = f" to {borrower}" if borrower else ""
+        at = f" (from {lent})" if isinstance(lent, str) else ""  # the branch, with a BranchLibrary
+        self.log_activity(f'Lent {quantity} copies of "{title}"{to}{at}.')
+
+    def return_book(self, title, quantity=1, borrower=None):
+        check_quantity(quantity)
+        book = self.library.books.get(title)
+        if book is None:
+            raise LendingError("Book not found.")
+        with self.storage.locked():
+            loans = self.loans_to_close(title, quantity, borrower)
+            returned = self.library.return_book(title, quantity)
+            if not returned:
+                raise LendingError(f"Only {book.is_lent} copies can be returned.")
+            self.close_loans(loans)
+        at = f" (to {returned})" if isinstance(returned, str) else ""
+        self.log_activity(f'Returned {quantity} copies of "{title}"{at}.')
+
+    def open_loans(self, title, borrowers, days=LOAN_DAYS):
+        # One loan per copy; call with the storage lock held, after lending.
+        now = datetime.now()
+        lent_at = now.strftime("%Y-%m-%d %H:%M:%S")
+        due_at = (now + timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+        self.storage.loans.record([(borrower or "", title, lent_at, due_at) for borrower in borrowers], [])
+
+    def loans_to_close(self, title, quantity, borrower=None):
+        # The oldest open loans of the title (of that borrower, if given).
+        # Copies lent before loans were recorded have none, so without a
+        # borrower fewer than `quantity` is fine.
+        loans = self.storage.loans.oldest(title, quantity, borrower)
+        if borrower and len(loans) < quantity:
+            raise LendingError(f"{borrower} has only {len(loans)} copies of '{title}' on loan.")
+        return loans
+
+    def close_loans(self, loan_ids):
+        returned_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.storage.loans.record([], [(loan_id, returned_at) for loan_id in loan_ids])
+
+    def overdue_loans(self, now=None):
+        # (loan id, borrower, title, lent_at, due_at), most overdue first.
+        now = (now or datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
+        return self.storage.loans.overdue(now)
+
+    def borrower_loans(self, borrower):
+        return self.storage.loans.open_loans(borrower=borrower)
+
+    def request_book(self, title):
+        self.library.sync()
+        book = self.library.find_book(title)
+        if book is None:
+            raise LendingError("Book not found.")
+        # Requests for titles with no copies left wait in the title's queue.
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.storage.requests.add(self.username, book.title, timestamp)
+        return book
+
+    def change_request(self, request_id, state):
+        # approved lends one copy to the requester; rejected and fulfilled
+        # only close the request. Returns the request's title.
+        store = self.storage.requests
+        with self.storage.locked():
+            self.library.sync()
+            store.refresh()
+            current = store.state(request_id)
+            if current is None:
+                raise LendingError(f"No request #{request_id}.")
+            if state not in REQUEST_TRANSITIONS.get(current, ()):
+                raise LendingError(f"Request #{request_id} is already {current}.")
+            username, title = store.get(request_id)[:2]
+            if state == "approved":
+                if not self.library.lend_book(title):
+                    raise LendingError(f"No copies of '{title}' are available.")
+                self.open_loans(title, [username])
+            store.set_status([(request_id, state)])
+        self.log_activity(f"Marked request #{request_id} for '{title}' as {state}.")
+        return title
+
+    def approve_fulfillable(self):
+        # Walks every title's pending FIFO once and approves as many of the
+        # oldest requests as there are copies on the shelf, all inside one
+        # batch: a single SQLite transaction, or one journal append plus one
+        # status-file append under the same lock with the text files.
+        # Returns how many requests were approved.
+        store = self.storage.requests
+        approved = []
+        with self.library.batch():
+            store.refresh()
+            for title, requests in store.pending_by_title():
+                book = self.library.books.get(title)
+                count = min(book.available(), len(requests)) if book is not None else 0
+                if count > 0:
+                    self.library.record_change("lend", title, count)
+                    self.open_loans(title, [username for _, username in requests[:count]])
+                    approved.extend(request_id for request_id, _ in requests[:count])
+            if approved:
+                store.set_status([(request_id, "approved") for request_id in approved])
+        if approved:
+            self.log_activity(f"Approved {len(approved)} pending requests.")
+        return len(approved)
+
+    def import_csv(self, path):
+        # "title,quantity" rows; a header row and blank rows are skipped.
+        # Returns (copies added, [error messages]).
+        added = 0
+        errors = []
+        with open(path, "r", newline="", encoding="utf-8") as f, self.library.batch():
+            for line_no, row in enumerate(csv.reader(f), start=1):
+                if not row or not row[0].strip():
+                    continue
+                title = row[0].strip()
+                quantity = row[1].strip() if len(row) > 1 else "1"
+                if not quantity.isdigit() or int(quantity) < 1:
+                    if line_no > 1:
+                        errors.append(f"line {line_no}: bad quantity {quantity!r}")
+                    continue
+                try:
+                    title = clean_title(title)
+                except LendingError as error:
+                    errors.append(f"line {line_no}: {error}")
+                    continue
+                self.library.add_book(title, int(quantity))
+                added += int(quantity)
+        self.log_activity(f"Imported {added} copies from '{os.path.basename(path)}'.")
+        return added, errors
+
+    def apply_events(self, path):
+        # "lend|return,title[,quantity[,borrower]]" rows applied under one
+        # lock and one write. Events that break a rule are skipped and
+        # reported. Returns (events applied, [error messages]).
+        applied = 0
+        errors = []
+        actions = {"lend": self.lend_event, "return": self.return_event}
+        with open(path, "r", newline="", encoding="utf-8") as f, self.library.batch():
+            for line_no, row in enumerate(csv.reader(f), start=1):
+                if not row or not row[0].strip():
+                    continue
+                action = row[0].strip().lower()
+                title = row[1].strip() if len(row) > 1 else ""
+                quantity = row[2].strip() if len(row) > 2 else "1"
+                borrower = row[3].strip() if len(row) > 3 else ""
+                if action not in actions or not title or not quantity.isdigit() or int(quantity) < 1:
+                    if line_no > 1:
+                        errors.append(f"line {line_no}: cannot parse {','.join(row)!r}")
+                    continue
+                if actions[action](title, int(quantity), borrower or None):
+                    applied += 1
+                else:
+                    errors.append(f"line {line_no}: cannot {action} {quantity} of {title!r}")
+        self.log_activity(f"Applied {applied} lend/return events from '{os.path.basename(path)}'.")
+        return applied, errors
+
+    def lend_event(self, title, quantity, borrower):
+        if not self.library.lend_book(title, quantity):
+            return False
+        self.open_loans(title, [borrower] * quantity)
+        return True
+
+    def return_event(self, title, quantity, borrower):
+        try:
+            loans = self.loans_to_close(title, quantity, borrower)
+        except LendingError:
+            return False
+        if not self.library.return_book(title, quantity):
+            return False
+        self.close_loans(loans)
+        return True
+
+    def report(self):
+        books = self.library.books
+        return {
+            "titles": len(books),
+            "copies": books.copies,
+            "lent": books.lent,
+            "available": books.total_available(),
+            "out_of_stock": books.out_of_stock,
+        }
+
+# === Persistence Worker ===
+# A GUI hands every disk operation to this one background thread so the Tk
+# event loop never waits on the lock, an fsync or a file read. The thread
+# owns the Library's changes (lends, syncs, the catalog load); the UI thread
+# only reads the in-memory catalog.
+#
+# submit(work, done, key, write) queues a call; done(result, error) runs
+# later on the UI thread. Jobs that share a key are coalesced, so only the
+# newest pending one runs (a second dashboard read or sync queued behind
+# the first is dropped). Consecutive write jobs run together inside one
+# Library.batch(), so a burst of clicks costs one lock, one journal append
+# and at most one compaction. Results, errors and Library notifications are
+# queued up and handed over when the UI thread calls deliver(), e.g. from a
+# Tk after() loop.
+class PersistenceWorker:
+    def __init__(self, library, on_error=None):
+        self.library = library
+        self.on_error = on_error  # done callback for jobs submitted without one
+        self.jobs = queue.Queue()
+        self.held = deque()  # reads taken off the queue while gathering writes
+        self.latest = {}
+        self.results = queue.Queue()
+        self.listeners = []
+        library.subscribe(self.forward)
+        self.thread = threading.Thread(target=self.run, name="persistence", daemon=True)
+        self.thread.start()
+
+    def submit(self, work, done=None, key=None, write=False):
+        job = (work, done, key, write)
+        if key is not None:
+            self.latest[key] = job
+        self.jobs.put(job)
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def forward(self, action, book):
+        # Library notifications can fire on either thread; listeners only ever
+        # see them on the UI thread.
+        self.results.put((self.notify, (action, None if book is None else book.title)))
+
+    def notify(self, action, title):
+        book = self.library.books.get(title) if title is not None else None
+        for listener in list(self.listeners):
+            listener(action, book)
+
+    def deliver(self):
+        while True:
+            try:
+                callback, args = self.results.get_nowait()
+            except queue.Empty:
+                return
+            callback(*args)
+
+    def next_job(self):
+        return self.held.popleft() if self.held else self.jobs.get()
+
+    def run(self):
+        while True:
+            job = self.next_job()
+            work, done, key, write = job
+            if key is not None and self.latest.get(key) is not job:
+                continue  # superseded by a newer job with the same key
+            if not write:
+                self.finish(done, *self.call(work))
+                continue
+            writes = [job]
+            while not self.held:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job[3]:
+                    writes.append(job)
+                else:
+                    self.held.append(job)
+            self.run_writes(writes)
+
+    def run_writes(self, writes):
+        outcomes = []
+        try:
+            with self.library.batch():
+                for work, done, key, write in writes:
+                    outcomes.append((done,) + self.call(work))
+        except Exception as error:
+            # The batch could not be locked or flushed: none of it was saved.
+            outcomes = [(done, None, error) for work, done, key, write in writes]
+        for done, result, error in outcomes:
+            self.finish(done, result, error)
+
+    @staticmethod
+    def call(work):
+        try:
+            return work(), None
+        except Exception as error:
+            return None, error
+
+    def finish(self, done, result, error):
+        if done is not None:
+            self.results.put((done, (result, error)))
+        elif error is not None and self.on_error is not None:
+            self.results.put((self.on_error, (error,)))
+
+# === Command Line ===
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+    return number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m booklending", description="Book lending without the GUI.")
+    parser.add_argument("--user", default="cli", help="name recorded in the activity log")
+    parser.add_argument("--perf", action="store_true", help="print hot-path timings to stderr when done")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_cmd = commands.add_parser("import", help="add books from a title,quantity CSV file")
+    import_cmd.add_argument("path")
+    apply_cmd = commands.add_parser("apply", help="apply a CSV file of lend/return events")
+    apply_cmd.add_argument("path")
+    for name in ("lend", "return"):
+        cmd = commands.add_parser(name, help=f"{name} copies of one title")
+        cmd.add_argument("title")
+        cmd.add_argument("--quantity", type=positive_int, default=1)
+        cmd.add_argument("--borrower", help="who has the copies (closes their loans on return)")
+        if name == "lend":
+            cmd.add_argument("--days", type=positive_int, default=LOAN_DAYS, help="loan period in days")
+    commands.add_parser("overdue", help="list loans past their due date")
+    log_cmd = commands.add_parser("log", help="search the activity log, newest first")
+    log_cmd.add_argument("--user", dest="log_user", help="entries by this user")
+    log_cmd.add_argument("--text", help="entries containing all of these words")
+    log_cmd.add_argument("--since", help="from this timestamp prefix on (e.g. 2025-05-13)")
+    log_cmd.add_argument("--until", help="up to and including this timestamp prefix")
+    log_cmd.add_argument("--limit", type=int, default=100)
+    availability_cmd = commands.add_parser("availability", help="copies of one title at each branch")
+    availability_cmd.add_argument("title")
+    commands.add_parser("report", help="print catalog totals")
+    commands.add_parser("approve-requests", help="approve every pending request that has a copy on the shelf")
+    mark_cmd = commands.add_parser("mark-request", help="approve, reject or fulfil one request")
+    mark_cmd.add_argument("request_id", type=int)
+    mark_cmd.add_argument("state", choices=["approved", "rejected", "fulfilled"])
+    commands.add_parser("migrate-sqlite", help=f"copy the text data files into {SQLITE_DB}")
+    args = parser.parse_args(argv)
+    if args.perf:
+        perf.enabled = True
+        try:
+            return run_command(args)
+        finally:
+            print(perf.report(), file=sys.stderr)
+    return run_command(args)
+
+
+def run_command(args):
+    try:
+        if args.command == "migrate-sqlite":
+            migrate_text_to_sqlite()
+            print(f"Copied the text data files into {SQLITE_DB}.")
+            return 0
+        service = LibraryService(username=args.user)
+        if args.command == "import":
+            added, errors = service.import_csv(args.path)
+            print(f"Added {added} copies.")
+        elif args.command == "apply":
+            applied, errors = service.apply_events(args.path)
+            print(f"Applied {applied} events.")
+        elif args.command == "lend":
+            service.lend_book(args.title, args.quantity, args.borrower, args.days)
+            errors = []
+            print(f"Lent {args.quantity} copies of {args.title!r}.")
+        elif args.command == "return":
+            service.return_book(args.title, args.quantity, args.borrower)
+            errors = []
+            print(f"Returned {args.quantity} copies of {args.title!r}.")
+        elif args.command == "approve-requests":
+            errors = []
+            print(f"Approved {service.approve_fulfillable()} requests.")
+        elif args.command == "overdue":
+            errors = []
+            for loan_id, borrower, title, lent_at, due_at in service.overdue_loans():
+                print(f"#{loan_id}  due {due_at}  {borrower or '(not recorded)'}  {title}")
+        elif args.command == "log":
+            errors = []
+            for entry in service.storage.activity_log.query(args.log_user, args.text, args.since, args.until,
+                                                            args.limit):
+                print(entry)
+        elif args.command == "availability":
+            errors = []
+            library = service.library
+            if not isinstance(library, BranchLibrary):
+                raise LendingError(f"No branches are set up ({BRANCHES_FILE} is missing).")
+            branches = library.availability(args.title)
+            if not branches:
+                raise LendingError("Book not found.")
+            for name, distance, book in branches:
+                print(f"{name:<20} {distance:>7.1f} km  {book.available()} of {book.quantity} available")
+        elif args.command == "mark-request":
+            errors = []
+            title = service.change_request(args.request_id, args.state)
+            print(f"Request #{args.request_id} for {title!r} is now {args.state}.")
+        else:
+            for name, value in service.report().items():
+                print(f"{name.replace('_', ' ').capitalize()}: {value}")
+            errors = []
+    except LendingError as error:
+        print(f"Error: {error}", file=sys.stderr)
+        return 1
+    for error in errors:
+        print(f"Skipped {error}", file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
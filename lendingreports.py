@@ -0,0 +1,401 @@
+"""Streaming reports over the request and activity history.
+
+Reads requests.txt (with request_status.txt) and the activity log, rotated
+segments included, a chunk at a time, so memory grows with the number of
+distinct titles, users and hours, not with the size of the files. Large
+files are cut into line-aligned segments that a process pool scans in
+parallel; each worker sends back partial counts that are merged at the end.
+Smaller histories are scanned in-process, as starting the pool would cost
+more than it saves.
+
+    python -m lendingreports
+    python -m lendingreports --workers 8 --top 20
+    python -m lendingreports --json > report.json
+
+With BOOK_STORAGE=sqlite the same report is read from library.db instead.
+"""
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from urllib.request import pathname2url
+
+from booklending import SqliteStorage, default_storage, perf
+
+# === CONFIG ===
+CHUNK_BYTES = 4 * 1024 * 1024  # read per batch
+CHUNK_ROWS = 50000  # rows per batch from SQLite
+SEGMENT_BYTES = 64 * 1024 * 1024  # files are split into pieces of about this size
+POOL_MIN_BYTES = 2 * SEGMENT_BYTES  # less history than this is scanned without a process pool
+REPORT_TOP = 10
+OPEN_STATES = ("pending", "approved")
+
+# === Reading ===
+# A segment is (path, start, end): the lines that start in [start, end).
+# A segment that begins mid-line leaves that line to the one before it, so
+# every line is read exactly once however the file is cut. Rotated .gz logs
+# can't be seeked into and are always one segment.
+def segments(path, size=SEGMENT_BYTES):
+    if not os.path.exists(path):
+        return []
+    if path.endswith(".gz"):
+        return [(path, 0, None)]
+    total = os.path.getsize(path)
+    step = max(1, -(-total // max(1, -(-total // size))))
+    return [(path, start, min(total, start + step)) for start in range(0, total, step)]
+
+
+def read_batches(path, start=0, end=None, chunk_bytes=CHUNK_BYTES):
+    # Yields lists of complete lines. A half-written last line is left for
+    # the next run, as the stores do.
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        if start:
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while end is None or pos < end:
+            data = f.read(chunk_bytes if end is None else min(chunk_bytes, end - pos))
+            if not data:
+                break
+            if not data.endswith(b"\n"):
+                data += f.readline()
+            pos += len(data)
+            perf.count("bytes read: reports", len(data))
+            lines = data.decode("utf-8", errors="replace").split("\n")
+            lines.pop()  # "" after the last newline, or a half-written line
+            yield lines
+
+
+# === Columnar Batches ===
+# Each batch of lines is split into one list per field, and the counting is
+# done a column at a time with Counter.update, which loops in C, rather than
+# field by field in Python. Hours are "YYYY-MM-DD HH" prefixes of the
+# timestamps, so they sort and group as plain strings.
+def request_columns(lines):
+    # The same lines parse_request accepts, in the same order, so the n-th
+    # row here is request #n.
+    users, titles, hours = [], [], []
+    for line in lines:
+        user, sep, rest = line.strip().partition("|")
+        title, sep, timestamp = rest.rpartition("|")
+        if sep:
+            users.append(user)
+            titles.append(title)
+            hours.append(timestamp[:13])
+    return users, titles, hours
+
+
+def activity_columns(lines):
+    # Lend and return lines only: "[timestamp] (user) Lent 2 copies of
+    # "Title" to borrower." and "... Returned 1 copies of "Title"."
+    # (a branch chain adds " (from branch)" / " (to branch)" before the dot).
+    lend_hours, lend_copies, borrowers, borrower_copies = [], [], [], []
+    return_hours, return_copies = [], []
+    for line in lines:
+        if not line.startswith("["):
+            continue
+        _, sep, action = line.partition(") ")
+        if not sep:
+            continue
+        lent = action.startswith("Lent ")
+        if not lent and not action.startswith("Returned "):
+            continue
+        try:
+            copies = int(action.split(" ", 2)[1])
+        except (IndexError, ValueError):
+            continue
+        if lent:
+            lend_hours.append(line[1:14])
+            lend_copies.append(copies)
+            _, to, borrower = action.rstrip().rpartition('" to ')
+            if to:
+                borrower = borrower[:-1] if borrower.endswith(".") else borrower
+                borrowers.append(borrower.partition(" (from ")[0])
+                borrower_copies.append(copies)
+        else:
+            return_hours.append(line[1:14])
+            return_copies.append(copies)
+    return lend_hours, lend_copies, borrowers, borrower_copies, return_hours, return_copies
+
+
+def add_weighted(counter, keys, weights):
+    # Batches come from a time-ordered log, so equal keys sit next to each
+    # other; count runs of them instead of adding one row at a time.
+    if not keys:
+        return
+    run_key, run_total = keys[0], 0
+    for key, weight in zip(keys, weights):
+        if key != run_key:
+            counter[run_key] += run_total
+            run_key, run_total = key, 0
+        run_total += weight
+    counter[run_key] += run_total
+
+# === Partial Counts ===
+# What one segment contributes. Workers return these and the parent merges
+# them, so only counters cross the process boundary, never lines.
+class ReportTotals:
+    def __init__(self):
+        self.requests = 0
+        self.demand = Counter()  # title -> requests
+        self.requesters = Counter()  # username -> requests
+        self.request_hours = Counter()
+        self.changed = Counter()  # (state, title) of requests that are no longer pending
+        self.lent = Counter()  # hour -> copies lent
+        self.returned = Counter()  # hour -> copies returned
+        self.borrowers = Counter()  # borrower -> copies lent to them
+
+    def merge(self, other):
+        self.requests += other.requests
+        for name in ("demand", "requesters", "request_hours", "changed", "lent", "returned", "borrowers"):
+            getattr(self, name).update(getattr(other, name))
+        return self
+
+    def add_requests(self, users, titles, hours):
+        self.requests += len(titles)
+        self.demand.update(titles)
+        self.requesters.update(users)
+        self.request_hours.update(hours)
+
+    def add_activity(self, columns):
+        lend_hours, lend_copies, borrowers, borrower_copies, return_hours, return_copies = columns
+        add_weighted(self.lent, lend_hours, lend_copies)
+        add_weighted(self.returned, return_hours, return_copies)
+        for borrower, copies in zip(borrowers, borrower_copies):
+            self.borrowers[borrower] += copies
+
+
+def scan_requests(path, start, end):
+    totals = ReportTotals()
+    for lines in read_batches(path, start, end):
+        totals.add_requests(*request_columns(lines))
+    return totals
+
+
+def scan_request_states(path, start, end, first_id, states):
+    # (state, title) counts for the requests of this segment that appear in
+    # `states` (request id -> latest state); first_id is the segment's first.
+    totals = ReportTotals()
+    request_id = first_id
+    for lines in read_batches(path, start, end):
+        _, titles, _ = request_columns(lines)
+        for title in titles:
+            state = states.get(request_id)
+            if state is not None:
+                totals.changed[state, title] += 1
+            request_id += 1
+    return totals
+
+
+def scan_activity(path, start, end):
+    totals = ReportTotals()
+    for lines in read_batches(path, start, end):
+        totals.add_activity(activity_columns(lines))
+    return totals
+
+
+def read_states(path):
+    # request id -> latest non-pending state, from request_status.txt.
+    states = {}
+    if not os.path.exists(path):
+        return states
+    for lines in read_batches(path):
+        for line in lines:
+            parts = line.split("|")
+            if len(parts) >= 2 and parts[0].isdigit():
+                states[int(parts[0])] = parts[1]
+    return states
+
+# === Report ===
+class ReportBuilder:
+    def __init__(self, storage=None, workers=None, segment_bytes=SEGMENT_BYTES, pool_min_bytes=POOL_MIN_BYTES):
+        self.storage = storage or default_storage()
+        self.workers = workers or os.cpu_count() or 1
+        self.segment_bytes = segment_bytes
+        self.pool_min_bytes = pool_min_bytes
+
+    def pool(self, tasks, paths):
+        # Workers are spawned, not forked: the GUI builds reports on a thread
+        # of its own, and forking a process that has other threads running
+        # can copy a lock some other thread was holding.
+        if self.workers < 2 or tasks < 2:
+            return None
+        if sum(os.path.getsize(path) for path in set(paths) if os.path.exists(path)) < self.pool_min_bytes:
+            return None
+        return ProcessPoolExecutor(min(self.workers, tasks), mp_context=multiprocessing.get_context("spawn"))
+
+    def run(self, pool, fn, tasks):
+        if pool is None:
+            return [fn(*task) for task in tasks]
+        return list(pool.map(fn, *zip(*tasks)))
+
+    @perf.timed("ReportBuilder.totals")
+    def totals(self):
+        if isinstance(self.storage, SqliteStorage):
+            return self.sqlite_totals()
+        requests = self.storage.requests
+        request_segments = segments(requests.filename, self.segment_bytes)
+        activity_segments = [segment for path in self.storage.activity_log.segment_paths()
+                             for segment in segments(path, self.segment_bytes)]
+        all_segments = request_segments + activity_segments
+        pool = self.pool(len(all_segments), [path for path, _, _ in all_segments])
+        try:
+            totals = ReportTotals()
+            parts = self.run(pool, scan_requests, request_segments)
+            for part in parts:
+                totals.merge(part)
+            for part in self.run(pool, scan_activity, activity_segments):
+                totals.merge(part)
+            # Request ids are line numbers, which a segment only knows once
+            # the segments before it have been counted, so states are
+            # matched to titles in a second pass over the segments that
+            # hold a changed request.
+            states = read_states(requests.status_file)
+            tasks = []
+            first_id = 1
+            for (path, start, end), part in zip(request_segments, parts):
+                last_id = first_id + part.requests
+                mine = {request_id: state for request_id, state in states.items() if first_id <= request_id < last_id}
+                if mine:
+                    tasks.append((path, start, end, first_id, mine))
+                first_id = last_id
+            for part in self.run(pool if len(tasks) > 1 else None, scan_request_states, tasks):
+                totals.merge(part)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return totals
+
+    def sqlite_totals(self):
+        # One database file, so one reader: the same columns, a batch of
+        # rows at a time. The GUI builds reports on a thread of their own,
+        # so they read through a read-only connection of their own, in one
+        # transaction, instead of the storage's (which lends and returns use).
+        conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(self.storage.path))}?mode=ro", uri=True)
+        try:
+            conn.execute("BEGIN")
+            return self.sqlite_scan(conn)
+        finally:
+            conn.close()
+
+    def sqlite_scan(self, conn):
+        totals = ReportTotals()
+        cursor = conn.execute("SELECT username, title, requested_at, status FROM requests ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(CHUNK_ROWS)
+            if not rows:
+                break
+            users, titles, timestamps, states = zip(*rows)
+            totals.add_requests(users, titles, [timestamp[:13] for timestamp in timestamps])
+            totals.changed.update((state, title) for state, title in zip(states, titles) if state != "pending")
+        cursor = conn.execute("SELECT entry FROM activity_log ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(CHUNK_ROWS)
+            if not rows:
+                break
+            totals.add_activity(activity_columns([entry for entry, in rows]))
+        return totals
+
+    def report(self, top=REPORT_TOP):
+        return summarize(self.totals(), top)
+
+
+def hour_span(*counters):
+    hours = [hour for counter in counters for hour in counter]
+    try:
+        first, last = (datetime.strptime(hour, "%Y-%m-%d %H") for hour in (min(hours), max(hours)))
+    except ValueError:  # no hours, or a malformed timestamp
+        return 0
+    return int((last - first).total_seconds() // 3600) + 1
+
+
+def summarize(totals, top=REPORT_TOP):
+    closed_states = Counter()
+    not_open = Counter()
+    for (state, title), n in totals.changed.items():
+        closed_states[state] += n
+        if state not in OPEN_STATES:
+            not_open[title] += n
+    unfulfilled = Counter(totals.demand)
+    unfulfilled.subtract(not_open)
+    states = {"pending": totals.requests - sum(closed_states.values())}
+    states.update(closed_states)
+
+    hours = hour_span(totals.lent, totals.returned)
+    lent, returned = sum(totals.lent.values()), sum(totals.returned.values())
+    by_hour_of_day = [[0, 0] for _ in range(24)]
+    for counter, column in ((totals.lent, 0), (totals.returned, 1)):
+        for hour, copies in counter.items():
+            if hour[11:13].isdigit() and int(hour[11:13]) < 24:
+                by_hour_of_day[int(hour[11:13])][column] += copies
+    days = max(1, -(-hours // 24))
+    busiest = Counter(totals.lent)
+    busiest.update(totals.returned)
+    return {
+        "requests": totals.requests,
+        "request_states": states,
+        "unfulfilled_requests": sum(n for n in unfulfilled.values() if n > 0),
+        "top_demand": totals.demand.most_common(top),
+        "top_unfulfilled": [(title, n) for title, n in unfulfilled.most_common(top) if n > 0],
+        "top_requesters": totals.requesters.most_common(top),
+        "copies_lent": lent,
+        "copies_returned": returned,
+        "hours_covered": hours,
+        "lent_per_hour": round(lent / hours, 2) if hours else 0,
+        "returned_per_hour": round(returned / hours, 2) if hours else 0,
+        "busiest_hours": [(hour, totals.lent[hour], totals.returned[hour]) for hour, _ in busiest.most_common(top)],
+        "hour_of_day_per_day": [(hour, round(hour_lent / days, 2), round(hour_returned / days, 2))
+                                for hour, (hour_lent, hour_returned) in enumerate(by_hour_of_day)],
+        "top_borrowers": totals.borrowers.most_common(top),
+    }
+
+
+def build_report(storage=None, workers=None, top=REPORT_TOP):
+    return ReportBuilder(storage, workers).report(top)
+
+
+def format_report(report):
+    lines = [
+        f"Requests: {report['requests']} ({report['unfulfilled_requests']} unfulfilled)",
+        "  " + ", ".join(f"{state} {n}" for state, n in report["request_states"].items()),
+        f"Copies lent: {report['copies_lent']} ({report['lent_per_hour']}/hour), "
+        f"returned: {report['copies_returned']} ({report['returned_per_hour']}/hour) "
+        f"over {report['hours_covered']} hours",
+    ]
+    sections = (("Most requested", "top_demand"), ("Most unfulfilled", "top_unfulfilled"),
+                ("Top requesters", "top_requesters"), ("Top borrowers (copies)", "top_borrowers"))
+    for heading, key in sections:
+        lines.append(f"\n{heading}:")
+        lines.extend(f"  {n:>7}  {name}" for name, n in report[key])
+    lines.append("\nBusiest hours (lent / returned):")
+    lines.extend(f"  {hour}:00  {lent:>6} / {returned}" for hour, lent, returned in report["busiest_hours"])
+    lines.append("\nAverage per day by hour of day (lent / returned):")
+    lines.extend(f"  {hour:02d}:00  {lent:>8} / {returned}" for hour, lent, returned in report["hour_of_day_per_day"]
+                 if lent or returned)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m lendingreports", description="Report on requests and activity.")
+    parser.add_argument("--workers", type=int, help="processes to scan with (default: one per CPU)")
+    parser.add_argument("--top", type=int, default=REPORT_TOP, help="rows in each top list")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--perf", action="store_true", help="print timings to stderr when done")
+    args = parser.parse_args(argv)
+    perf.enabled = perf.enabled or args.perf
+    report = build_report(workers=args.workers, top=args.top)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    if args.perf:
+        print(perf.report(), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
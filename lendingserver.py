@@ -0,0 +1,531 @@
+"""Local JSON API in front of one shared Library.
+
+One process owns the catalog and every client talks to it over HTTP/1.1
+(keep-alive) on localhost or a Unix socket, instead of each window reading
+and locking the data files itself:
+
+    python -m lendingserver --port 8765
+    python -m lendingserver --unix /tmp/lending.sock
+
+Endpoints (JSON in, JSON out; all but /health, /login and /signup need
+"Authorization: Bearer <token>" from /login):
+
+    GET  /health
+    POST /login     {"username", "password"} -> {"token", "role"}
+    POST /signup    {"username", "password"}
+    GET  /books     ?q=&mode=substring|prefix|fuzzy&offset=0&limit=100
+                    &sort=title|available|total|lent&desc=1   (optional)
+                    &after=N   (unsorted, not fuzzy: resume after catalog
+                                number N, the last row of the previous page)
+    GET  /stats
+    POST /lend      {"title", "quantity", "borrower"}   (managers)
+    POST /return    {"title", "quantity", "borrower"}   (managers)
+    POST /add       {"title", "quantity"}               (managers)
+    POST /request   {"title"}
+    GET  /requests  the caller's own requests
+    GET  /loans     the caller's own loans
+    POST /batch     {"ops": [{"op": "lend", ...}, {"op": "search", ...}, ...]}
+
+Clients set BOOK_SERVER=http://127.0.0.1:8765 (or unix:/tmp/lending.sock)
+to have the GUI's customer view use LendingClient instead of the files.
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import secrets
+import socket
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from booklending import (
+    DUMMY_PASSWORD_HASH, SORT_COLUMNS, LendingError, LibraryService, hash_password, needs_rehash,
+    shared_library, verify_password,
+)
+
+# === CONFIG ===
+DEFAULT_PORT = 8765
+SYNC_INTERVAL = 2.0  # seconds between syncs with changes made by other processes
+IDLE_TIMEOUT = 60.0  # keep-alive connections idle this long are closed
+MAX_BODY = 1024 * 1024
+SEARCH_LIMIT = 100
+SEARCH_LIMIT_MAX = 1000
+SESSION_TTL = 8 * 3600  # seconds a login token stays valid after its last use
+SESSION_MAX = 10000  # the least recently used tokens beyond this are dropped
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def validate_signup(username, password):
+    # The same rules the sign-up tab applies.
+    if not username or not password:
+        raise LendingError("Please enter all fields.")
+    if len(password) < 6:
+        raise LendingError("Password must be at least 6 characters long.")
+    if username.lower() == password.lower():
+        raise LendingError("Password cannot be the same as the username.")
+
+
+def parse_quantity(value):
+    # JSON numbers, or digits from a query string.
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise HTTPError(400, "quantity must be a whole number of at least 1.")
+    return value
+
+# === Server ===
+# The event loop only parses requests and writes responses. Everything that
+# touches the Library runs on one library thread, in arrival order, so the
+# catalog needs no locking of its own and fsyncs never stall other
+# connections. Writes that arrive while a group of writes is being applied
+# queue up and are applied together in one Library.batch(): one file lock,
+# one journal append and one fsync for however many clients sent them.
+# Password hashing runs on a separate pool so logins don't hold up lending.
+# Sessions are kept in least-recently-used order and expire SESSION_TTL
+# seconds after their last request.
+class LendingServer:
+    def __init__(self, library=None):
+        self.library = library or shared_library()
+        self.library_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="library")
+        self.hashing = ThreadPoolExecutor(thread_name_prefix="hashing")
+        self.sessions = OrderedDict()  # token -> session, least recently used first
+        self.pending_writes = []
+        self.flushing = False
+        self.loop = None
+        self.routes = {
+            ("GET", "/health"): self.health,
+            ("POST", "/login"): self.login,
+            ("POST", "/signup"): self.signup,
+            ("GET", "/books"): self.books,
+            ("GET", "/stats"): self.stats,
+            ("POST", "/lend"): self.lend,
+            ("POST", "/return"): self.return_book,
+            ("POST", "/add"): self.add,
+            ("POST", "/request"): self.request,
+            ("GET", "/requests"): self.my_requests,
+            ("GET", "/loans"): self.my_loans,
+            ("POST", "/batch"): self.batch,
+        }
+
+    async def serve(self, host="127.0.0.1", port=DEFAULT_PORT, unix_path=None):
+        self.loop = asyncio.get_running_loop()
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+        sync_task = asyncio.create_task(self.sync_forever())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sync_task.cancel()
+            self.library_thread.shutdown()
+            self.hashing.shutdown()
+
+    async def sync_forever(self):
+        while True:
+            await asyncio.sleep(SYNC_INTERVAL)
+            try:
+                await self.read(self.library.sync)
+            except OSError as error:
+                print(f"sync failed: {error}", file=sys.stderr)
+
+    # --- HTTP ---
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not line:
+                    break
+                keep_alive = await self.handle_request(line, reader, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, line, reader, writer):
+        headers = {}
+        try:
+            method, target, version = line.decode("latin-1").split()
+            while True:
+                header = await reader.readline()
+                if header in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = header.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", "0"))
+            if length > MAX_BODY:
+                raise HTTPError(413, "Request body too large.")
+            body = await reader.readexactly(length) if length else b""
+        except HTTPError as error:
+            self.respond(writer, error.status, {"error": str(error)}, keep_alive=False)
+            return False
+        except ValueError:
+            self.respond(writer, 400, {"error": "Malformed request."}, keep_alive=False)
+            return False
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+        status, payload = await self.dispatch(method, target, headers, body)
+        self.respond(writer, status, payload, keep_alive)
+        return keep_alive
+
+    def respond(self, writer, status, payload, keep_alive):
+        data = json.dumps(payload).encode("utf-8")
+        head = (f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + data)
+
+    async def dispatch(self, method, target, headers, body):
+        url = urlsplit(target)
+        handler = self.routes.get((method, url.path))
+        if handler is None:
+            known = any(path == url.path for _, path in self.routes)
+            return (405, {"error": "Method not allowed."}) if known else (404, {"error": "Not found."})
+        try:
+            params = json.loads(body) if body else {}
+            if not isinstance(params, dict):
+                raise HTTPError(400, "Expected a JSON object.")
+            for name, values in parse_qs(url.query).items():
+                params.setdefault(name, values[-1])
+            session = self.session(headers.get("authorization", "").removeprefix("Bearer ").strip())
+            if handler not in (self.health, self.login, self.signup) and session is None:
+                raise HTTPError(401, "Log in first.")
+            return 200, await handler(params, session)
+        except HTTPError as error:
+            return error.status, {"error": str(error)}
+        except LendingError as error:
+            return 400, {"error": str(error)}
+        except (ValueError, TypeError, KeyError) as error:
+            return 400, {"error": f"Bad request: {error}"}
+        except Exception as error:
+            print(f"{method} {url.path} failed: {error!r}", file=sys.stderr)
+            return 500, {"error": "Internal error."}
+
+    # --- Library thread ---
+    def read(self, fn, *args):
+        return self.loop.run_in_executor(self.library_thread, fn, *args)
+
+    def write(self, fn, *args):
+        # The flush waits for the loop's next turn, so writes queued in the
+        # same turn (every op of a /batch, or requests that arrived together)
+        # go to the library thread as one group.
+        future = self.loop.create_future()
+        if not self.pending_writes:
+            self.loop.call_soon(self.flush_writes)
+        self.pending_writes.append((fn, args, future))
+        return future
+
+    def flush_writes(self):
+        if self.flushing or not self.pending_writes:
+            return
+        group, self.pending_writes = self.pending_writes, []
+        self.flushing = True
+        done = self.loop.run_in_executor(self.library_thread, self.apply_writes, group)
+        done.add_done_callback(lambda outcome: self.writes_applied(group, outcome))
+
+    def apply_writes(self, group):
+        # Runs on the library thread. A LendingError only fails its own
+        # request (it is raised before anything is written); anything else (a
+        # disk error) fails the whole group, and the batch rolls back every
+        # change in it, so no client is told a write failed that was kept.
+        results = []
+        with self.library.batch():
+            for fn, args, _ in group:
+                try:
+                    results.append((True, fn(*args)))
+                except LendingError as error:
+                    results.append((False, error))
+        return results
+
+    def writes_applied(self, group, outcome):
+        self.flushing = False
+        error = outcome.exception()
+        for index, (_, _, future) in enumerate(group):
+            if future.cancelled():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                ok, value = outcome.result()[index]
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+        self.flush_writes()
+
+    # --- Sessions ---
+    def session(self, token):
+        session = self.sessions.get(token)
+        if session is None:
+            return None
+        now = time.monotonic()
+        if session["expires"] <= now:
+            del self.sessions[token]
+            return None
+        session["expires"] = now + SESSION_TTL
+        self.sessions.move_to_end(token)
+        return session
+
+    def open_session(self, username, role):
+        now = time.monotonic()
+        while self.sessions:
+            token, oldest = next(iter(self.sessions.items()))
+            if oldest["expires"] > now and len(self.sessions) < SESSION_MAX:
+                break
+            del self.sessions[token]
+        token = secrets.token_urlsafe(24)
+        self.sessions[token] = {"username": username, "role": role, "expires": now + SESSION_TTL,
+                                "service": LibraryService(self.library, username)}
+        return token
+
+    # --- Endpoints ---
+    def require_manager(self, session):
+        if session["role"] != "manager":
+            raise HTTPError(403, "Managers only.")
+
+    async def health(self, params, session):
+        return {"ok": True, "loaded": self.library.loaded}
+
+    async def login(self, params, session):
+        username, password = str(params["username"]).strip(), str(params["password"])
+        storage = self.library.storage
+        for role in ("manager", "customer"):
+            stored = await self.read(storage.find_user, role, username)
+            if stored is not None and await self.loop.run_in_executor(self.hashing, verify_password,
+                                                                      password, stored):
+                if needs_rehash(stored):
+                    rehashed = await self.loop.run_in_executor(self.hashing, hash_password, password)
+                    await self.read(storage.save_user, username, rehashed, role)
+                return {"token": self.open_session(username, role), "role": role}
+        await self.loop.run_in_executor(self.hashing, verify_password, password, DUMMY_PASSWORD_HASH)
+        raise HTTPError(401, "Invalid credentials.")
+
+    async def signup(self, params, session):
+        username, password = str(params["username"]).strip(), str(params["password"]).strip()
+        validate_signup(username, password)
+        hashed = await self.loop.run_in_executor(self.hashing, hash_password, password)
+
+        def create():
+            storage = self.library.storage
+            if storage.find_user("customer", username) is not None:
+                raise LendingError("Username already exists.")
+            storage.save_user(username, hashed)
+        await self.read(create)
+        return {"created": username}
+
+    def search(self, params):
+        query = str(params.get("q", ""))
+        mode = params.get("mode", "substring")
+        if mode not in ("substring", "prefix", "fuzzy"):
+            raise HTTPError(400, f"Unknown search mode {mode!r}.")
+        offset = max(0, int(params.get("offset", 0)))
+        limit = min(SEARCH_LIMIT_MAX, max(1, int(params.get("limit", SEARCH_LIMIT))))
+        sort = params.get("sort")
+        after = params.get("after")
+        if sort is None and after is not None and mode != "fuzzy":
+            # Unsorted matches come in catalog order, so the next page starts
+            # straight after the last one instead of skipping `offset` matches.
+            matches = islice(self.library.iter_search_books(query, mode, max(0, int(after))), limit + 1)
+        elif sort is None:
+            matches = islice(self.library.iter_search_books(query, mode), offset, offset + limit + 1)
+        elif sort in SORT_COLUMNS:
+            descending = str(params.get("desc", "")) in ("1", "true", "True")
+            matches = self.library.sorted_books(sort, offset, offset + limit + 1, descending, query, mode)
+        else:
+            raise HTTPError(400, f"Unknown sort column {sort!r}.")
+        rows = [[number, book.title, book.available(), book.quantity] for number, book in matches]
+        return {"rows": rows[:limit], "more": len(rows) > limit}
+
+    async def books(self, params, session):
+        return await self.read(self.search, params)
+
+    async def stats(self, params, session):
+        return await self.read(session["service"].report)
+
+    async def lend(self, params, session):
+        self.require_manager(session)
+        await self.write(session["service"].lend_book, *self.copies(params))
+        return {"ok": True}
+
+    async def return_book(self, params, session):
+        self.require_manager(session)
+        await self.write(session["service"].return_book, *self.copies(params))
+        return {"ok": True}
+
+    async def add(self, params, session):
+        self.require_manager(session)
+        await self.write(session["service"].add_book, str(params["title"]), parse_quantity(params.get("quantity", 1)))
+        return {"ok": True}
+
+    @staticmethod
+    def copies(params):
+        return str(params["title"]), parse_quantity(params.get("quantity", 1)), params.get("borrower") or None
+
+    async def request(self, params, session):
+        book = await self.write(session["service"].request_book, str(params["title"]))
+        return {"title": book.title}
+
+    async def my_requests(self, params, session):
+        store = self.library.storage.requests
+        requests = await self.read(store.user_requests, session["username"])
+        return {"requests": [[title, requested_at, state] for _, title, requested_at, state in requests]}
+
+    async def my_loans(self, params, session):
+        loans = await self.read(session["service"].borrower_loans, session["username"])
+        return {"loans": [list(loan) for loan in loans]}
+
+    async def batch(self, params, session):
+        # Runs each op as if it were sent on its own. Every op is started
+        # before the loop turns, so the writes in it are queued before the
+        # flush and land in one write group (one journal append), unless a
+        # group is already being applied, in which case they make up the next.
+        ops = params["ops"]
+        if not isinstance(ops, list):
+            raise HTTPError(400, "ops must be a list.")
+        handlers = {"search": self.books, "lend": self.lend, "return": self.return_book, "add": self.add,
+                    "request": self.request, "requests": self.my_requests, "loans": self.my_loans}
+
+        async def run(op):
+            handler = handlers.get(op.get("op")) if isinstance(op, dict) else None
+            if handler is None:
+                return {"error": f"Unknown op {op!r}."}
+            try:
+                return await handler(op, session)
+            except (HTTPError, LendingError, ValueError, TypeError, KeyError) as error:
+                return {"error": str(error)}
+        return {"results": await asyncio.gather(*(run(op) for op in ops))}
+
+# === Client ===
+# A blocking client on one keep-alive connection, for the GUI's worker
+# thread and for scripts. Errors the server reports as 4xx come back as
+# LendingError with the server's message.
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=30):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class LendingClient:
+    def __init__(self, url, timeout=30):
+        self.url = url
+        self.timeout = timeout
+        self.token = None
+        self.role = None
+        self.conn = None
+
+    def connect(self):
+        if self.url.startswith("unix:"):
+            return UnixHTTPConnection(self.url[len("unix:"):], self.timeout)
+        parts = urlsplit(self.url)
+        return http.client.HTTPConnection(parts.hostname or "127.0.0.1", parts.port or DEFAULT_PORT,
+                                          timeout=self.timeout)
+
+    def call(self, method, path, payload=None):
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = self.connect()
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = json.loads(response.read() or b"{}")
+                break
+            except (ConnectionError, http.client.HTTPException):
+                # The server closed an idle keep-alive connection; reconnect once.
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        if response.status >= 400:
+            raise LendingError(data.get("error", f"Server answered {response.status}."))
+        return data
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def login(self, username, password):
+        try:
+            result = self.call("POST", "/login", {"username": username, "password": password})
+        except LendingError:
+            return None
+        self.token, self.role = result["token"], result["role"]
+        return self.role
+
+    def signup(self, username, password):
+        self.call("POST", "/signup", {"username": username, "password": password})
+
+    def search_books(self, query, mode="substring", offset=0, limit=SEARCH_LIMIT, sort=None, descending=False,
+                     after=None):
+        # (rows of [number, title, available, quantity], whether more follow)
+        params = {"q": query, "mode": mode, "offset": offset, "limit": limit}
+        if sort is not None:
+            params.update(sort=sort, desc=int(descending))
+        if after is not None:
+            params["after"] = after
+        query = urlencode(params)
+        result = self.call("GET", f"/books?{query}")
+        return result["rows"], result["more"]
+
+    def request_book(self, title):
+        return self.call("POST", "/request", {"title": title})["title"]
+
+    def user_requests(self):
+        return self.call("GET", "/requests")["requests"]
+
+    def loans(self):
+        return self.call("GET", "/loans")["loans"]
+
+    def batch(self, ops):
+        return self.call("POST", "/batch", {"ops": ops})["results"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m lendingserver", description="Serve the library over HTTP/JSON.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--unix", metavar="PATH", help="listen on a Unix socket instead of TCP")
+    args = parser.parse_args(argv)
+    if args.unix and os.path.exists(args.unix):
+        os.remove(args.unix)
+    server = LendingServer(shared_library())
+    where = f"unix:{args.unix}" if args.unix else f"http://{args.host}:{args.port}"
+    print(f"Serving {len(server.library.books)} titles on {where}", flush=True)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+"""Benchmark suite for the lending system's data paths.
+
+For each catalog size it generates a data set (tools/generate_data.py) and
+times, in a fresh interpreter per size, the work behind the app's slow
+spots without opening a window:
+
+  load            Library(): parse library.txt, replay the journal, build the index
+  save            save_books(): rewrite the catalog snapshot
+  rows            every row of the book list, as refresh_books() builds them
+  search_*        substring / short / prefix / fuzzy searches, materialised
+  sort_first      the first page sorted by availability (builds that sort index)
+  sort_page       a later page from the middle of another sort order
+  lend_return     one lend plus one return through the service, persisted
+  login_first     the first users.txt lookup (parses the file)
+  login_lookup    a later lookup of another user
+  dashboard       what the dashboard reads: log tail, requests, top titles, stats
+  peak_rss_mb     peak resident memory after all of the above (Unix only)
+
+Times are the best of --repeat runs, in milliseconds. Results go to a JSON
+file tagged with the git commit, and --compare prints the ratio against an
+earlier results file so regressions show up between commits.
+
+    python tools/bench_lending.py --sizes 1000 100000 1000000 --output bench.json
+    python tools/bench_lending.py --sizes 1000 100000 --compare bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(TOOLS)
+
+
+def best(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return min(times) * 1000
+
+
+def measure(repeat, lend_ops):
+    # Runs inside the data directory, in a child interpreter.
+    started = time.perf_counter()
+    import booklending
+    results = {"import": (time.perf_counter() - started) * 1000}
+
+    library = None
+
+    def load():
+        nonlocal library
+        library = booklending.Library(storage=booklending.default_storage())
+    # The first load is cold; later ones rebuild the same state from warm
+    # page cache, like a restart would.
+    results["load_cold"] = best(load, 1)
+    results["load"] = best(load, repeat)
+    results["save"] = best(library.save_books, repeat)
+    results["rows"] = best(lambda: [(book.title, book.available(), book.quantity)
+                                    for _, book in library.search_books("")], repeat)
+    for name, query, mode in (("search_substring", "Golden Harbor", "substring"),
+                              ("search_short", "Ky", "substring"),
+                              ("search_prefix", "The Lost", "prefix"),
+                              ("search_fuzzy", "golden harbr", "fuzzy")):
+        results[name] = best(lambda: library.search_books(query, mode), repeat)
+    results["sort_first"] = best(lambda: library.sorted_books("available", 0, 50, True), 1)
+    middle = len(library.books) // 2
+    results["sort_page"] = best(lambda: library.sorted_books("available", middle, middle + 50), repeat)
+
+    service = booklending.LibraryService(library, "manager0")
+    title = next(book.title for book in library.books.values() if book.available() > 0)
+
+    def lend_return():
+        for _ in range(lend_ops):
+            service.lend_book(title, 1, "user0000001")
+            service.return_book(title, 1, "user0000001")
+    results["lend_return"] = best(lend_return, repeat) / lend_ops
+
+    storage = library.storage
+    results["login_first"] = best(lambda: storage.find_user("customer", "user0000002"), 1)
+    results["login_lookup"] = best(lambda: storage.find_user("customer", "user0000003"), repeat)
+
+    def dashboard():
+        list(storage.activity_log.entries)
+        storage.requests.refresh()
+        storage.requests.most_requested()
+        service.report()
+    results["dashboard"] = best(dashboard, repeat)
+    results["books"] = len(library.books)
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+        scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+        results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    return results
+
+
+def run_size(size, backend, repeat, lend_ops):
+    # Imported here so the child's import time stays cold.
+    sys.path.insert(0, TOOLS)
+    from generate_data import generate
+
+    with tempfile.TemporaryDirectory(prefix=f"lending-bench-{size}-") as data_dir:
+        generate(data_dir, size)
+        env = dict(os.environ, PYTHONPATH=REPO, BOOK_STORAGE=backend)
+        if backend == "sqlite":
+            subprocess.run([sys.executable, "-m", "booklending", "migrate-sqlite"], cwd=data_dir, env=env,
+                           check=True, capture_output=True)
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child",
+                              "--repeat", str(repeat), "--lend-ops", str(lend_ops)],
+                             cwd=data_dir, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(report, baseline=None):
+    for size, results in report["results"].items():
+        print(f"\n{size} titles ({report['backend']})")
+        old = (baseline or {}).get("results", {}).get(size, {})
+        for name, value in results.items():
+            line = f"  {name:<18} {value:>12}" if isinstance(value, int) else f"  {name:<18} {value:>12.2f}"
+            if isinstance(old.get(name), (int, float)) and old[name]:
+                line += f"   {value / old[name]:>6.2f}x vs {baseline.get('commit')}"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--backend", choices=["text", "sqlite"], default="text")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the best one is kept")
+    parser.add_argument("--lend-ops", type=int, default=20, help="lend/return pairs per lend_return run")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="an earlier JSON results file to compare against")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.repeat, args.lend_ops)))
+        return
+
+    report = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": args.backend,
+        "results": {},
+    }
+    for size in args.sizes:
+        report["results"][str(size)] = run_size(size, args.backend, args.repeat, args.lend_ops)
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+    print_table(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
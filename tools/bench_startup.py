@@ -0,0 +1,99 @@
+"""Startup benchmark for the manager view's data path.
+
+Generates a catalog of N titles (plus an activity log and a requests file)
+and measures, each in a fresh interpreter so imports are cold:
+
+  before  what the manager view waited for before it could paint: import,
+          the full catalog load and index build, the activity log tail and
+          a full read of requests.txt
+  first   what it waits for now: import and the first catalog chunk
+  full    the lazy path run to the end (every chunk), for comparison
+  snap    a full open from an up-to-date library.snap (written by an
+          untimed load first)
+
+before, first and full run with BOOK_SNAPSHOT=0 and no library.snap on
+disk, so they measure the text path they are named after.
+No window is opened, so this runs headless; the GUI adds the same
+customtkinter import and widget setup to both sides.
+
+    python tools/bench_startup.py
+    python tools/bench_startup.py --sizes 10000 100000 1000000 --repeat 3
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPETS = {
+    "before": (
+        "lib = booklending.Library()\n"
+        "list(lib.storage.activity_log.entries)\n"
+        "lib.storage.requests.refresh()\n"
+    ),
+    "first": (
+        "lib = booklending.Library(lazy=True)\n"
+        "lib.load_next_chunk()\n"
+    ),
+    "full": (
+        "lib = booklending.Library(lazy=True)\n"
+        "lib.ensure_loaded()\n"
+    ),
+    "snap": (
+        "lib = booklending.Library()\n"
+    ),
+}
+
+
+def make_data(data_dir, titles):
+    with open(os.path.join(data_dir, "library.txt"), "w") as f:
+        for i in range(titles):
+            f.write(f"Benchmark Title {i:07d} Volume {i % 97}|{1 + i % 5}|{i % 2}\n")
+    with open(os.path.join(data_dir, "activity_log.txt"), "w") as f:
+        for i in range(titles // 10):
+            f.write(f"[2024-01-01 10:00:00] bench: Lent 1 copy of 'Benchmark Title {i:07d}'\n")
+    with open(os.path.join(data_dir, "requests.txt"), "w") as f:
+        for i in range(titles // 10):
+            f.write(f"reader{i % 500}|Benchmark Title {i:07d}|2024-01-01 10:00:00\n")
+
+
+def run(data_dir, mode):
+    snapshot = os.path.join(data_dir, "library.snap")
+    if mode != "snap" and os.path.exists(snapshot):
+        os.remove(snapshot)
+    code = (
+        "import time\n"
+        "started = time.perf_counter()\n"
+        "import booklending\n"
+        + SNIPPETS[mode]
+        + "print(time.perf_counter() - started)\n"
+    )
+    env = dict(os.environ, PYTHONPATH=REPO, BOOK_STORAGE="text", BOOK_SNAPSHOT="1" if mode == "snap" else "0")
+    out = subprocess.run([sys.executable, "-c", code], cwd=data_dir, env=env,
+                         check=True, capture_output=True, text=True).stdout
+    return float(out.split()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the best one is kept")
+    args = parser.parse_args()
+
+    print(f"{'titles':>9} {'before':>10} {'first':>10} {'full':>10} {'speedup':>8} {'snap':>10}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory(prefix="lending-startup-") as data_dir:
+            make_data(data_dir, size)
+            times = {mode: min(run(data_dir, mode) for _ in range(args.repeat))
+                     for mode in ("before", "first", "full")}
+            run(data_dir, "snap")  # writes library.snap
+            times["snap"] = min(run(data_dir, "snap") for _ in range(args.repeat))
+        print(f"{size:>9} {times['before'] * 1000:>8.0f}ms {times['first'] * 1000:>8.0f}ms "
+              f"{times['full'] * 1000:>8.0f}ms {times['before'] / times['first']:>7.1f}x "
+              f"{times['snap'] * 1000:>8.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
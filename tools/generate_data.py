@@ -0,0 +1,127 @@
+"""Synthetic data generator for the lending system.
+
+Writes library.txt, users.txt, managers.txt, requests.txt and
+activity_log.txt in the app's own formats into a data directory, so load,
+search, login and dashboard paths can be exercised at sizes the bundled
+sample files never reach. Titles are built from a small vocabulary (so
+searches hit realistic numbers of matches) plus a serial number that keeps
+them unique. Every user gets the same password hash, computed once.
+
+    python tools/generate_data.py /tmp/lending-1m --titles 1000000
+    python tools/generate_data.py data --titles 100000 --users 50000 --requests 200000
+    python tools/generate_data.py /tmp/chain --titles 100000 --branches 4
+
+With --branches the catalog is written as a chain of branch shards instead
+(branches.txt plus branches/<name>/library.txt), each title stocked at a
+random one to all of the branches.
+
+Log in to a generated data set as any user0000042 / manager3 with
+password "password".
+"""
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from booklending import hash_password  # noqa: E402
+
+ADJECTIVES = ["Silent", "Lost", "Golden", "Broken", "Hidden", "Last", "Crimson", "Winter", "Distant",
+              "Burning", "Quiet", "Wandering", "Forgotten", "Little", "Great", "Secret"]
+NOUNS = ["River", "Kingdom", "Garden", "Letters", "Orchard", "Harbor", "Mountain", "Empire", "Lantern",
+         "Mirror", "Island", "Library", "Machine", "Storm", "Forest", "Daughter"]
+PLACES = ["the North", "Avalon", "the Sea", "Paris", "the Moon", "Manila", "the Valley", "Babel",
+          "the Desert", "Kyoto", "the Stars", "Eden"]
+ACTIONS = ["Lent {n} copies of \"{title}\".", "Returned {n} copies of \"{title}\".",
+           "Added {n} copies of \"{title}\".", "User requested \"{title}\"."]
+PASSWORD = "password"
+START = datetime(2024, 1, 1, 8, 0, 0)
+
+
+def make_title(rng, number):
+    return f"The {rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} of {rng.choice(PLACES)} {number:07d}"
+
+
+def write_lines(path, lines):
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+
+
+def generate(data_dir, titles=1000, users=None, managers=5, requests=None, log_entries=None, seed=0, branches=0):
+    """Writes a data set into data_dir and returns its catalog titles.
+
+    users, requests and log_entries default to a tenth of the catalog.
+    branches > 0 splits the catalog into that many branch shards.
+    """
+    users = max(10, titles // 10) if users is None else users
+    requests = titles // 10 if requests is None else requests
+    log_entries = titles // 10 if log_entries is None else log_entries
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    password = hash_password(PASSWORD)
+
+    catalog = [make_title(rng, number) for number in range(titles)]
+    if branches:
+        names = [f"branch{number}" for number in range(branches)]
+        write_lines(os.path.join(data_dir, "branches.txt"),
+                    (f"{name}|{rng.uniform(0, 50):.1f}|{rng.uniform(0, 50):.1f}\n" for name in names))
+        shards = {name: [] for name in names}
+        for title in catalog:
+            for name in rng.sample(names, rng.randint(1, branches)):
+                quantity = rng.randint(1, 5)
+                shards[name].append(f"{title}|{quantity}|{rng.randint(0, quantity)}\n")
+        for name, lines in shards.items():
+            os.makedirs(os.path.join(data_dir, "branches", name), exist_ok=True)
+            write_lines(os.path.join(data_dir, "branches", name, "library.txt"), lines)
+    else:
+        lines = []
+        for title in catalog:
+            quantity = rng.randint(1, 10)
+            lines.append(f"{title}|{quantity}|{rng.randint(0, quantity)}\n")
+        write_lines(os.path.join(data_dir, "library.txt"), lines)
+
+    usernames = [f"user{number:07d}" for number in range(users)]
+    write_lines(os.path.join(data_dir, "users.txt"), (f"{name},{password}\n" for name in usernames))
+    write_lines(os.path.join(data_dir, "managers.txt"),
+                (f"manager{number},{password}\n" for number in range(managers)))
+
+    # Requests favour a small set of popular titles, like real demand does.
+    popular = catalog[:max(1, titles // 100)]
+    timestamp = START
+    lines = []
+    for _ in range(requests):
+        timestamp += timedelta(seconds=rng.randint(1, 600))
+        title = rng.choice(popular) if rng.random() < 0.5 else rng.choice(catalog)
+        lines.append(f"{rng.choice(usernames)}|{title}|{timestamp:%Y-%m-%d %H:%M:%S}\n")
+    write_lines(os.path.join(data_dir, "requests.txt"), lines)
+
+    timestamp = START
+    lines = []
+    for _ in range(log_entries):
+        timestamp += timedelta(seconds=rng.randint(1, 600))
+        action = rng.choice(ACTIONS).format(n=rng.randint(1, 3), title=rng.choice(catalog))
+        lines.append(f"[{timestamp:%Y-%m-%d %H:%M:%S}] (manager{rng.randrange(managers)}) {action}\n")
+    write_lines(os.path.join(data_dir, "activity_log.txt"), lines)
+    return catalog
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("data_dir")
+    parser.add_argument("--titles", type=int, default=1000)
+    parser.add_argument("--users", type=int, help="customer accounts (default: titles / 10)")
+    parser.add_argument("--managers", type=int, default=5)
+    parser.add_argument("--requests", type=int, help="book requests (default: titles / 10)")
+    parser.add_argument("--log-entries", type=int, help="activity log lines (default: titles / 10)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--branches", type=int, default=0, help="split the catalog into this many branch shards")
+    args = parser.parse_args()
+    generate(args.data_dir, args.titles, args.users, args.managers, args.requests, args.log_entries, args.seed,
+             args.branches)
+    print(f"Wrote {args.titles} titles into {args.data_dir}.")
+
+
+if __name__ == "__main__":
+    main()
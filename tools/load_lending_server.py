@@ -0,0 +1,235 @@
+"""Load generator for lendingserver.py.
+
+Generates a data set (tools/generate_data.py), starts the server on it and
+opens --clients concurrent keep-alive connections, each sending a mix of
+searches, lend/return pairs, requests and small batches for --seconds.
+Prints throughput and p50/p95/p99 latency per operation, then reloads the
+catalog from the files and checks that every successful lend and return
+the clients saw was persisted, and nothing else.
+
+    python tools/load_lending_server.py --clients 200 --seconds 10
+    python tools/load_lending_server.py --titles 1000000 --clients 500
+    python tools/load_lending_server.py --url http://127.0.0.1:8765   (an already running server)
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlencode, urlsplit
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(TOOLS)
+sys.path.insert(0, TOOLS)
+sys.path.insert(0, REPO)
+
+from generate_data import PASSWORD, generate  # noqa: E402
+
+WORDS = ["golden", "harbor", "lost", "river", "the sea", "kyoto", "mirror", "storm", "00012", "ga"]
+
+
+class Connection:
+    # One keep-alive HTTP/1.1 connection speaking just enough of the protocol.
+    def __init__(self, url, token=None):
+        self.url = url
+        self.token = token
+        self.reader = self.writer = None
+
+    async def open(self):
+        if self.url.startswith("unix:"):
+            self.reader, self.writer = await asyncio.open_unix_connection(self.url[len("unix:"):])
+        else:
+            parts = urlsplit(self.url)
+            self.reader, self.writer = await asyncio.open_connection(parts.hostname, parts.port)
+
+    async def call(self, method, path, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        auth = f"Authorization: Bearer {self.token}\r\n" if self.token else ""
+        self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n{auth}"
+                          f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode().partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        return status, json.loads(await self.reader.readexactly(length))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def login(url, username):
+    conn = Connection(url)
+    await conn.open()
+    status, result = await conn.call("POST", "/login", {"username": username, "password": PASSWORD})
+    conn.close()
+    if status != 200:
+        raise SystemExit(f"login as {username} failed: {result}")
+    return result["token"]
+
+
+async def client(url, manager_token, customer_token, titles, deadline, seed, latencies, outcome):
+    rng = random.Random(seed)
+    manager = Connection(url, manager_token)
+    customer = Connection(url, customer_token)
+    await manager.open()
+    await customer.open()
+    lent, returned = outcome
+    try:
+        while time.perf_counter() < deadline:
+            roll = rng.random()
+            started = time.perf_counter()
+            if roll < 0.7:
+                name = "search"
+                query = urlencode({"q": rng.choice(WORDS), "limit": 50})
+                status, _ = await customer.call("GET", f"/books?{query}")
+            elif roll < 0.85:
+                name = "lend+return"
+                title = rng.choice(titles)
+                status, _ = await manager.call("POST", "/lend", {"title": title, "borrower": f"user{seed:07d}"})
+                if status == 200:
+                    lent[title] += 1
+                    status, _ = await manager.call("POST", "/return", {"title": title})
+                    if status == 200:
+                        returned[title] += 1
+                status = 200  # an empty shelf is a valid outcome under load
+            elif roll < 0.95:
+                name = "request"
+                status, _ = await customer.call("POST", "/request", {"title": rng.choice(titles)})
+            else:
+                name = "batch"
+                picks = rng.sample(titles, 3)
+                ops = [{"op": "lend", "title": title} for title in picks] + [{"op": "search", "q": "lost"}]
+                status, result = await manager.call("POST", "/batch", {"ops": ops})
+                for title, op_result in zip(picks, result.get("results", [])):
+                    if op_result.get("ok"):
+                        lent[title] += 1
+            latencies[name].append(time.perf_counter() - started)
+            if status != 200:
+                latencies["errors"].append(0.0)
+    finally:
+        manager.close()
+        customer.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+
+async def run_load(url, clients, seconds, titles):
+    manager_token = await login(url, "manager0")
+    customer_token = await login(url, "user0000000")
+    latencies = defaultdict(list)
+    outcome = (Counter(), Counter())
+    started = time.perf_counter()
+    deadline = started + seconds
+    await asyncio.gather(*(client(url, manager_token, customer_token, titles, deadline, seed, latencies, outcome)
+                           for seed in range(clients)))
+    return latencies, outcome, time.perf_counter() - started
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url, process):
+    async def ping():
+        conn = Connection(url)
+        await conn.open()
+        try:
+            return await conn.call("GET", "/health")
+        finally:
+            conn.close()
+    while True:
+        if process.poll() is not None:
+            raise SystemExit("the server exited during startup")
+        try:
+            return asyncio.run(ping())
+        except OSError:
+            time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--titles", type=int, default=10000, help="catalog size of the generated data set")
+    parser.add_argument("--hot-titles", type=int, default=50, help="titles the lend/return traffic is spread over")
+    parser.add_argument("--unix", action="store_true", help="serve on a Unix socket instead of TCP")
+    parser.add_argument("--url", help="load an already running server (no data set, no persistence check)")
+    args = parser.parse_args()
+
+    process = data_dir = None
+    if args.url:
+        url = args.url
+    else:
+        data_dir = tempfile.mkdtemp(prefix="lending-load-")
+        generate(data_dir, args.titles)
+        if args.unix:
+            path = os.path.join(data_dir, "server.sock")
+            url, listen = f"unix:{path}", ["--unix", path]
+        else:
+            port = free_port()
+            url, listen = f"http://127.0.0.1:{port}", ["--port", str(port)]
+        env = dict(os.environ, PYTHONPATH=REPO, BOOK_STORAGE="text")
+        process = subprocess.Popen([sys.executable, "-m", "lendingserver", *listen], cwd=data_dir, env=env)
+        wait_until_up(url, process)
+
+    original = {}  # is_lent of the hot titles before the run
+    try:
+        if data_dir:
+            with open(os.path.join(data_dir, "library.txt")) as f:
+                for line in f:
+                    title, _, is_lent = line.rstrip("\n").split("|")
+                    original[title] = int(is_lent)
+                    if len(original) == args.hot_titles:
+                        break
+            hot = list(original)
+        else:
+            hot = [f"The Golden Harbor of the Sea {i:07d}" for i in range(args.hot_titles)]
+        latencies, (lent, returned), elapsed = asyncio.run(run_load(url, args.clients, args.seconds, hot))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    total = sum(len(values) for name, values in latencies.items() if name != "errors")
+    print(f"{args.clients} clients, {total} operations in {elapsed:.1f}s = {total / elapsed:.0f} ops/s "
+          f"({len(latencies['errors'])} errors)")
+    for name, values in sorted(latencies.items()):
+        if name != "errors":
+            print(f"  {name:<12} {len(values):>7}  p50 {percentile(values, 0.5):7.2f} ms  "
+                  f"p95 {percentile(values, 0.95):7.2f} ms  p99 {percentile(values, 0.99):7.2f} ms")
+
+    if data_dir:
+        os.chdir(data_dir)
+        import booklending
+        library = booklending.Library(storage=booklending.TextStorage())
+        failures = []
+        for title in hot:
+            expected = original[title] + lent[title] - returned[title]
+            if library.books[title].is_lent != expected:
+                failures.append(f"{title}: is_lent={library.books[title].is_lent}, expected {expected}")
+        for failure in failures:
+            print("FAIL", failure)
+        if failures:
+            sys.exit(1)
+        print(f"OK: {sum(lent.values())} lends and {sum(returned.values())} returns persisted exactly")
+
+
+if __name__ == "__main__":
+    main()
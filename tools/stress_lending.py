@@ -0,0 +1,129 @@
+"""Stress harness for lending from several processes at once.
+
+Starts N processes that lend and return the same few titles against one
+data directory, then reloads the catalog and checks that no lend or return
+was lost and that every title still has 0 <= is_lent <= quantity.
+
+    python tools/stress_lending.py --processes 8 --operations 300
+    python tools/stress_lending.py --backend sqlite
+    python tools/stress_lending.py --branches 3   (a branch chain; process i works at branch i % 3)
+"""
+import argparse
+import importlib
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_app(backend, compact_every):
+    os.environ["BOOK_STORAGE"] = backend
+    app = importlib.import_module("booklending")
+    app.STORAGE_BACKEND = backend
+    app.JOURNAL_COMPACT_EVERY = compact_every
+    return app
+
+
+def open_library(app, branches, seed=0):
+    if branches:
+        return app.BranchLibrary(app.load_branches(), home=f"branch{seed % branches}")
+    return app.Library()
+
+
+def worker(data_dir, backend, compact_every, branches, titles, operations, seed, results):
+    try:
+        os.chdir(data_dir)
+        library = open_library(load_app(backend, compact_every), branches, seed)
+        rng = random.Random(seed)
+        lent = dict.fromkeys(titles, 0)
+        returned = dict.fromkeys(titles, 0)
+        for _ in range(operations):
+            title = rng.choice(titles)
+            if rng.random() < 0.6:
+                if library.lend_book(title):
+                    lent[title] += 1
+            elif library.return_book(title):
+                returned[title] += 1
+        results.put((lent, returned))
+    except Exception as error:
+        results.put(f"process {seed} crashed: {error!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--operations", type=int, default=300, help="lend/return attempts per process")
+    parser.add_argument("--titles", type=int, default=3)
+    parser.add_argument("--copies", type=int, default=5)
+    parser.add_argument("--backend", choices=["text", "sqlite"], default="text")
+    parser.add_argument("--compact-every", type=int, default=50,
+                        help="journal records between compactions, kept low to exercise them")
+    parser.add_argument("--branches", type=int, default=0, help="split the copies over this many branch shards")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="lending-stress-")
+    os.chdir(data_dir)
+    titles = [f"Stress Title {i}" for i in range(args.titles)]
+    if args.branches:
+        with open("branches.txt", "w") as f:
+            for i in range(args.branches):
+                f.write(f"branch{i}|{i * 10}|0\n")
+        library = open_library(load_app(args.backend, args.compact_every), args.branches)
+        for branch in library.branches.values():
+            for title in titles:
+                branch.add_book(title, args.copies)
+    else:
+        with open("library.txt", "w") as f:
+            for title in titles:
+                f.write(f"{title}|{args.copies}|0\n")
+        if args.backend == "sqlite":
+            load_app(args.backend, args.compact_every).migrate_text_to_sqlite()
+
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=worker, args=(data_dir, args.backend, args.compact_every, args.branches,
+                                                     titles, args.operations, seed, results))
+        for seed in range(args.processes)
+    ]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    failures = [outcome for outcome in outcomes if isinstance(outcome, str)]
+    outcomes = [outcome for outcome in outcomes if not isinstance(outcome, str)]
+    library = open_library(load_app(args.backend, args.compact_every), args.branches)
+    shards = list(library.branches.values()) if args.branches else [library]
+    total_ok = 0
+    for title in titles:
+        lent = sum(outcome[0][title] for outcome in outcomes)
+        returned = sum(outcome[1][title] for outcome in outcomes)
+        total_ok += lent + returned
+        book = library.books[title]
+        if book.is_lent != lent - returned:
+            failures.append(f"{title}: is_lent={book.is_lent}, expected {lent - returned} "
+                            f"({lent} lends - {returned} returns)")
+        for shard in shards:
+            book = shard.books[title]
+            if not 0 <= book.is_lent <= book.quantity:
+                failures.append(f"{title}: is_lent={book.is_lent} outside 0..{book.quantity}")
+
+    attempts = args.processes * args.operations
+    print(f"{args.backend}: {attempts} attempts ({total_ok} succeeded) from {args.processes} processes "
+          f"in {elapsed:.2f}s, data in {data_dir}")
+    for failure in failures:
+        print("FAIL", failure)
+    if failures:
+        sys.exit(1)
+    print("OK: no lost updates, all counts within range")
+
+
+if __name__ == "__main__":
+    main()